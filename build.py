@@ -1,11 +1,39 @@
 #!/usr/bin/env python3
 
 import argparse
-from ninja import Writer, ninja as run_build
+from fnmatch import fnmatch
+from ninja import BIN_DIR as NINJA_BIN_DIR, Writer, ninja as run_build
 import os
+import random
 import sys
 
 from build_system.json_generator import JsonGenerator
+from build_system.extra_files import import_file
+from build_system.interference import check_assembly
+from build_system.manifest import load_manifest, write_manifest
+from build_system.openscad import default_executable, parameters_to_string
+from build_system.preview import preview_path
+from build_system.plan import default_jobs, estimate_durations, explain_build, plan_report
+from build_system.preflight import preflight
+from build_system.print_estimate import DEFAULT_SETTINGS as PRINT_SETTINGS, estimate_prints
+from build_system.printability import limit_arguments
+from build_system.progress import run_with_progress
+from build_system.refs import build_refs
+from build_system.render_history import (
+    HISTORY_FILE,
+    RENDER_LOG,
+    read_records,
+    record_build,
+    typical_durations,
+)
+from build_system.thumbnail import make_thumbnails
+from build_system.variants import (
+    Exclusion,
+    VariantMatrix,
+    parse_axis_argument,
+    variant_report,
+)
+from build_system.watch import watch
 
 stl_presets = [
     {
@@ -212,6 +240,10 @@ required_stls = [
     r"^feet.*\.stl",
 ]
 
+# test prints, which are built but aren't part of a microscope, so they are
+# left out of the print estimate of each configuration
+test_stls = ["just_leg_test.stl"]
+
 build_dir = "builds"
 
 build_file = open("build.ninja", "w")
@@ -228,53 +260,261 @@ parser.add_argument(
 )
 parser.add_argument(
     "--include-extra-files",
-    help="Copy over STL files from openflexure-microscope-extra/ into the builds/ folder.",
+    help="Link or copy STL files from openflexure-microscope-extra/ into the builds/ folder.",
+    action="store_true",
+)
+parser.add_argument(
+    "--previews",
+    help="Make small preview meshes of every STL for the web STL selector, listed in stl_options.json.",
+    action="store_true",
+)
+parser.add_argument(
+    "--printability",
+    help="Measure overhangs and wall thickness of every STL, and fail if they are beyond the limits in build.py.",
+    action="store_true",
+)
+parser.add_argument(
+    "--thumbnails",
+    help="Draw a picture of every STL for the web STL selector and the docs, listed in stl_options.json.",
+    action="store_true",
+)
+parser.add_argument(
+    "--print-estimates",
+    help="Slice every STL to estimate its print time and filament, listed in stl_options.json "
+    "for each STL and totalled for each preset.",
+    action="store_true",
+)
+parser.add_argument(
+    "--layer-height",
+    help="Layer height in mm for --print-estimates.",
+    type=float,
+    default=PRINT_SETTINGS["layer_height"],
+)
+parser.add_argument(
+    "--interference",
+    help="Place the built parts where they go in the microscope (see openscad/assembly_poses.scad) "
+    "and fail if any that are used together collide. Needs --generate-stl-options-json.",
+    action="store_true",
+)
+parser.add_argument(
+    "--refs",
+    nargs="+",
+    metavar="REF",
+    help="Build these git refs (tags, branches or commits) side by side in builds/refs, "
+    "sharing renders between them, and list the STLs that differ from the first.",
+)
+parser.add_argument(
+    "--variant-report",
+    help="Print how many renders each variant matrix produces instead of building.",
+    action="store_true",
+)
+parser.add_argument(
+    "--what-if",
+    help="With --variant-report, show how many renders adding an axis would cost, e.g. main_body:infill=low,high",
+    action="append",
+    default=[],
+    metavar="[MATRIX:]AXIS=VALUES",
+)
+parser.add_argument(
+    "--backend",
+    help="Where to run openscad: on this machine, or on the workers of a render farm coordinator (see build_system/render_farm.py).",
+    choices=["local", "farm"],
+    default="local",
+)
+parser.add_argument(
+    "--farm-coordinator",
+    help="URL of the render farm coordinator, e.g. http://build-host:8765",
+)
+parser.add_argument(
+    "--csg-backend",
+    help="Geometry engine openscad uses for CSG operations. The faster ones need a recent (development) OpenSCAD.",
+    choices=["cgal", "fast-csg", "manifold"],
+    default="cgal",
+)
+parser.add_argument(
+    "--semantic-cache",
+    help="Export each part's CSG tree first, and only render it if the tree has changed (see build_system/semantic_cache.py).",
+    action="store_true",
+)
+parser.add_argument(
+    "--verify-csg-backend",
+    help="Also render this many randomly chosen outputs (or 'all') with CGAL and fail the build if the meshes from --csg-backend differ.",
+    metavar="N|all",
+)
+parser.add_argument(
+    "--csg-tolerance",
+    help="How far (in mm) the surfaces of a mesh may be from the CGAL reference with --verify-csg-backend.",
+    type=float,
+    default=0.02,
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    help="Number of renders to run at once (passed on to ninja).",
+    type=int,
+)
+parser.add_argument(
+    "--watch",
+    help="Watch openscad/ and re-render the STL files affected by each edit, instead of building everything.",
+    action="store_true",
+)
+parser.add_argument(
+    "--focus",
+    help="With --watch, render outputs matching this pattern (e.g. 'main_body_*.stl') before the others. Can be given more than once.",
+    action="append",
+    default=[],
+)
+parser.add_argument(
+    "--plan",
+    help="List the renders that are out of date and why, with an estimate of how long they will take, instead of building.",
+    action="store_true",
+)
+parser.add_argument(
+    "--preflight",
+    help="Check the parts that need rendering for OpenSCAD errors first, and stop before rendering if there are any.",
+    action="store_true",
+)
+parser.add_argument(
+    "--no-progress",
+    help="Show ninja's output rather than a status line, even in a terminal.",
+    action="store_true",
+)
+parser.add_argument(
+    "--poll",
+    help="With --watch, poll for changes instead of using inotify.",
     action="store_true",
 )
 args = parser.parse_args()
 
+if args.backend == "farm" and not args.farm_coordinator:
+    parser.error("--backend farm needs --farm-coordinator")
+
+if args.interference and not args.generate_stl_options_json:
+    parser.error("--interference needs --generate-stl-options-json")
+
+if args.verify_csg_backend and args.csg_backend == "cgal":
+    parser.error("--verify-csg-backend needs a --csg-backend other than cgal")
+
 # ninja looks at the arguments and would get confused if we didn't remove
 # the `--generate-stl-options-json` and other options
 sys.argv = sys.argv[:1]
+if args.jobs:
+    sys.argv += ["-j", str(args.jobs)]
 
 
 if args.generate_stl_options_json:
-    json_generator = JsonGenerator(build_dir, option_docs, stl_presets, required_stls)
+    json_generator = JsonGenerator(build_dir, option_docs, stl_presets, required_stls, test_stls)
 
+# the input scad file of every output, for --watch
+render_targets = {}
+# the openscad parameters of every output, for --verify-csg-backend
+render_parameters = {}
 
-if sys.platform.startswith("darwin"):
-    executable = "/Applications/OpenSCAD.app/Contents/MacOS/OpenSCAD"
-else:
-    executable = "openscad"
+
+executable = default_executable()
+
+
+# openscad options that select the geometry engine, these changed between
+# OpenSCAD versions so may need updating for the one you have installed
+csg_backend_flags = {
+    "cgal": [],
+    "fast-csg": ["--enable=fast-csg"],
+    "manifold": ["--backend=manifold"],
+}
+
+
+render_log = os.path.join(build_dir, RENDER_LOG)
+
+
+def openscad_command(flags=(), input="$in"):
+    command = " ".join([executable, *flags, f"$parameters {input} -o $out -d $out.d"])
+    if args.backend == "farm":
+        # queue the render on the farm and wait for the stl and depfile to come back.
+        # The submit client logs the time and memory measured on the worker, as
+        # its own would only show how long it waited.
+        return (
+            f"{sys.executable} -m build_system.render_farm submit"
+            f" --coordinator {args.farm_coordinator} --log {render_log} -- {command}"
+        )
+    # log how long each render takes, see build_system/render_history.py
+    return (
+        f"{sys.executable} -m build_system.render_history run"
+        f" --log {render_log} --output $out -- {command}"
+    )
 
 
 ninja.rule(
     "openscad",
-    command=f"{executable} $parameters $in -o $out -d $out.d",
+    command=openscad_command(csg_backend_flags[args.csg_backend]),
     depfile="$out.d",
 )
 
+if args.semantic_cache:
+    semantic_cache_dir = os.path.join(build_dir, ".semantic_cache")
+    # a quick CSG export whose hash only changes if the geometry does, restat
+    # lets ninja skip the render when it hasn't
+    ninja.rule(
+        "csg_key",
+        command=f"{sys.executable} -m build_system.semantic_cache key --output $out"
+        f" --cache-dir {semantic_cache_dir} -- {executable} $parameters $in -o $out.csg -d $out.d",
+        depfile="$out.d",
+        restat=True,
+        description="CSG key $out",
+    )
+    # no depfile, the key covers everything the render depends on
+    ninja.rule(
+        "openscad_cached",
+        command=f"{sys.executable} -m build_system.semantic_cache render --key $in --output $out"
+        f" --cache-dir {semantic_cache_dir} --engine {args.csg_backend}"
+        f" -- {openscad_command(csg_backend_flags[args.csg_backend], input='$scad')}",
+    )
+
+if args.verify_csg_backend:
+    ninja.rule(
+        "openscad_reference",
+        command=openscad_command(),
+        depfile="$out.d",
+    )
+    ninja.rule(
+        "compare_meshes",
+        command=f"{sys.executable} -m build_system.csg_verify $in -o $out --tolerance {args.csg_tolerance}",
+        description="Comparing $in",
+    )
+
+
+def semantic_key(output):
+    """The file with the --semantic-cache key of an output"""
+    return os.path.join(semantic_cache_dir, os.path.basename(output) + ".key")
+
 
-def parameters_to_string(parameters):
+def render(output, input, parameters):
     """
-    Build an OpenScad parameter arguments string from a variable name and value
+    Add the ninja edge(s) that render an stl file.
 
     Arguments:
-        parameters {dict} -- Dictionary of parameters
+        output {str} -- path of the stl file, e.g. builds/feet.stl
+        input {str} -- path of the scad file, e.g. openscad/feet.scad
+        parameters {str} -- openscad parameter arguments, see parameters_to_string
     """
-    strings = []
-    for name in parameters:
-        value = parameters[name]
-        # Convert bools to lowercase
-        if type(value) == bool:
-            value = str(value).lower()
-        # Wrap strings in quotes
-        elif type(value) == str:
-            value = f'"{value}"'
+    render_targets[output] = input
+    render_parameters[output] = parameters
 
-        strings.append("-D '{}={}'".format(name, value))
-
-    return " ".join(strings)
+    if args.semantic_cache:
+        key = semantic_key(output)
+        ninja.build(key, rule="csg_key", inputs=input, variables={"parameters": parameters})
+        ninja.build(
+            output,
+            rule="openscad_cached",
+            inputs=key,
+            variables={"parameters": parameters, "scad": input},
+        )
+    else:
+        ninja.build(
+            output,
+            rule="openscad",
+            inputs=input,
+            variables={"parameters": parameters},
+        )
 
 
 def openscad(
@@ -318,15 +558,12 @@ def openscad(
             select_stl_if=select_stl_if,
         )
 
-    ninja.build(
+    render(
         os.path.join(build_dir, output),
-        rule="openscad",
-        inputs=os.path.join("openscad/", input),
-        variables={
-            "parameters": parameters_to_string(
-                {**parameters, **file_local_parameters, **openscad_only_parameters}
-            )
-        },
+        os.path.join("openscad/", input),
+        parameters_to_string(
+            {**parameters, **file_local_parameters, **openscad_only_parameters}
+        ),
     )
 
 
@@ -355,38 +592,47 @@ microscope_size_options = [
 ]
 
 
+# Every set of variants built, so we can report on them
+variant_matrices = []
+
+
 ###################
 ### MICROSCOPE BODY
 
-for stage_size in stage_size_options:
-    for sample_z in sample_z_options:
-        for beamsplitter in [True, False]:
-            for brim in [True, False]:
-                motors = True  # Right now we never need to remove motor lugs
-
-                output = "main_body_{stage_size}{sample_z}{motors}{beamsplitter}{brim}.stl".format(
-                    stage_size=stage_size,
-                    sample_z=sample_z,
-                    motors="-M" if motors else "",
-                    beamsplitter="-BS" if beamsplitter else "",
-                    brim="_brim" if brim else "",
-                )
-
-                parameters = {
-                    **stage_parameters(stage_size, sample_z),
-                    "motor_lugs": motors,
-                    "enable_smart_brim": brim,
-                }
-                openscad_only = {"beamsplitter": beamsplitter}
-                select_stl_if = {"reflection_illumination": beamsplitter}
-
-                openscad(
-                    output,
-                    "main_body.scad",
-                    parameters,
-                    openscad_only_parameters=openscad_only,
-                    select_stl_if=select_stl_if,
-                )
+main_body_variants = VariantMatrix(
+    "main_body",
+    axes={
+        "stage_size": stage_size_options,
+        "sample_z": sample_z_options,
+        "motors": [True],  # Right now we never need to remove motor lugs
+        "beamsplitter": [True, False],
+        "brim": [True, False],
+    },
+    output="main_body_{stage_size}{sample_z}{motors}{beamsplitter}{brim}.stl",
+    labels={
+        "motors": {True: "-M", False: ""},
+        "beamsplitter": {True: "-BS", False: ""},
+        "brim": {True: "_brim", False: ""},
+    },
+)
+variant_matrices.append(main_body_variants)
+
+for variant in main_body_variants:
+    parameters = {
+        **stage_parameters(variant["stage_size"], variant["sample_z"]),
+        "motor_lugs": variant["motors"],
+        "enable_smart_brim": variant["brim"],
+    }
+    openscad_only = {"beamsplitter": variant["beamsplitter"]}
+    select_stl_if = {"reflection_illumination": variant["beamsplitter"]}
+
+    openscad(
+        main_body_variants.output(variant),
+        "main_body.scad",
+        parameters,
+        openscad_only_parameters=openscad_only,
+        select_stl_if=select_stl_if,
+    )
 
 
 #################
@@ -411,73 +657,90 @@ all_lenses = list(
     set(l for c, l in optics_versions).union({"dashcam_lens", "6ledcam_lens"})
 )
 
-for sample_z in sample_z_options:
-    for (camera, lens) in optics_versions:
-        beamsplitter_options = [True, False] if lens in rms_lenses else [False]
-
-        for beamsplitter in beamsplitter_options:
-            output = "optics_{camera}_{lens}{beamsplitter}.stl".format(
-                camera=camera,
-                lens=lens,
-                beamsplitter="_beamsplitter" if beamsplitter else "",
-            )
-
-            parameters = {"sample_z": sample_z, "optics": lens, "camera": camera}
-            openscad_only = {"beamsplitter": beamsplitter}
-            select_stl_if = {"reflection_illumination": beamsplitter}
-
-            if lens == "pilens":
-                select_stl_if["use_pilens_optics_module"] = True
-
-            if lens not in rms_lenses:
-                select_stl_if["riser"] = "no riser"
-
-            if lens == "rms_infinity_f50d13":
-                select_stl_if["microscope_stand:box_h"] = 45
-            else:
-                select_stl_if["microscope_stand:box_h"] = 30
+optics_variants = VariantMatrix(
+    "optics",
+    axes={
+        "sample_z": sample_z_options,
+        ("camera", "lens"): optics_versions,
+        "beamsplitter": [True, False],
+    },
+    exclude=[
+        # the beamsplitter only works with RMS objectives
+        Exclusion(
+            ("lens", "beamsplitter"),
+            lambda lens, beamsplitter: beamsplitter and lens not in rms_lenses,
+        )
+    ],
+    output="optics_{camera}_{lens}{beamsplitter}.stl",
+    labels={"beamsplitter": {True: "_beamsplitter", False: ""}},
+)
+variant_matrices.append(optics_variants)
+
+for variant in optics_variants:
+    lens = variant["lens"]
+    parameters = {
+        "sample_z": variant["sample_z"],
+        "optics": lens,
+        "camera": variant["camera"],
+    }
+    openscad_only = {"beamsplitter": variant["beamsplitter"]}
+    select_stl_if = {"reflection_illumination": variant["beamsplitter"]}
+
+    if lens == "pilens":
+        select_stl_if["use_pilens_optics_module"] = True
+
+    if lens not in rms_lenses:
+        select_stl_if["riser"] = "no riser"
+
+    if lens == "rms_infinity_f50d13":
+        select_stl_if["microscope_stand:box_h"] = 45
+    else:
+        select_stl_if["microscope_stand:box_h"] = 30
 
-            openscad(
-                output,
-                "optics.scad",
-                parameters,
-                openscad_only_parameters=openscad_only,
-                select_stl_if=select_stl_if,
-            )
+    openscad(
+        optics_variants.output(variant),
+        "optics.scad",
+        parameters,
+        openscad_only_parameters=openscad_only,
+        select_stl_if=select_stl_if,
+    )
 
 
 ####################
 ### MICROSCOPE STAND
 
 # Stand with pi
-for stand_height in [30, 45]:
-    for beamsplitter in [True, False]:
-        output = "microscope_stand_{stand_height}{beamsplitter}.stl".format(
-            stand_height=stand_height, beamsplitter="-BS" if beamsplitter else ""
-        )
+stand_variants = VariantMatrix(
+    "microscope_stand",
+    axes={"stand_height": [30, 45], "beamsplitter": [True, False]},
+    output="microscope_stand_{stand_height}{beamsplitter}.stl",
+    labels={"beamsplitter": {True: "-BS", False: ""}},
+)
+variant_matrices.append(stand_variants)
 
-        openscad_only = {"beamsplitter": beamsplitter}
+for variant in stand_variants:
+    openscad_only = {"beamsplitter": variant["beamsplitter"]}
 
-        if stand_height == 45:
-            compatible_lenses = ["rms_infinity_f50d13"]
-        else:
-            compatible_lenses = [l for l in all_lenses if l != "rms_infinity_f50d13"]
+    if variant["stand_height"] == 45:
+        compatible_lenses = ["rms_infinity_f50d13"]
+    else:
+        compatible_lenses = [l for l in all_lenses if l != "rms_infinity_f50d13"]
 
-        openscad(
-            output,
-            "microscope_stand.scad",
-            openscad_only_parameters=openscad_only,
-            file_local_parameters={"box_h": stand_height},
-            select_stl_if=[
-                {
-                    "pi_in_base": True,
-                    "base": "bucket",
-                    "reflection_illumination": beamsplitter,
-                    "optics": optics,
-                }
-                for optics in compatible_lenses
-            ],
-        )
+    openscad(
+        stand_variants.output(variant),
+        "microscope_stand.scad",
+        openscad_only_parameters=openscad_only,
+        file_local_parameters={"box_h": variant["stand_height"]},
+        select_stl_if=[
+            {
+                "pi_in_base": True,
+                "base": "bucket",
+                "reflection_illumination": variant["beamsplitter"],
+                "optics": optics,
+            }
+            for optics in compatible_lenses
+        ],
+    )
 
 # Stand without pi
 openscad(
@@ -491,13 +754,7 @@ openscad(
 for motor_driver_electronics in ["sangaboard", "arduino_nano"]:
     outputs = f"{build_dir}/motor_driver_case_{motor_driver_electronics}.stl"
     parameters = {"motor_driver_electronics": motor_driver_electronics}
-
-    ninja.build(
-        outputs,
-        rule="openscad",
-        inputs="openscad/motor_driver_case.scad",
-        variables={"parameters": parameters_to_string(parameters)},
-    )
+    render(outputs, "openscad/motor_driver_case.scad", parameters_to_string(parameters))
 
 ########
 ### FEET
@@ -560,51 +817,63 @@ camera_platform_versions = [
     ("dashcam", "dashcam_lens"),
 ]
 
-for stage_size in stage_size_options:
-    for sample_z in sample_z_options:
-        for camera, optics in camera_platform_versions:
-            output = f"camera_platform_{camera}_{stage_size}{sample_z}.stl"
+camera_platform_variants = VariantMatrix(
+    "camera_platform",
+    axes={
+        "stage_size": stage_size_options,
+        "sample_z": sample_z_options,
+        ("camera", "optics"): camera_platform_versions,
+    },
+    output="camera_platform_{camera}_{stage_size}{sample_z}.stl",
+)
+variant_matrices.append(camera_platform_variants)
 
-            parameters = {
-                **stage_parameters(stage_size, sample_z),
-                "camera": camera,
-            }
+for variant in camera_platform_variants:
+    parameters = {
+        **stage_parameters(variant["stage_size"], variant["sample_z"]),
+        "camera": variant["camera"],
+    }
 
-            select_stl_if = {
-                "riser": "no riser",
-                "optics": optics,
-            }
+    select_stl_if = {
+        "riser": "no riser",
+        "optics": variant["optics"],
+    }
 
-            openscad(
-                output,
-                "camera_platform.scad",
-                parameters=parameters,
-                select_stl_if=select_stl_if
-            )
+    openscad(
+        camera_platform_variants.output(variant),
+        "camera_platform.scad",
+        parameters=parameters,
+        select_stl_if=select_stl_if
+    )
 
 
 ###############
 ### LENS SPACER
 
-for stage_size in stage_size_options:
-    for sample_z in sample_z_options:
-        output = "lens_spacer_picamera_2_pilens_{stage_size}{sample_z}.stl".format(
-            stage_size=stage_size, sample_z=sample_z
-        )
+lens_spacer_variants = VariantMatrix(
+    "lens_spacer",
+    axes={"stage_size": stage_size_options, "sample_z": sample_z_options},
+    output="lens_spacer_picamera_2_pilens_{stage_size}{sample_z}.stl",
+)
+variant_matrices.append(lens_spacer_variants)
 
-        parameters = {**stage_parameters(stage_size, sample_z), "optics": "pilens"}
+for variant in lens_spacer_variants:
+    parameters = {
+        **stage_parameters(variant["stage_size"], variant["sample_z"]),
+        "optics": "pilens",
+    }
 
-        openscad(
-            output,
-            "lens_spacer.scad",
-            parameters,
-            select_stl_if={
-                "camera": "picamera_2",
-                "reflection_illumination": False,
-                "use_pilens_optics_module": False,
-                "riser": "no riser",
-            },
-        )
+    openscad(
+        lens_spacer_variants.output(variant),
+        "lens_spacer.scad",
+        parameters,
+        select_stl_if={
+            "camera": "picamera_2",
+            "reflection_illumination": False,
+            "use_pilens_optics_module": False,
+            "riser": "no riser",
+        },
+    )
 
 
 ##################
@@ -707,17 +976,15 @@ openscad(
 
 ### prebuilt STL files from openflexure-microscope-extra
 
+extra_files = []
 if args.include_extra_files:
-    ninja.rule("copy", command="cp $in $out")
 
     def copy_stl(stl_file, select_stl_if=None):
         if args.generate_stl_options_json:
             json_generator.register(
                 output=stl_file, input=stl_file, select_stl_if=select_stl_if
             )
-        output = os.path.join(build_dir, stl_file)
-        input = os.path.join("openflexure-microscope-extra", stl_file)
-        ninja.build(output, rule="copy", inputs=input)
+        extra_files.append(stl_file)
 
     for camera in ["6ledcam", "dashcam"]:
         copy_stl(
@@ -738,12 +1005,206 @@ if args.include_extra_files:
     )
 
 
+# every stl file the build makes, relative to the build folder
+stl_files = [os.path.relpath(o, build_dir) for o in render_targets] + extra_files
+
+
+### preview meshes for the web STL selector
+
+# triangle budgets of the previews, the smallest is loaded first
+preview_budgets = [2000, 20000]
+preview_dir = os.path.join(build_dir, "previews")
+# the previews of each stl file, relative to the build folder
+previews = {}
+
+if args.previews:
+    ninja.rule(
+        "preview",
+        command=f"{sys.executable} -m build_system.preview $in --output-dir {preview_dir}"
+        f" --budgets {' '.join(str(b) for b in preview_budgets)}",
+        description="Preview $in",
+    )
+    for stl_file in stl_files:
+        outputs = [preview_path(preview_dir, stl_file, b) for b in sorted(preview_budgets)]
+        ninja.build(outputs, rule="preview", inputs=os.path.join(build_dir, stl_file))
+        previews[stl_file] = [os.path.relpath(o, build_dir) for o in outputs]
+
+
+### printability checks
+
+# limits on the metrics in build_system/printability.py, by stl file name.
+# Every pattern that matches a file applies, later ones overriding earlier ones.
+printability_limits = {
+    # thinner than this can't be printed with a 0.4mm nozzle
+    "*": {"min_wall": 0.3},
+}
+printability_dir = os.path.join(build_dir, ".printability")
+# the printability metrics of each stl file, relative to the build folder
+printability_files = {}
+
+if args.printability:
+    ninja.rule(
+        "printability",
+        command=f"{sys.executable} -m build_system.printability $in -o $out $limits",
+        description="Check printability of $in",
+    )
+    for stl_file in stl_files:
+        limits = {}
+        for pattern, values in printability_limits.items():
+            if fnmatch(stl_file, pattern):
+                limits.update(values)
+        output = os.path.join(printability_dir, stl_file + ".json")
+        ninja.build(
+            output,
+            rule="printability",
+            inputs=os.path.join(build_dir, stl_file),
+            variables={"limits": limit_arguments(limits)},
+        )
+        printability_files[stl_file] = os.path.relpath(output, build_dir)
+
+
+### check the fast CSG backend against CGAL
+
+if args.verify_csg_backend:
+    outputs = sorted(render_targets)
+    if args.verify_csg_backend != "all":
+        # the same sample every time, so the reference renders stay cached
+        sample_size = min(int(args.verify_csg_backend), len(outputs))
+        outputs = sorted(random.Random(0).sample(outputs, sample_size))
+
+    # the leading dot keeps these out of the manifest and the zip files
+    reference_dir = os.path.join(build_dir, ".csg_reference")
+    for output in outputs:
+        reference = os.path.join(reference_dir, os.path.basename(output))
+        ninja.build(
+            reference,
+            rule="openscad_reference",
+            inputs=render_targets[output],
+            variables={"parameters": render_parameters[output]},
+        )
+        ninja.build(
+            os.path.splitext(reference)[0] + ".json",
+            rule="compare_meshes",
+            inputs=[output, reference],
+        )
+
+
 ###############
 ### RUN BUILD
 
 build_file.close()
 
+if args.refs:
+    # each ref is built with its own build.py, this tree's build.ninja isn't used
+    sys.exit(build_refs(args.refs, args.jobs))
+
+if args.variant_report:
+    extra_axes = dict(parse_axis_argument(a) for a in args.what_if)
+    print(variant_report(variant_matrices, extra_axes))
+    sys.exit(0)
+
+ninja_command = [os.path.join(NINJA_BIN_DIR, "ninja")] + sys.argv[1:]
+build_settings = f"{args.backend}/{args.csg_backend}"
+
+if args.watch:
+    watch(render_targets, ninja_command, focus=args.focus, polling=args.poll)
+    sys.exit(0)
+
+if args.plan or args.preflight or (sys.stdout.isatty() and not args.no_progress):
+    reasons, edges = explain_build(ninja_command)
+    typical = typical_durations(read_records(HISTORY_FILE), build_settings)
+
+if args.plan:
+    print(plan_report(reasons, edges, render_targets, typical, args.jobs or default_jobs()))
+    sys.exit(0)
+
+if args.preflight:
+    # only the parts that are about to be rendered, so all of them on a fresh build
+    out_of_date = {
+        o: i
+        for o, i in render_targets.items()
+        if o in reasons or (args.semantic_cache and semantic_key(o) in reasons)
+    }
+    ok, report = preflight(executable, out_of_date, render_parameters, args.jobs)
+    print(report)
+    if not ok:
+        sys.exit("Preflight found errors, not rendering anything.")
+
+# link the extra files into builds/ rather than copying them, and leave any
+# that are already up to date alone. Not before here, so the dry runs above
+# leave the build folder as it is.
+for stl_file in extra_files:
+    result = import_file(
+        os.path.join("openflexure-microscope-extra", stl_file),
+        os.path.join(build_dir, stl_file),
+    )
+    print(f"{stl_file}: {result}")
+
+# start a fresh render log, so it only has the renders of this build
+os.makedirs(build_dir, exist_ok=True)
+open(render_log, "w").close()
+
+if sys.stdout.isatty() and not args.no_progress:
+    # a status line with an estimate of the time left, rather than ninja's output
+    estimates, _ = estimate_durations([o for o in reasons if o in render_targets], typical)
+    status = run_with_progress(
+        ninja_command, render_log, estimates, args.jobs or default_jobs(), total=edges
+    )
+    if status:
+        sys.exit(status)
+else:
+    try:
+        run_build()
+    except SystemExit as e:
+        if e.code:
+            raise
+
+# keep the render times of this commit, for `python3 -m build_system.render_history check`
+record_build(render_log, HISTORY_FILE, settings=build_settings)
+
+if args.thumbnails:
+    # drawn here rather than by ninja, as they are cached by geometry rather than by file
+    drawn = make_thumbnails(
+        [os.path.join(build_dir, f) for f in stl_files],
+        os.path.join(build_dir, "thumbnails"),
+        jobs=args.jobs,
+    )
+    thumbnails = {
+        os.path.relpath(stl_file, build_dir): {
+            view: os.path.relpath(path, build_dir) for view, path in views.items()
+        }
+        for stl_file, views in drawn.items()
+    }
+
+if args.print_estimates:
+    # like thumbnails, cached by geometry rather than by file
+    estimated = estimate_prints(
+        [os.path.join(build_dir, f) for f in stl_files],
+        {"layer_height": args.layer_height},
+        jobs=args.jobs,
+    )
+    print_estimates = {
+        os.path.relpath(stl_file, build_dir): estimate for stl_file, estimate in estimated.items()
+    }
+
+# record a content hash of everything built, so deploys only upload what changed
+manifest_path = write_manifest(build_dir)
+
 if args.generate_stl_options_json:
-    json_generator.write()
+    json_generator.write(
+        manifest=load_manifest(manifest_path),
+        previews=previews if args.previews else None,
+        printability=printability_files if args.printability else None,
+        thumbnails=thumbnails if args.thumbnails else None,
+        print_estimates=print_estimates if args.print_estimates else None,
+    )
+    # stl_options.json has just changed, so update its manifest entry
+    write_manifest(build_dir)
+
+print(f"generated {manifest_path}")
 
-run_build()
+if args.interference:
+    ok, report = check_assembly(build_dir, executable, jobs=args.jobs)
+    print(report)
+    if not ok:
+        sys.exit("Some parts collide in the assembled microscope.")
@@ -1,75 +1,531 @@
 # Copy the documentation files to a folder, allowing for some processing.
 from __future__ import print_function
+import argparse
+import gzip
+import hashlib
+import json
 import os
 import sys
 import shutil
 import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Matches every image reference on a line, e.g. ``./images/foo.jpg`` or
+# ``../../images/sub/bar.PNG``, capturing the path relative to ``images/``
+IMAGE_PATTERN = re.compile(r"images/([^.()\s\"'<>]*\.(?:jpeg|jpg|JPG|JPEG|png|PNG))")
+# Matches an STL file name written as code, e.g. ``back_foot.stl``
+STL_PATTERN = re.compile(r"``([\w\-]+\.stl)``")
+# Matches the marker of a list item, up to where its content starts
+LIST_ITEM_PATTERN = re.compile(r"^\s*(?:[*+-]|\d+[.)])\s+")
+# The view of the thumbnails drawn by build.py --thumbnails shown in the docs
+THUMBNAIL_VIEW = "iso"
+
+# The search index, written next to index.html
+SEARCH_INDEX = "search_index.json.gz"
+# Bump this when the index format or the tokeniser changes, so cached pages are redone
+SEARCH_INDEX_VERSION = 2
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Markdown syntax that isn't text: link and image targets, HTML tags
+LINK_TARGET_PATTERN = re.compile(r"\]\([^)]*\)")
+TAG_PATTERN = re.compile(r"<[^>]*>")
+# Characters docsify removes when it turns a heading into an anchor
+ANCHOR_REMOVED_PATTERN = re.compile(r"[\u2000-\u206F\u2E00-\u2E7F\\'!\"#$%&()*+,./:;<=>?@\[\]^`{|}~]")
+STOP_WORDS = set(
+    "a an and are as at be but by can for from if in into is it its of on or so that the"
+    " then there these this to was will with you your".split()
+)
+
 
 def insert_markdown(infile, outfile):
     """Insert content into the target markdown file"""
     pass
 
-def process_markdown(infile, outfile):
+def add_thumbnails(content, outfile, thumbnails):
+    """
+    Show a thumbnail after the first line that mentions each STL file that
+    has one. thumbnails maps STL file names to thumbnail paths. In a list,
+    the thumbnail is indented to be part of the item, so the list isn't
+    split in two.
+    """
+    lines = []
+    shown = set()
+    for line in content.split("\n"):
+        lines.append(line)
+        item = LIST_ITEM_PATTERN.match(line)
+        indent = " " * len(item.group(0)) if item else ""
+        for stl in STL_PATTERN.findall(line):
+            if stl in thumbnails and stl not in shown:
+                shown.add(stl)
+                path = os.path.relpath(thumbnails[stl], os.path.dirname(outfile))
+                lines.append(f"\n{indent}![{stl}]({path.replace(os.sep, '/')})\n")
+    return "\n".join(lines)
+
+
+def process_markdown(infile, outfile, quiet=False, thumbnails=None):
     """Process and copy a markdown file, and scan for images used in the file"""
     images = set()
     with open(infile, 'r', encoding='utf8') as input_file, open(outfile, 'w', encoding='utf8') as output_file:
-        print(f"Opened {infile}...")
+        if not quiet:
+            print(f"Opened {infile}...")
 
         # Inject extra markdown only if the file isn't special
         if (os.path.basename(infile)[0] != "_"):
             insert_markdown(infile=infile, outfile=outfile)
-        else:
+        elif not quiet:
             print(f"File {infile} is special. Copying without modification.")
 
-        # Copy the basic markdown content into the new file, and find images
-        for line in input_file:
-            # Copy over the line
-            output_file.write(line) # copy over the file
-            # Search for images
-            m = re.search(r"images/([^.]*\.(jpeg|jpg|JPG|JPEG|png|PNG))", line)
-            if m:
-                images.add(m.group(1))
+        # Copy the markdown content into the new file, and find all images
+        content = input_file.read()
+        if thumbnails:
+            content = add_thumbnails(content, outfile, thumbnails)
+        output_file.write(content)
+        images.update(IMAGE_PATTERN.findall(content))
     return images
 
 
-if __name__ == "__main__":
-    # Find all relevant directories
-    here = os.path.dirname(os.path.realpath(__file__))
-    docs_dir = os.path.abspath(os.path.join(here, "docs"))
-    parts_dir = os.path.abspath(os.path.join(docs_dir, "parts"))
-    build_dir = os.path.abspath(os.path.join(here, "builds"))
-    output_dir = os.path.abspath(os.path.join(build_dir, "docs"))
+def find_markdown(docs_dir):
+    """
+    Recursively find all markdown files below docs_dir, returning their paths
+    relative to docs_dir in a stable order. The images folders are skipped.
+    """
+    markdown_files = []
+    for root, dirs, files in os.walk(docs_dir):
+        dirs[:] = sorted(d for d in dirs if d not in ("images", "original_images"))
+        for f in sorted(files):
+            if f.endswith(".md"):
+                markdown_files.append(os.path.relpath(os.path.join(root, f), docs_dir))
+    return markdown_files
 
-    if not os.path.isdir(build_dir):
-        os.mkdir(build_dir)
 
+def process_all_markdown(docs_dir, output_dir, jobs=None, quiet=False, thumbnails=None):
+    """
+    Process every markdown file below docs_dir concurrently, mirroring the
+    folder structure into output_dir.
+
+    Returns a dict mapping each referenced image to the set of markdown files
+    (relative to docs_dir) that use it.
+    """
+    markdown_files = find_markdown(docs_dir)
+    for d in sorted(set(os.path.dirname(f) for f in markdown_files)):
+        os.makedirs(os.path.join(output_dir, d), exist_ok=True)
+
+    def process(f):
+        return f, process_markdown(
+            os.path.join(docs_dir, f), os.path.join(output_dir, f), quiet=quiet, thumbnails=thumbnails
+        )
+
+    references = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for f, f_images in executor.map(process, markdown_files):
+            for image in f_images:
+                references.setdefault(image, set()).add(f)
+    return references
+
+
+def missing_images(references, images_dir):
+    """Return the referenced images that don't exist, with the files using them"""
+    return {
+        image: users
+        for image, users in references.items()
+        if not os.path.isfile(os.path.join(images_dir, image))
+    }
+
+
+def format_missing_images(missing):
+    """Build a single error report listing every missing image"""
+    lines = [f"{len(missing)} image(s) referenced in the documentation could not be found:"]
+    for image in sorted(missing):
+        lines.append(f"  images/{image}, used in: {', '.join(sorted(missing[image]))}")
+    return "\n".join(lines)
+
+
+def copy_thumbnails(thumbnails_dir, output_dir):
+    """
+    Copy the thumbnails of STL files into the docs, returning a dict of the
+    copy of each STL's thumbnail.
+    """
+    suffix = f".{THUMBNAIL_VIEW}.png"
+    copied = {}
+    if not os.path.isdir(thumbnails_dir):
+        return copied
+    os.makedirs(os.path.join(output_dir, "thumbnails"), exist_ok=True)
+    for f in sorted(os.listdir(thumbnails_dir)):
+        if f.endswith(suffix):
+            path = os.path.join(output_dir, "thumbnails", f)
+            shutil.copyfile(os.path.join(thumbnails_dir, f), path)
+            copied[f[: -len(suffix)] + ".stl"] = path
+    return copied
+
+
+def build_docs(
+    docs_dir, output_dir, jobs=None, quiet=False, thumbnails_dir=None, search_cache=None
+):
+    """
+    Build the documentation from docs_dir into output_dir. If thumbnails_dir
+    is given, thumbnails drawn by build.py --thumbnails are shown where STL
+    files are mentioned. The search index is only updated for pages that
+    changed since search_cache was written, if it is given.
+    """
     # Delete the output directory if it exists
     if os.path.isdir(output_dir):
         shutil.rmtree(output_dir)
 
     # Create the output directory and the folder structure
-    os.mkdir(output_dir)
-    os.mkdir(os.path.join(output_dir, "parts"))
-
-    for f in os.listdir(parts_dir):
-        if os.path.isdir(os.path.join(parts_dir, f)):
-            os.mkdir(os.path.join(output_dir, "parts", f))
-    os.mkdir(os.path.join(output_dir, "images"))
+    os.makedirs(os.path.join(output_dir, "images"))
 
     # Copy our docsify index page
     shutil.copyfile(os.path.join(docs_dir, "index.html"), os.path.join(output_dir, "index.html"))
 
-    # Create a set to note our used image files
-    images = set()
-    # TODO: This should be recursive or something - but for now, I just enumerate the parts directory
-    for input_dir in ['.', 'parts'] + [os.path.join('parts', d) for d in os.listdir(parts_dir) if os.path.isdir(os.path.join(parts_dir, d))]:
-        input_dir_abs = os.path.join(docs_dir, input_dir)
-        for f in os.listdir(os.path.join(docs_dir, input_dir)):
-            if f.endswith(".md"):
-                f_images = process_markdown(os.path.join(input_dir_abs, f), os.path.join(output_dir, input_dir, f))
-                images.update(f_images)
+    thumbnails = copy_thumbnails(thumbnails_dir, output_dir) if thumbnails_dir else None
+    references = process_all_markdown(
+        docs_dir, output_dir, jobs=jobs, quiet=quiet, thumbnails=thumbnails
+    )
+
+    # Check every image exists before copying any of them
+    images_dir = os.path.join(docs_dir, "images")
+    missing = missing_images(references, images_dir)
+    if missing:
+        raise FileNotFoundError(format_missing_images(missing))
 
     # Copy over only the images that are actually used
-    for f in images:
-        shutil.copyfile(os.path.join(docs_dir, "images", f), os.path.join(output_dir, "images", f))
+    for f in references:
+        os.makedirs(os.path.dirname(os.path.join(output_dir, "images", f)), exist_ok=True)
+        shutil.copyfile(os.path.join(images_dir, f), os.path.join(output_dir, "images", f))
+
+    reindexed = build_search_index(output_dir, find_markdown(output_dir), search_cache)
+    if not quiet:
+        print(f"Updated the search index for {reindexed} page(s)")
+
+    return references
+
+
+def _is_consonant(word, i):
+    if word[i] in "aeiou":
+        return False
+    if word[i] == "y":
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+
+def _measure(stem):
+    # the number of vowel-consonant sequences, m in the Porter stemmer
+    forms = "".join("c" if _is_consonant(stem, i) else "v" for i in range(len(stem)))
+    return len(re.findall("v+c+", forms))
+
+
+def _has_vowel(stem):
+    return any(not _is_consonant(stem, i) for i in range(len(stem)))
+
+
+def _ends_cvc(stem):
+    # consonant-vowel-consonant, the last not w, x or y, as in "hop"
+    return (
+        len(stem) >= 3
+        and _is_consonant(stem, len(stem) - 3)
+        and not _is_consonant(stem, len(stem) - 2)
+        and _is_consonant(stem, len(stem) - 1)
+        and stem[-1] not in "wxy"
+    )
+
+
+def stem(word):
+    """
+    Steps 1 and 5a of the Porter stemmer, which take off plurals and -ed,
+    -ing and -e, so e.g. "clips", "clipping" and "clipped" match.
+    """
+    if len(word) <= 2 or word.isdigit():
+        return word
+    # step 1a, plurals
+    if word.endswith("sses") or word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    # step 1b, -ed and -ing
+    if word.endswith("eed"):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ("ed", "ing"):
+            if word.endswith(suffix) and _has_vowel(word[: -len(suffix)]):
+                word = word[: -len(suffix)]
+                if word.endswith(("at", "bl", "iz")):
+                    word += "e"
+                elif len(word) > 1 and word[-1] == word[-2] and _is_consonant(word, len(word) - 1):
+                    if word[-1] not in "lsz":
+                        word = word[:-1]
+                elif _measure(word) == 1 and _ends_cvc(word):
+                    word += "e"
+                break
+    # step 1c, y to i
+    if word.endswith("y") and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+    # step 5a, a final e
+    if word.endswith("e"):
+        m = _measure(word[:-1])
+        if m > 1 or (m == 1 and not _ends_cvc(word[:-1])):
+            word = word[:-1]
+    return word
+
+
+def tokenise(text):
+    """The stemmed search terms in some markdown text"""
+    text = TAG_PATTERN.sub(" ", LINK_TARGET_PATTERN.sub("]", text.lower()))
+    return [stem(w) for w in WORD_PATTERN.findall(text) if w not in STOP_WORDS]
+
+
+def docsify_anchor(heading, used):
+    """
+    The id docsify gives a heading, which needs to be unique on its page.
+
+    Arguments:
+        heading {str} -- the heading text
+        used {dict} -- how many times each id has been used on the page so far
+    """
+    anchor = ANCHOR_REMOVED_PATTERN.sub("", TAG_PATTERN.sub("", heading.strip().lower()))
+    anchor = re.sub(r"\s", "-", anchor)
+    anchor = re.sub(r"-+", "-", anchor)
+    # an id can't start with a digit
+    anchor = re.sub(r"^(\d)", r"_\1", anchor)
+    count = used.get(anchor, 0)
+    used[anchor] = count + 1
+    return anchor if count == 0 else f"{anchor}-{count}"
+
+
+def index_page(content):
+    """
+    Split a markdown page into sections at its headings, and count the
+    search terms in each. Words in a heading count three times.
+
+    Returns a list of [anchor, title, {term: count}].
+    """
+    sections = []
+    used = {}
+    current = ["", "", {}]
+    in_code = False
+
+    def add(text, weight=1):
+        for term in tokenise(text):
+            current[2][term] = current[2].get(term, 0) + weight
+
+    for line in content.split("\n"):
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+            continue
+        match = None if in_code else HEADING_PATTERN.match(line)
+        if match:
+            if current[2] or current[1]:
+                sections.append(current)
+            title = match.group(2)
+            current = [docsify_anchor(title, used), title, {}]
+            add(title, weight=3)
+        else:
+            add(line)
+    if current[2] or current[1]:
+        sections.append(current)
+    return sections
+
+
+def build_search_index(output_dir, markdown_files, cache_path=None):
+    """
+    Write an inverted index of the processed markdown to output_dir, as
+    gzipped JSON:
+
+        {"version": 1,
+         "sections": [[page, anchor, title], ...],
+         "terms": {term: [section, count, section, count, ...], ...}}
+
+    where a page links to ``#/<page>?id=<anchor>``. Only pages that have
+    changed since the cache at cache_path was written are read again.
+
+    Returns the number of pages that were (re)indexed.
+    """
+    cache = {}
+    if cache_path and os.path.isfile(cache_path):
+        with open(cache_path, encoding="utf8") as f:
+            cache = json.load(f)
+        if cache.get("version") != SEARCH_INDEX_VERSION:
+            cache = {}
+    cached_pages = cache.get("pages", {})
+
+    pages = {}
+    reindexed = 0
+    for f in markdown_files:
+        if os.path.basename(f).startswith("_"):
+            continue
+        with open(os.path.join(output_dir, f), encoding="utf8") as md:
+            content = md.read()
+        digest = hashlib.sha256(content.encode("utf8")).hexdigest()
+        page = cached_pages.get(f)
+        if page is None or page["sha256"] != digest:
+            page = {"sha256": digest, "sections": index_page(content)}
+            reindexed += 1
+        pages[f] = page
+
+    sections = []
+    terms = {}
+    for f in sorted(pages):
+        name = os.path.splitext(f)[0].replace(os.sep, "/")
+        for anchor, title, counts in pages[f]["sections"]:
+            for term, count in counts.items():
+                terms.setdefault(term, []).extend([len(sections), count])
+            sections.append([name, anchor, title])
+
+    index = {"version": SEARCH_INDEX_VERSION, "sections": sections, "terms": terms}
+    data = json.dumps(index, separators=(",", ":"), sort_keys=True).encode("utf8")
+    # mtime=0 so the same docs always give the same bytes
+    with open(os.path.join(output_dir, SEARCH_INDEX), "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as compressed:
+            compressed.write(data)
+
+    if cache_path:
+        with open(cache_path, "w", encoding="utf8") as f:
+            json.dump({"version": SEARCH_INDEX_VERSION, "pages": pages}, f)
+    return reindexed
+
+
+def _expect(value, expected, what):
+    # not assert, so the checks still run under python -O
+    if value != expected:
+        raise AssertionError(f"{what}: expected {expected!r}, got {value!r}")
+
+
+def self_test():
+    """Check the stemmer, anchors, thumbnails and search index cache, raising AssertionError if wrong"""
+    for words in [
+        ("assembly", "assemblies"),
+        ("supply", "supplies"),
+        ("use", "used", "using", "uses"),
+        ("clip", "clips", "clipping", "clipped"),
+    ]:
+        _expect([stem(w) for w in words], [stem(words[0])] * len(words), "stems")
+    for heading, anchor in [
+        ("OpenFlexure Microscope - Assembly Instructions", "openflexure-microscope-assembly-instructions"),
+        ("60 Ohm resistor", "_60-ohm-resistor"),
+    ]:
+        _expect(docsify_anchor(heading, {}), anchor, f"anchor of {heading!r}")
+    used = {}
+    _expect([docsify_anchor("Step", used) for _ in range(3)], ["step", "step-1", "step-2"], "repeated anchors")
+    thumbnails = {"feet.stl": os.path.join("out", "thumbnails", "feet.png")}
+    _expect(
+        add_thumbnails("* 3 feet: ``feet.stl``\n* gears", os.path.join("out", "page.md"), thumbnails),
+        "* 3 feet: ``feet.stl``\n\n  ![feet.stl](thumbnails/feet.png)\n\n* gears",
+        "thumbnail in a list item",
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = os.path.join(tmp, "cache.json")
+        pages = {"a.md": "# Feet\n\nAttach the feet.\n", "sub/b.md": "# Optics\n\nInsert the lens.\n"}
+
+        def write(name, content):
+            os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+            with open(os.path.join(tmp, name), "w", encoding="utf8") as f:
+                f.write(content)
+
+        def index():
+            with gzip.open(os.path.join(tmp, SEARCH_INDEX), "rt", encoding="utf8") as f:
+                return json.load(f)
+
+        for name, content in pages.items():
+            write(name, content)
+        _expect(build_search_index(tmp, sorted(pages), cache), 2, "pages indexed without a cache")
+        first = index()
+        _expect(build_search_index(tmp, sorted(pages), cache), 0, "pages indexed with nothing changed")
+        _expect(index(), first, "index rebuilt from the cache")
+        write("sub/b.md", "# Optics\n\nInsert the camera.\n")
+        _expect(build_search_index(tmp, sorted(pages), cache), 1, "pages indexed after one changed")
+        terms = index()["terms"]
+        _expect(stem("camera") in terms and stem("lens") not in terms, True, "terms of the changed page")
+        _expect(terms.get(stem("feet")), first["terms"][stem("feet")], "terms of the unchanged page")
+
+
+def make_synthetic_docs(docs_dir, target_dir, scale):
+    """
+    Make a docs tree `scale` times larger than docs_dir, by copying all the
+    markdown into nested subfolders. Images are created as empty files.
+    """
+    markdown_files = find_markdown(docs_dir)
+    shutil.copyfile(os.path.join(docs_dir, "index.html"), os.path.join(target_dir, "index.html"))
+    for i in range(scale):
+        copy_dir = "." if i == 0 else os.path.join(*["copy_{}".format(j) for j in range(i)])
+        for f in markdown_files:
+            target = os.path.join(target_dir, copy_dir, f)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(docs_dir, f), target)
+
+    os.mkdir(os.path.join(target_dir, "images"))
+    for f in markdown_files:
+        with open(os.path.join(docs_dir, f), encoding='utf8') as md:
+            for image in IMAGE_PATTERN.findall(md.read()):
+                path = os.path.join(target_dir, "images", image)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "w").close()
+
+
+def benchmark(docs_dir, scale, repeats=5):
+    """Time the docs build on a synthetic docs tree, serially and concurrently"""
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic_dir = os.path.join(tmp, "docs")
+        os.mkdir(synthetic_dir)
+        make_synthetic_docs(docs_dir, synthetic_dir, scale)
+        n_files = len(find_markdown(synthetic_dir))
+        print(f"Synthetic docs tree: {n_files} markdown files ({scale}x)")
+
+        for jobs in [1, None]:
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                build_docs(synthetic_dir, os.path.join(tmp, "output"), jobs=jobs, quiet=True)
+                timings.append(time.perf_counter() - start)
+            label = "serial" if jobs == 1 else "concurrent"
+            print(f"{label}: best {min(timings) * 1000:.1f} ms of {repeats} runs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the OpenFlexure Microscope documentation.")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="Number of markdown files to process at once.")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="SCALE",
+        help="Instead of building, time the build on a synthetic docs tree SCALE times larger than docs/.",
+    )
+    parser.add_argument(
+        "--self-test",
+        action="store_true",
+        help="Check the search tokeniser, anchors, thumbnails and index cache, instead of building.",
+    )
+    args = parser.parse_args()
+
+    if args.self_test:
+        self_test()
+        print("build_docs self test passed")
+        sys.exit(0)
+
+    # Find all relevant directories
+    here = os.path.dirname(os.path.realpath(__file__))
+    docs_dir = os.path.abspath(os.path.join(here, "docs"))
+    build_dir = os.path.abspath(os.path.join(here, "builds"))
+    output_dir = os.path.abspath(os.path.join(build_dir, "docs"))
+
+    if args.benchmark:
+        benchmark(docs_dir, args.benchmark)
+        sys.exit(0)
+
+    if not os.path.isdir(build_dir):
+        os.mkdir(build_dir)
 
+    try:
+        build_docs(
+            docs_dir,
+            output_dir,
+            jobs=args.jobs,
+            thumbnails_dir=os.path.join(build_dir, "thumbnails"),
+            # outside output_dir, which is deleted on every build
+            search_cache=os.path.join(build_dir, ".docs_search_cache.json"),
+        )
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
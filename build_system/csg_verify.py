@@ -0,0 +1,103 @@
+"""
+Check that a mesh rendered with a fast CSG backend matches a reference
+render made with CGAL.
+
+    python3 -m build_system.csg_verify builds/main_body_LS65-M.stl \\
+        builds/.csg_reference/main_body_LS65-M.stl -o result.json --tolerance 0.02
+
+The meshes are compared by volume, bounding box, and the distance from
+points sampled on each surface to the other surface. The result is written
+to the output file only if they agree, so ninja fails the build otherwise.
+"""
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from .geometry import BoxGrid, sample_surface
+from .stl import mesh_volume, read_stl
+
+def surface_distance(source, target, tolerance, n_samples=2000):
+    """
+    Largest distance from points sampled on source to the surface of target,
+    or inf if any point is further than a few times the tolerance away.
+    """
+    points = sample_surface(source, n_samples)
+    if len(points) == 0 or len(target) == 0:
+        return 0.0 if len(points) == len(target) == 0 else float("inf")
+    # cells a few triangles across, as in interference._paired, so the big
+    # flat faces of CAD meshes are filed under a few cells, not searched for
+    # every point
+    edges = np.linalg.norm(target - np.roll(target, 1, axis=1), axis=2).max(axis=1)
+    cell_size = max(4 * tolerance, 2 * float(np.median(edges)))
+    grid = BoxGrid(target, cell_size)
+    return float(grid.nearest_distance(points, 4 * tolerance).max())
+
+
+def compare_meshes(mesh, reference, tolerance, volume_tolerance=1e-3, n_samples=2000):
+    """
+    Compare a mesh with a reference render of the same part.
+
+    Returns (ok, metrics).
+
+    Arguments:
+        mesh {ndarray} -- (n, 3, 3) triangles of the mesh to check
+        reference {ndarray} -- (m, 3, 3) triangles of the reference mesh
+        tolerance {float} -- largest acceptable distance between the surfaces (mm)
+        volume_tolerance {float} -- largest acceptable relative difference in volume
+        n_samples {int} -- points sampled on each surface
+    """
+    volume = mesh_volume(mesh)
+    reference_volume = mesh_volume(reference)
+    volume_error = abs(volume - reference_volume) / max(abs(reference_volume), 1e-9)
+
+    def bbox(t):
+        points = t.reshape(-1, 3)
+        return np.concatenate([points.min(axis=0), points.max(axis=0)])
+
+    if len(mesh) and len(reference):
+        bbox_error = float(np.abs(bbox(mesh) - bbox(reference)).max())
+    else:
+        bbox_error = 0.0 if len(mesh) == len(reference) else float("inf")
+
+    distance = max(
+        surface_distance(mesh, reference, tolerance, n_samples),
+        surface_distance(reference, mesh, tolerance, n_samples),
+    )
+    metrics = {
+        "volume": volume,
+        "reference_volume": reference_volume,
+        "volume_error": volume_error,
+        "bbox_error": bbox_error,
+        "surface_distance": distance,
+        "tolerance": tolerance,
+        "volume_tolerance": volume_tolerance,
+    }
+    ok = volume_error <= volume_tolerance and bbox_error <= tolerance and distance <= tolerance
+    return ok, metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a mesh with a reference render.")
+    parser.add_argument("mesh", help="STL rendered with the fast backend.")
+    parser.add_argument("reference", help="STL rendered with CGAL.")
+    parser.add_argument("-o", "--output", required=True, help="JSON file written if they agree.")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Distance tolerance in mm.")
+    parser.add_argument(
+        "--volume-tolerance", type=float, default=1e-3, help="Relative volume tolerance."
+    )
+    args = parser.parse_args()
+
+    ok, metrics = compare_meshes(
+        read_stl(args.mesh), read_stl(args.reference), args.tolerance, args.volume_tolerance
+    )
+    if not ok:
+        print(
+            f"{args.mesh} doesn't match the CGAL render {args.reference}: "
+            + json.dumps(metrics, indent=2),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    with open(args.output, "w") as f:
+        json.dump(metrics, f, indent=2, default=str)
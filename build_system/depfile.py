@@ -0,0 +1,72 @@
+import os
+
+
+def parse_depfile(text):
+    """
+    Parse a Makefile-style dependency file, as written by `openscad -d`.
+
+    Returns (target, dependencies).
+
+    Arguments:
+        text {str} -- content of the depfile
+    """
+    # join continuation lines, keeping escaped spaces in file names
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+    target, _, rest = text.partition(": ")
+    dependencies = []
+    current = ""
+    escaped = False
+    for c in rest:
+        if escaped:
+            current += c
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c.isspace():
+            if current:
+                dependencies.append(current)
+            current = ""
+        else:
+            current += c
+    if current:
+        dependencies.append(current)
+    return target.strip(), dependencies
+
+
+def read_depfile(path):
+    """Read and parse a dependency file, see parse_depfile"""
+    with open(path) as f:
+        return parse_depfile(f.read())
+
+
+def write_depfile(path, target, dependencies):
+    """
+    Write a Makefile-style dependency file that ninja can read.
+
+    Arguments:
+        path {str} -- the depfile to write
+        target {str} -- the output the dependencies are for
+        dependencies {list} -- paths of the files it depends on
+    """
+
+    def escape(p):
+        return p.replace("\\", "/").replace(" ", "\\ ")
+
+    with open(path, "w") as f:
+        f.write(f"{escape(target)}: " + " \\\n  ".join(escape(d) for d in dependencies) + "\n")
+
+
+def relative_dependencies(dependencies, root):
+    """
+    Express dependencies relative to root where they are inside it, so they
+    make sense on another machine with the same tree somewhere else.
+    """
+    root = os.path.abspath(root)
+    result = []
+    for d in dependencies:
+        absolute = os.path.abspath(os.path.join(root, d))
+        if absolute == root or absolute.startswith(root + os.sep):
+            result.append(os.path.relpath(absolute, root).replace(os.sep, "/"))
+        else:
+            result.append(d)
+    return result
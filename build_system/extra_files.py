@@ -0,0 +1,71 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from .stl import file_sha256
+
+# ioctl request to clone a file's extents (reflink) on btrfs, xfs etc.
+FICLONE = 0x40049409
+
+
+def _reflink(source, destination):
+    """Make destination a copy-on-write clone of source, if the filesystem allows"""
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+def link_or_copy(source, destination):
+    """
+    Put a copy of source at destination without duplicating the data if
+    possible: hardlink, then reflink, then fall back to a real copy.
+
+    Returns which method was used.
+
+    Arguments:
+        source {str} -- the file to import
+        destination {str} -- where to put it
+    """
+    try:
+        os.link(source, destination)
+        return "hardlinked"
+    except OSError:
+        pass
+    try:
+        _reflink(source, destination)
+        return "reflinked"
+    except OSError:
+        pass
+    shutil.copyfile(source, destination)
+    return "copied"
+
+
+def import_file(source, destination):
+    """
+    Import a prebuilt file into the build folder, skipping it if the
+    destination already has the same content.
+
+    Returns what was done, e.g. "unchanged" or "hardlinked".
+
+    Arguments:
+        source {str} -- the file to import
+        destination {str} -- where to put it
+    """
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination) or file_sha256(
+            source
+        ) == file_sha256(destination):
+            return "unchanged"
+        os.remove(destination)
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    return link_or_copy(source, destination)
@@ -0,0 +1,480 @@
+import numpy as np
+
+from .stl import face_areas
+
+
+def sample_surface(triangles, n_samples, seed=0, return_faces=False):
+    """
+    Points spread uniformly over the surface of a mesh.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        n_samples {int} -- number of points
+        seed {int} -- seed of the random number generator, for repeatable results
+        return_faces {bool} -- also return the index of the triangle each point is on
+    """
+    random = np.random.RandomState(seed)
+    areas = face_areas(triangles)
+    if len(triangles) == 0 or areas.sum() == 0:
+        if return_faces:
+            return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+        return np.zeros((0, 3))
+    chosen = random.choice(len(triangles), size=n_samples, p=areas / areas.sum())
+    u, v = random.random_sample((2, n_samples))
+    # reflect points outside the triangle back inside it
+    outside = u + v > 1
+    u[outside], v[outside] = 1 - u[outside], 1 - v[outside]
+    t = triangles[chosen]
+    points = t[:, 0] + u[:, None] * (t[:, 1] - t[:, 0]) + v[:, None] * (t[:, 2] - t[:, 0])
+    if return_faces:
+        return points, chosen
+    return points
+
+
+def _segment_distance(points, a, b):
+    ab = b - a
+    length2 = np.einsum("ij,ij->i", ab, ab)
+    t = np.einsum("ij,ij->i", points - a, ab) / np.where(length2 > 0, length2, 1)
+    t = np.clip(t, 0, 1)
+    return np.linalg.norm(points - (a + t[:, None] * ab), axis=1)
+
+
+def _segments_distance(p1, q1, p2, q2):
+    # closest points of two segments, clamping one then the other
+    d1, d2, r = q1 - p1, q2 - p2, p1 - p2
+    a = np.einsum("ij,ij->i", d1, d1)
+    e = np.einsum("ij,ij->i", d2, d2)
+    b = np.einsum("ij,ij->i", d1, d2)
+    c = np.einsum("ij,ij->i", d1, r)
+    f = np.einsum("ij,ij->i", d2, r)
+    denominator = a * e - b * b
+    safe_a = np.where(a > 0, a, 1)
+    s = np.where(denominator > 1e-12, (b * f - c * e) / np.where(denominator > 1e-12, denominator, 1), 0)
+    s = np.clip(s, 0, 1)
+    t = (b * s + f) / np.where(e > 0, e, 1)
+    s = np.where(t < 0, np.clip(-c / safe_a, 0, 1), np.where(t > 1, np.clip((b - c) / safe_a, 0, 1), s))
+    t = np.clip(t, 0, 1)
+    return np.linalg.norm(p1 + s[:, None] * d1 - p2 - t[:, None] * d2, axis=1)
+
+
+def point_triangle_distance(points, triangles):
+    """
+    Distance from each point to the corresponding triangle (element-wise).
+
+    Arguments:
+        points {ndarray} -- (n, 3) points
+        triangles {ndarray} -- (n, 3, 3) triangles
+    """
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    normal = np.cross(b - a, c - a)
+    length = np.linalg.norm(normal, axis=1)
+    unit = normal / np.where(length > 0, length, 1)[:, None]
+    ap = points - a
+    plane_distance = np.einsum("ij,ij->i", ap, unit)
+    projected = points - plane_distance[:, None] * unit
+    # the projection is inside if it is on the inner side of all three edges
+    inside = length > 0
+    for p, q in ((a, b), (b, c), (c, a)):
+        inside &= np.einsum("ij,ij->i", np.cross(q - p, projected - p), normal) >= 0
+    edge_distance = np.minimum(
+        np.minimum(_segment_distance(points, a, b), _segment_distance(points, b, c)),
+        _segment_distance(points, c, a),
+    )
+    return np.where(inside, np.abs(plane_distance), edge_distance)
+
+
+class TriangleGrid:
+    def __init__(self, triangles, cell_size):
+        """
+        A uniform grid spatial index of triangles. Triangles no bigger than
+        a cell are filed under the cell of their centroid; bigger ones are
+        kept in a short list that is always searched.
+
+        Arguments:
+            triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+            cell_size {float} -- edge length of the grid cells
+        """
+        self.triangles = triangles
+        self.cell_size = float(cell_size)
+        extent = triangles.max(axis=1) - triangles.min(axis=1)
+        small = extent.max(axis=1) <= self.cell_size
+        self.large = np.nonzero(~small)[0]
+        small_indices = np.nonzero(small)[0]
+        keys = self._keys(triangles[small_indices].mean(axis=1))
+        order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[order]
+        self._sorted_triangles = small_indices[order]
+
+    def _cells(self, points):
+        return np.floor(points / self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _pack(cells):
+        # 21 bits per axis is plenty for any part on a printer bed
+        cells = cells + (1 << 20)
+        return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+    def _keys(self, points):
+        return self._pack(self._cells(points))
+
+    def candidates(self, points, radius=1.0):
+        """
+        Pairs (point index, triangle index) of every triangle that may lie
+        within `radius` cells of each point.
+        """
+        reach = int(np.ceil(radius)) + 1
+        offsets = np.array(
+            [
+                (i, j, k)
+                for i in range(-reach, reach + 1)
+                for j in range(-reach, reach + 1)
+                for k in range(-reach, reach + 1)
+            ]
+        )
+        cells = self._cells(points)[:, None, :] + offsets[None, :, :]
+        keys = self._pack(cells).ravel()
+        starts = np.searchsorted(self._sorted_keys, keys, side="left")
+        ends = np.searchsorted(self._sorted_keys, keys, side="right")
+        counts = ends - starts
+        point_index = np.repeat(np.repeat(np.arange(len(points)), len(offsets)), counts)
+        # expand each [start, end) range into the indices it covers
+        total = counts.sum()
+        if total:
+            range_starts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            positions = np.arange(total) + range_starts
+            triangle_index = self._sorted_triangles[positions]
+        else:
+            triangle_index = np.zeros(0, dtype=np.int64)
+
+        if len(self.large):
+            point_index = np.concatenate(
+                [point_index, np.repeat(np.arange(len(points)), len(self.large))]
+            )
+            triangle_index = np.concatenate(
+                [triangle_index, np.tile(self.large, len(points))]
+            )
+        return point_index, triangle_index
+
+    def nearest_distance(self, points, max_distance, chunk=200000):
+        """
+        Distance from each point to the nearest triangle, or inf if it is
+        further than max_distance (which should not exceed the cell size).
+        """
+        if max_distance > self.cell_size:
+            raise ValueError("max_distance can't be larger than the grid cells")
+        distances = np.full(len(points), np.inf)
+        if len(points) == 0:
+            return distances
+        point_index, triangle_index = self.candidates(points, max_distance / self.cell_size)
+        for start in range(0, len(point_index), chunk):
+            p = point_index[start : start + chunk]
+            t = triangle_index[start : start + chunk]
+            d = point_triangle_distance(points[p], self.triangles[t])
+            np.minimum.at(distances, p, d)
+        distances[distances > max_distance] = np.inf
+        return distances
+
+
+def ray_triangle_distance(origins, directions, triangles):
+    """
+    Distance along each ray to the corresponding triangle (element-wise), or
+    inf if the ray misses it. Rays go one way from their origin.
+
+    Arguments:
+        origins {ndarray} -- (n, 3) start of each ray
+        directions {ndarray} -- (n, 3) unit direction of each ray
+        triangles {ndarray} -- (n, 3, 3) triangles
+    """
+    # Moller-Trumbore
+    a = triangles[:, 0]
+    ab, ac = triangles[:, 1] - a, triangles[:, 2] - a
+    p = np.cross(directions, ac)
+    determinant = np.einsum("ij,ij->i", ab, p)
+    parallel = np.abs(determinant) < 1e-12
+    inverse = 1 / np.where(parallel, 1, determinant)
+    s = origins - a
+    u = np.einsum("ij,ij->i", s, p) * inverse
+    q = np.cross(s, ab)
+    v = np.einsum("ij,ij->i", directions, q) * inverse
+    t = np.einsum("ij,ij->i", ac, q) * inverse
+    hit = ~parallel & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(hit, t, np.inf)
+
+
+class BoxGrid(TriangleGrid):
+    def __init__(self, triangles, cell_size, max_cells=4096):
+        """
+        A uniform grid spatial index of triangles, each filed under every
+        cell its bounding box touches rather than just the cell of its
+        centroid, for finding what a short ray hits or the triangles near a
+        point.
+        Triangles that would take more than max_cells cells are kept in a
+        short list that is always searched.
+
+        Arguments:
+            triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+            cell_size {float} -- edge length of the grid cells
+            max_cells {int} -- most cells a triangle is filed under
+        """
+        self.triangles = triangles
+        self.cell_size = float(cell_size)
+        self.max_cells = max_cells
+        index, keys, self.large = self._file(triangles, 0.0)
+        order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[order]
+        self._sorted_triangles = index[order]
+
+    def candidates(self, points, radius=1.0):
+        """
+        Pairs (point index, triangle index) of every triangle whose bounding
+        box is within `radius` cells of each point, each pair once.
+        """
+        # only the cells a box around each point touches, usually just one
+        point_index, keys, _ = self._file(points[:, None, :], radius * self.cell_size)
+        starts = np.searchsorted(self._sorted_keys, keys, side="left")
+        counts = np.searchsorted(self._sorted_keys, keys, side="right") - starts
+        range_starts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        point_index = np.repeat(point_index, counts)
+        triangle_index = self._sorted_triangles[np.arange(counts.sum()) + range_starts]
+        if len(self.large):
+            point_index = np.concatenate(
+                [point_index, np.repeat(np.arange(len(points)), len(self.large))]
+            )
+            triangle_index = np.concatenate([triangle_index, np.tile(self.large, len(points))])
+        # a triangle is found once for every cell it shares with the box
+        pairs = np.unique(point_index * len(self.triangles) + triangle_index)
+        return pairs // len(self.triangles), pairs % len(self.triangles)
+
+    def _file(self, triangles, padding):
+        # (triangle index, cell key) of every cell each triangle's bounding
+        # box, grown by padding, touches, and the triangles that touch too many
+        low = self._cells(triangles.min(axis=1) - padding)
+        counts = self._cells(triangles.max(axis=1) + padding) - low + 1
+        total = counts.prod(axis=1)
+        small = total <= self.max_cells
+        index = np.repeat(np.nonzero(small)[0], total[small])
+        # the position of each entry within its triangle's block of cells
+        local = np.arange(len(index)) - np.repeat(np.cumsum(total[small]) - total[small], total[small])
+        ny, nz = counts[index, 1], counts[index, 2]
+        cells = low[index] + np.stack([local // (ny * nz), (local // nz) % ny, local % nz], axis=1)
+        return index, self._pack(cells), np.nonzero(~small)[0]
+
+    def overlapping(self, triangles, padding=0.0):
+        """
+        Pairs (index into triangles, index into self.triangles) of triangles
+        whose bounding boxes touch a common cell, each pair once.
+
+        Arguments:
+            triangles {ndarray} -- (m, 3, 3) triangles to pair with the grid's
+            padding {float} -- grow the bounding boxes of `triangles` by this much
+        """
+        index, keys, large = self._file(triangles, padding)
+        starts = np.searchsorted(self._sorted_keys, keys, side="left")
+        counts = np.searchsorted(self._sorted_keys, keys, side="right") - starts
+        total = counts.sum()
+        range_starts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        mine = [np.repeat(index, counts)]
+        theirs = [self._sorted_triangles[np.arange(total) + range_starts]]
+
+        # triangles too big to file are paired by comparing bounding boxes
+        for big, other, swap in ((large, self.triangles, False), (self.large, triangles, True)):
+            source = self.triangles if swap else triangles
+            low, high = other.min(axis=1), other.max(axis=1)
+            for i in big:
+                touching = np.nonzero(
+                    np.all(low <= source[i].max(axis=0) + padding, axis=1)
+                    & np.all(high >= source[i].min(axis=0) - padding, axis=1)
+                )[0]
+                single = np.full(len(touching), i)
+                mine.append(touching if swap else single)
+                theirs.append(single if swap else touching)
+
+        pairs = np.unique(np.concatenate(mine) * len(self.triangles) + np.concatenate(theirs))
+        return pairs // len(self.triangles), pairs % len(self.triangles)
+
+    def _hits(self, origins, directions, ray_index, triangle_index, min_distance, distances):
+        t = self.triangles[triangle_index]
+        d = ray_triangle_distance(origins[ray_index], directions[ray_index], t)
+        normal = np.cross(t[:, 1] - t[:, 0], t[:, 2] - t[:, 0])
+        d[(np.einsum("ij,ij->i", normal, directions[ray_index]) <= 0) | (d < min_distance)] = np.inf
+        np.minimum.at(distances, ray_index, d)
+
+    def first_hit(self, origins, directions, max_distance, min_distance=1e-3, chunk=5000):
+        """
+        Distance along each ray to the first triangle it hits from behind,
+        i.e. leaving a solid, ignoring hits closer than min_distance. inf if
+        there is none within max_distance.
+
+        The rays are followed one cell length at a time, and a ray is
+        dropped as soon as it has hit something.
+        """
+        distances = np.full(len(origins), np.inf)
+        for start in range(0, len(self.large) and len(origins), chunk):
+            rays = np.arange(start, min(start + chunk, len(origins)))
+            self._hits(
+                origins,
+                directions,
+                np.repeat(rays, len(self.large)),
+                np.tile(self.large, len(rays)),
+                min_distance,
+                distances,
+            )
+
+        steps = max(1, int(np.ceil(max_distance / self.cell_size)))
+        step = max_distance / steps
+        active = np.arange(len(origins))
+        for s in range(steps):
+            active = active[distances[active] > s * step]
+            for first in range(0, len(active), chunk):
+                rays = active[first : first + chunk]
+                begin = origins[rays] + s * step * directions[rays]
+                end = begin + step * directions[rays]
+                low = self._cells(np.minimum(begin, end))
+                high = self._cells(np.maximum(begin, end))
+                # a segment no longer than a cell touches at most two cells along each axis
+                keys = []
+                for i in (0, 1):
+                    for j in (0, 1):
+                        for k in (0, 1):
+                            keys.append(self._pack(np.minimum(low + [i, j, k], high)))
+                keys = np.sort(np.stack(keys, axis=1), axis=1)
+                # don't look in the same cell twice
+                keys[:, 1:][keys[:, 1:] == keys[:, :-1]] = -1
+                keys = keys.ravel()
+                starts = np.searchsorted(self._sorted_keys, keys, side="left")
+                ends = np.searchsorted(self._sorted_keys, keys, side="right")
+                counts = np.where(keys >= 0, ends - starts, 0)
+                total = counts.sum()
+                if total == 0:
+                    continue
+                range_starts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+                self._hits(
+                    origins,
+                    directions,
+                    np.repeat(np.repeat(rays, 8), counts),
+                    self._sorted_triangles[np.arange(total) + range_starts],
+                    min_distance,
+                    distances,
+                )
+        distances[distances > max_distance] = np.inf
+        return distances
+
+
+def triangles_intersect(a, b, tolerance=1e-3):
+    """
+    Whether each triangle of a passes through the corresponding triangle of
+    b (element-wise), i.e. an edge of one crosses the inside of the other,
+    or they overlap in the same plane facing the same way (so the solids
+    behind them overlap too). Triangles that only touch, within tolerance,
+    or face each other in the same plane don't count.
+
+    Arguments:
+        a {ndarray} -- (n, 3, 3) triangles
+        b {ndarray} -- (n, 3, 3) triangles
+        tolerance {float} -- how far past the edges of the other triangle a
+                             crossing must be
+    """
+    crossing = np.zeros(len(a), dtype=bool)
+    for edges, other in ((a, b), (b, a)):
+        # Moller-Trumbore, with each edge as the ray
+        p0 = other[:, 0]
+        p1, p2 = other[:, 1] - p0, other[:, 2] - p0
+        normal = np.linalg.norm(np.cross(p1, p2), axis=1)
+        # a barycentric coordinate times this is the distance to the opposite side
+        heights = [normal / np.maximum(np.linalg.norm(side, axis=1), 1e-12) for side in (p2, p1, p2 - p1)]
+        for i in range(3):
+            start, direction = edges[:, i], edges[:, (i + 1) % 3] - edges[:, i]
+            length = np.linalg.norm(direction, axis=1)
+            p = np.cross(direction, p2)
+            determinant = np.einsum("ij,ij->i", p1, p)
+            parallel = np.abs(determinant) < 1e-12
+            inverse = 1 / np.where(parallel, 1, determinant)
+            s = start - p0
+            u = np.einsum("ij,ij->i", s, p) * inverse
+            q = np.cross(s, p1)
+            v = np.einsum("ij,ij->i", direction, q) * inverse
+            t = np.einsum("ij,ij->i", p2, q) * inverse
+            crossing |= (
+                ~parallel
+                & (u * heights[0] > tolerance)
+                & (v * heights[1] > tolerance)
+                & ((1 - u - v) * heights[2] > tolerance)
+                & (t * length > tolerance)
+                & ((1 - t) * length > tolerance)
+            )
+    return crossing | _coplanar_overlap(a, b, tolerance)
+
+
+def _coplanar_overlap(a, b, tolerance):
+    # triangles in the same plane, facing the same way, whose insides overlap
+    normal_a = np.cross(a[:, 1] - a[:, 0], a[:, 2] - a[:, 0])
+    normal_a /= np.maximum(np.linalg.norm(normal_a, axis=1), 1e-12)[:, None]
+    normal_b = np.cross(b[:, 1] - b[:, 0], b[:, 2] - b[:, 0])
+    normal_b /= np.maximum(np.linalg.norm(normal_b, axis=1), 1e-12)[:, None]
+    plane_distance = np.abs(np.einsum("nij,nj->ni", b - a[:, None, 0], normal_a)).max(axis=1)
+    overlap = (np.einsum("ij,ij->i", normal_a, normal_b) > 1 - 1e-9) & (plane_distance < tolerance)
+    candidates = np.nonzero(overlap)[0]
+    if len(candidates) == 0:
+        return overlap
+    # drop the coordinate the plane faces most, leaving 2D triangles
+    kept = np.array([[1, 2], [0, 2], [0, 1]])[np.abs(normal_a[candidates]).argmax(axis=1)]
+    flat_a = np.take_along_axis(a[candidates], kept[:, None, :], axis=2)
+    flat_b = np.take_along_axis(b[candidates], kept[:, None, :], axis=2)
+    # separating axis test, on the normals of all six edges
+    separate = np.zeros(len(candidates), dtype=bool)
+    for triangle in (flat_a, flat_b):
+        for i in range(3):
+            edge = triangle[:, (i + 1) % 3] - triangle[:, i]
+            axis = np.stack([-edge[:, 1], edge[:, 0]], axis=1)
+            axis /= np.maximum(np.linalg.norm(axis, axis=1), 1e-12)[:, None]
+            along_a = np.einsum("nij,nj->ni", flat_a, axis)
+            along_b = np.einsum("nij,nj->ni", flat_b, axis)
+            shared = np.minimum(along_a.max(axis=1), along_b.max(axis=1)) - np.maximum(
+                along_a.min(axis=1), along_b.min(axis=1)
+            )
+            separate |= shared <= tolerance
+    overlap[candidates] = ~separate
+    return overlap
+
+
+def point_inside(point, triangles):
+    """
+    Whether a point is inside a closed mesh, by counting how many times a
+    ray from it crosses the surface.
+
+    Arguments:
+        point {ndarray} -- (3,) the point
+        triangles {ndarray} -- (n, 3, 3) triangles of the mesh
+    """
+    # an odd direction, so the ray is unlikely to hit an edge or vertex exactly
+    direction = np.array([0.5773, 0.5774, 0.5775])
+    direction /= np.linalg.norm(direction)
+    distances = ray_triangle_distance(
+        np.broadcast_to(point, (len(triangles), 3)),
+        np.broadcast_to(direction, (len(triangles), 3)),
+        triangles,
+    )
+    # a point on the surface doesn't count as inside
+    return bool((np.isfinite(distances) & (distances > 1e-9)).sum() % 2)
+
+
+def triangle_distance(a, b):
+    """
+    Distance between each triangle of a and the corresponding triangle of b
+    (element-wise), for triangles that don't intersect.
+
+    Arguments:
+        a {ndarray} -- (n, 3, 3) triangles
+        b {ndarray} -- (n, 3, 3) triangles
+    """
+    distance = np.full(len(a), np.inf)
+    # the closest points are a vertex and a face, or two edges
+    for i in range(3):
+        distance = np.minimum(distance, point_triangle_distance(a[:, i], b))
+        distance = np.minimum(distance, point_triangle_distance(b[:, i], a))
+        for j in range(3):
+            distance = np.minimum(
+                distance,
+                _segments_distance(a[:, i], a[:, (i + 1) % 3], b[:, j], b[:, (j + 1) % 3]),
+            )
+    return distance
@@ -0,0 +1,378 @@
+"""
+Check that the printed parts fit together.
+
+    python3 -m build_system.interference builds
+
+places the built STL files where they sit in the assembled microscope,
+using the poses echoed by openscad/assembly_poses.scad, and looks for
+parts that pass through each other. Every pair of posed parts that some
+combination of the options in stl_options.json uses together is checked,
+so all the optics, main body and stand combinations are covered without
+going through every configuration.
+
+For each pair the triangles of one part near the other are filed in a
+uniform grid by bounding box, and each triangle of the other part is
+paired with those in the cells it is near. Pairs whose bounding boxes
+overlap are tested for crossing each other, or overlapping in the same
+plane. If none do, a ray from a corner of each part tells whether it is
+entirely inside the other, and if not the clearance is the smallest
+distance between triangles whose bounding boxes are close, looking further
+afield only until something is found. Results are cached by the content of
+the STL files and their poses, so only the pairs involving a part that has
+changed are checked again.
+
+The exit status is 1 if any parts intersect, or are closer than
+`--min-clearance`.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import lru_cache
+
+import numpy as np
+
+from .geometry import BoxGrid, point_inside, triangle_distance, triangles_intersect
+from .openscad import default_executable, parameter_arguments
+from .selection import load_stl_options
+from .stl import file_sha256, read_stl
+
+POSES_FILE = os.path.join("openscad", "assembly_poses.scad")
+CACHE_PATH = os.path.join("builds", ".interference_cache.json")
+# change this when the results change, so cached ones aren't used
+CHECKER_VERSION = 2
+# clearances bigger than this (in mm) aren't measured
+MAX_CLEARANCE = 2.0
+_POSE_PATTERN = re.compile(
+    r'ECHO: pose = "([^"]*)", rotate = \[([^\]]*)\], translate = \[([^\]]*)\]'
+)
+
+
+def read_poses(executable, parameters=None, poses_file=POSES_FILE):
+    """
+    Evaluate the pose table with openscad.
+
+    Returns a list of (pattern, rotate, translate).
+
+    Arguments:
+        executable {str} -- the openscad executable
+        parameters {dict} -- variables to set, e.g. a stand's box_h
+        poses_file {str} -- the .scad file that echoes the poses
+    """
+    handle, csg_file = tempfile.mkstemp(suffix=".csg")
+    os.close(handle)
+    result = subprocess.run(
+        [executable, *parameter_arguments(parameters or {}), poses_file, "-o", csg_file],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    os.remove(csg_file)
+    output = result.stdout.decode(errors="replace")
+    if result.returncode:
+        raise RuntimeError(f"openscad failed to evaluate {poses_file}:\n{output}")
+    return [
+        (
+            match.group(1),
+            tuple(float(x) for x in match.group(2).split(",")),
+            tuple(float(x) for x in match.group(3).split(",")),
+        )
+        for match in _POSE_PATTERN.finditer(output)
+    ]
+
+
+def pose_parameters(parameters):
+    """
+    The parameters of an entry in stl_options.json as openscad variables:
+    file local ones like "microscope_stand:box_h" lose their file name, and
+    lists of allowed values are left out.
+    """
+    return {
+        name.split(":")[-1]: value
+        for name, value in parameters.items()
+        if not isinstance(value, (list, set))
+    }
+
+
+def find_pose(poses, stl):
+    """The (rotate, translate) of the first pose matching an STL file name, or None"""
+    for pattern, rotate, translate in poses:
+        if fnmatch(stl, pattern):
+            return rotate, translate
+    return None
+
+
+def place(triangles, rotate, translate):
+    """
+    Move a mesh into its pose, rotating about x, then y, then z like
+    OpenSCAD's rotate(), then translating.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        rotate {tuple} -- angles about x, y and z in degrees
+        translate {tuple} -- offset in mm
+    """
+    x, y, z = np.radians(rotate)
+    rx = np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+    ry = np.array([[np.cos(y), 0, np.sin(y)], [0, 1, 0], [-np.sin(y), 0, np.cos(y)]])
+    rz = np.array([[np.cos(z), -np.sin(z), 0], [np.sin(z), np.cos(z), 0], [0, 0, 1]])
+    return triangles @ (rz @ ry @ rx).T + np.asarray(translate)
+
+
+def used_together(a, b, options):
+    """
+    Whether some configuration selects both an STL registered with
+    parameters a and one registered with parameters b, i.e. they allow a
+    common value of every option they both depend on.
+
+    Arguments:
+        a {dict} -- the "parameters" of an entry in stl_options.json
+        b {dict} -- the "parameters" of another entry
+        options {dict} -- the changeable options from stl_options.json
+    """
+    for name in options:
+        if name in a and name in b:
+            allowed_a = set(a[name]) if isinstance(a[name], (list, set)) else {a[name]}
+            allowed_b = set(b[name]) if isinstance(b[name], (list, set)) else {b[name]}
+            if not allowed_a & allowed_b:
+                return False
+    return True
+
+
+def _near(triangles, low, high):
+    return triangles[
+        np.all(triangles.max(axis=1) >= low, axis=1) & np.all(triangles.min(axis=1) <= high, axis=1)
+    ]
+
+
+def _paired(a, b, padding):
+    # pairs of triangles whose bounding boxes are within padding, nearest first
+    low = np.maximum(a.min(axis=(0, 1)), b.min(axis=(0, 1))) - padding
+    high = np.minimum(a.max(axis=(0, 1)), b.max(axis=(0, 1))) + padding
+    if np.any(low > high):
+        return a[:0], b[:0], np.zeros(0)
+    # only the triangles near the other part matter
+    a, b = _near(a, low, high), _near(b, low, high)
+    if len(a) == 0 or len(b) == 0:
+        return a[:0], b[:0], np.zeros(0)
+    # cells a few triangles across
+    both = np.concatenate([a, b])
+    edges = np.linalg.norm(both - np.roll(both, 1, axis=1), axis=2).max(axis=1)
+    cell_size = max(2 * np.median(edges), padding, 1e-3)
+    i, j = BoxGrid(b, cell_size).overlapping(a, padding)
+    a, b = a[i], b[j]
+    # the gap between bounding boxes is the least the gap between triangles can be
+    box_gap = np.linalg.norm(
+        np.maximum(0, np.maximum(a.min(axis=1) - b.max(axis=1), b.min(axis=1) - a.max(axis=1))),
+        axis=1,
+    )
+    order = np.argsort(box_gap, kind="stable")
+    order = order[box_gap[order] <= padding]
+    return a[order], b[order], box_gap[order]
+
+
+def _inside(a, b):
+    # a part can only be inside another that is bigger in every direction
+    if np.any(a.min(axis=(0, 1)) < b.min(axis=(0, 1))) or np.any(a.max(axis=(0, 1)) > b.max(axis=(0, 1))):
+        return False
+    return point_inside(a[0, 0], b)
+
+
+def check_pair(a, b, max_clearance=MAX_CLEARANCE, chunk=100000):
+    """
+    Look for places where two placed parts pass through each other.
+
+    Returns {"intersections": number of pairs of triangles that cross,
+    "inside": whether one part is entirely inside the other, "clearance":
+    smallest gap in mm, 0 if they intersect or touch, None if it is more
+    than max_clearance}.
+
+    Arguments:
+        a {ndarray} -- (n, 3, 3) triangles of one part, in its pose
+        b {ndarray} -- (m, 3, 3) triangles of the other part
+        max_clearance {float} -- largest gap to measure
+        chunk {int} -- pairs of triangles tested at once, to limit memory use
+    """
+    result = {"intersections": 0, "inside": False, "clearance": None}
+    # only triangles with overlapping bounding boxes can cross
+    near_a, near_b, _ = _paired(a, b, 0.0)
+    for start in range(0, len(near_a), chunk):
+        crossing = triangles_intersect(near_a[start : start + chunk], near_b[start : start + chunk])
+        result["intersections"] += int(crossing.sum())
+    if result["intersections"]:
+        result["clearance"] = 0.0
+        return result
+    # with no crossings, either part is inside the other or neither is
+    if _inside(a, b) or _inside(b, a):
+        result["inside"] = True
+        result["clearance"] = 0.0
+        return result
+
+    # Look a short way around each triangle, then further until something
+    # is found: any closer pair is within the padding, so the gap is exact.
+    # Parts that fit together are usually close, so the search stays small.
+    padding = max_clearance / 16
+    while True:
+        near_a, near_b, box_gap = _paired(a, b, padding)
+        gap = np.inf
+        # nearest first, stopping when no pair left can be closer
+        for start in range(0, len(near_a), chunk):
+            if box_gap[start] >= gap:
+                break
+            pairs = slice(start, start + chunk)
+            gap = min(gap, triangle_distance(near_a[pairs], near_b[pairs]).min())
+        if gap <= padding:
+            result["clearance"] = round(float(gap), 3)
+            return result
+        if padding >= max_clearance:
+            return result
+        padding = min(2 * padding, max_clearance)
+
+
+@lru_cache(maxsize=8)
+def _placed(path, rotate, translate):
+    return place(read_stl(path), rotate, translate)
+
+
+def _check_pair(job):
+    path_a, pose_a, path_b, pose_b, max_clearance = job
+    return check_pair(_placed(path_a, *pose_a), _placed(path_b, *pose_b), max_clearance)
+
+
+def _cache_key(hash_a, pose_a, hash_b, pose_b, max_clearance):
+    return hashlib.sha256(
+        json.dumps([hash_a, pose_a, hash_b, pose_b, max_clearance, CHECKER_VERSION]).encode()
+    ).hexdigest()
+
+
+def check_assembly(
+    build_dir,
+    executable,
+    poses_file=POSES_FILE,
+    min_clearance=0.0,
+    max_clearance=MAX_CLEARANCE,
+    cache_path=CACHE_PATH,
+    jobs=None,
+):
+    """
+    Check every pair of posed parts that are used together.
+
+    Returns (ok, report).
+
+    Arguments:
+        build_dir {str} -- the build folder with the STL files and stl_options.json
+        executable {str} -- the openscad executable
+        poses_file {str} -- the .scad file that echoes the poses
+        min_clearance {float} -- smallest acceptable gap between parts, in mm
+        max_clearance {float} -- largest gap to measure
+        cache_path {str} -- JSON file of results from earlier builds
+        jobs {int} -- number of pairs to check at once
+    """
+    stl_options = load_stl_options(build_dir)
+    options = stl_options["options"]
+    # the patterns don't depend on the parameters, only the poses do
+    patterns = read_poses(executable, poses_file=poses_file)
+    entries = [e for e in stl_options["stls"] if find_pose(patterns, e["stl"])]
+    parameter_sets = sorted(
+        {json.dumps(pose_parameters(e["parameters"]), sort_keys=True) for e in entries}
+    )
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        poses = dict(
+            zip(
+                parameter_sets,
+                executor.map(
+                    lambda p: read_poses(executable, json.loads(p), poses_file), parameter_sets
+                ),
+            )
+        )
+    placed = []
+    for entry in entries:
+        key = json.dumps(pose_parameters(entry["parameters"]), sort_keys=True)
+        placed.append((entry, find_pose(poses[key], entry["stl"])))
+
+    pairs = set()
+    for n, (entry_a, pose_a) in enumerate(placed):
+        for entry_b, pose_b in placed[n + 1 :]:
+            if entry_a["stl"] == entry_b["stl"]:
+                continue
+            if used_together(entry_a["parameters"], entry_b["parameters"], options):
+                pairs.add(tuple(sorted([(entry_a["stl"], pose_a), (entry_b["stl"], pose_b)])))
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    hashes = {}
+    for entry in entries:
+        if entry["stl"] not in hashes:
+            hashes[entry["stl"]] = entry.get("sha256") or file_sha256(
+                os.path.join(build_dir, entry["stl"])
+            )
+    keys = {
+        pair: _cache_key(hashes[pair[0][0]], pair[0][1], hashes[pair[1][0]], pair[1][1], max_clearance)
+        for pair in pairs
+    }
+    # grouped by the first part, so each process reads each mesh about once
+    to_check = sorted(pair for pair in pairs if keys[pair] not in cache)
+    job_list = [
+        (os.path.join(build_dir, a), pose_a, os.path.join(build_dir, b), pose_b, max_clearance)
+        for (a, pose_a), (b, pose_b) in to_check
+    ]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for pair, result in zip(to_check, executor.map(_check_pair, job_list, chunksize=4)):
+            cache[keys[pair]] = result
+
+    problems = []
+    for pair in sorted(pairs):
+        (a, _), (b, _) = pair
+        result = cache[keys[pair]]
+        if result["intersections"]:
+            problems.append(f"{a} and {b} intersect ({result['intersections']} crossing triangles)")
+        elif result["inside"]:
+            problems.append(f"{a} and {b} intersect (one is inside the other)")
+        elif result["clearance"] is not None and result["clearance"] < min_clearance:
+            problems.append(f"{a} and {b} are only {result['clearance']} mm apart")
+
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump({keys[pair]: cache[keys[pair]] for pair in pairs}, f)
+    os.replace(cache_path + ".tmp", cache_path)
+
+    lines = [
+        f"Checked {len(pairs)} pairs of parts used together "
+        f"({len(pairs) - len(to_check)} unchanged since the last check)."
+    ]
+    if problems:
+        lines.append("These parts collide in the assembled microscope:")
+        lines += [f"    {problem}" for problem in problems]
+    return not problems, "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the printed parts fit together.")
+    parser.add_argument("build_dir", nargs="?", default="builds")
+    parser.add_argument("--openscad", default=default_executable())
+    parser.add_argument("--poses", default=POSES_FILE, help="The .scad file that echoes the poses.")
+    parser.add_argument("--min-clearance", type=float, default=0.0, help="In mm.")
+    parser.add_argument("--max-clearance", type=float, default=MAX_CLEARANCE, help="In mm.")
+    parser.add_argument("--cache", default=CACHE_PATH)
+    parser.add_argument("--jobs", "-j", type=int)
+    args = parser.parse_args()
+
+    ok, report = check_assembly(
+        args.build_dir,
+        args.openscad,
+        args.poses,
+        args.min_clearance,
+        args.max_clearance,
+        args.cache,
+        args.jobs,
+    )
+    print(report)
+    if not ok:
+        sys.exit(1)
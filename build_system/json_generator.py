@@ -2,17 +2,21 @@ import json
 import os
 import operator
 import pathlib
+from .preview import read_preview_header
+from .print_estimate import configuration_estimate
+from .selection import preset_configuration
 from .util import merge_dicts
 
 
 class JsonGenerator:
-    def __init__(self, build_dir, option_docs, stl_presets, required_stls):
+    def __init__(self, build_dir, option_docs, stl_presets, required_stls, test_stls=()):
         self._all_select_stl_params = set()
         self._stl_options = []
         self._build_dir = build_dir
         self._option_docs = option_docs
         self._stl_presets = stl_presets
         self._required_stls = required_stls
+        self._test_stls = sorted(test_stls)
 
     def register(
         self,
@@ -65,7 +69,54 @@ class JsonGenerator:
                 {"stl": output, "input": input, "parameters": stl_option_params}
             )
 
-    def write(self):
+    def write(
+        self, manifest=None, previews=None, printability=None, thumbnails=None, print_estimates=None
+    ):
+        """
+        Write stl_options.json to the build folder.
+
+        Arguments:
+            self {JsonGenerator}
+            manifest {dict} -- manifest of the build folder, if given the checksum and mesh metrics of each stl are included
+            previews {dict} -- preview mesh files (relative to the build folder) of each stl, smallest first
+            printability {dict} -- printability metrics file (relative to the build folder) of each stl
+            thumbnails {dict} -- thumbnail (relative to the build folder) of each view, for each stl
+            print_estimates {dict} -- print time and filament estimate of each stl, totalled for
+                                      each preset over the stls it selects except test_stls
+        """
+        if manifest is not None:
+            for v in self._stl_options:
+                entry = manifest["files"].get(v["stl"])
+                if entry is not None:
+                    v["sha256"] = entry["sha256"]
+                    v["mesh"] = entry.get("mesh")
+
+        if previews is not None:
+            for v in self._stl_options:
+                v["previews"] = []
+                for preview in previews.get(v["stl"], []):
+                    path = os.path.join(self._build_dir, preview)
+                    if os.path.exists(path):
+                        v["previews"].append(
+                            {
+                                "file": preview,
+                                "triangles": read_preview_header(path)["triangles"],
+                                "bytes": os.path.getsize(path),
+                            }
+                        )
+
+        if printability is not None:
+            for v in self._stl_options:
+                path = os.path.join(self._build_dir, printability.get(v["stl"], ""))
+                if v.get("mesh") and os.path.isfile(path):
+                    with open(path) as f:
+                        v["mesh"]["printability"] = json.load(f)
+
+        if thumbnails is not None:
+            for v in self._stl_options:
+                if v["stl"] in thumbnails:
+                    v["thumbnails"] = thumbnails[v["stl"]]
+
         # condense all used parameters down to sets of possible values
         available_options = {}
         for v in self._stl_options:
@@ -119,6 +170,30 @@ class JsonGenerator:
 
         self._stl_options.sort(key=operator.itemgetter("stl"))
 
+        presets = self._stl_presets
+        if print_estimates is not None:
+            for v in self._stl_options:
+                if v["stl"] in print_estimates:
+                    v["print_estimate"] = print_estimates[v["stl"]]
+            # the total for any other configuration is the sum over the stls it
+            # selects, leaving out test_stls
+            stl_options = {
+                "stls": self._stl_options,
+                "options": changeable_options,
+                "docs": self._option_docs,
+                "presets": self._stl_presets,
+                "test_stls": self._test_stls,
+            }
+            presets = [
+                {
+                    **preset,
+                    "print_estimate": configuration_estimate(
+                        stl_options, preset_configuration(stl_options, preset["key"]), print_estimates
+                    ),
+                }
+                for preset in self._stl_presets
+            ]
+
         def encode_set(s):
             """ encode 'set' as sorted 'list' when converting to JSON """
             if type(s) is set:
@@ -137,7 +212,8 @@ class JsonGenerator:
                     "options": changeable_options,
                     "docs": self._option_docs,
                     "required": self._required_stls,
-                    "presets": self._stl_presets,
+                    "test_stls": self._test_stls,
+                    "presets": presets,
                 },
                 f,
                 indent=2,
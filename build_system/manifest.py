@@ -0,0 +1,173 @@
+"""
+A content-hash manifest of the build folder, used to deploy only the files
+that have really changed.
+
+    python3 -m build_system.manifest write builds
+    python3 -m build_system.manifest diff old_manifest.json builds/manifest.json \\
+        --upload-list upload.txt --delete-list delete.txt
+
+Every file gets a sha256 and size, STL files also get mesh metrics including
+a geometry fingerprint that ignores triangle order and number formatting. A
+file whose geometry fingerprint is unchanged doesn't need uploading, even if
+its bytes differ.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .stl import file_sha256, is_stl, mesh_metrics, read_stl
+
+MANIFEST_NAME = "manifest.json"
+
+
+def manifest_files(build_dir):
+    """
+    Relative paths of all the files in build_dir that belong in the
+    manifest. Hidden files, ninja depfiles and the manifest itself are skipped.
+    """
+    found = []
+    for root, dirs, files in os.walk(build_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            rel_path = os.path.relpath(os.path.join(root, f), build_dir)
+            if f.startswith(".") or f.endswith(".d") or rel_path == MANIFEST_NAME:
+                continue
+            found.append(rel_path.replace(os.sep, "/"))
+    return sorted(found)
+
+
+def file_entry(path):
+    """
+    Manifest entry for one file: hash, size, modification time and, for STL
+    files, mesh metrics.
+    """
+    stat = os.stat(path)
+    entry = {"sha256": file_sha256(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if is_stl(path):
+        entry["mesh"] = mesh_metrics(read_stl(path))
+    return entry
+
+
+def build_manifest(build_dir, previous=None, jobs=None):
+    """
+    Make the manifest of build_dir. Entries in `previous` are reused for
+    files whose size and modification time haven't changed, everything else
+    is hashed in parallel.
+
+    Arguments:
+        build_dir {str} -- the build folder, e.g. "builds"
+        previous {dict} -- an earlier manifest of the same folder
+        jobs {int} -- number of files to process in parallel
+    """
+    previous_files = previous["files"] if previous else {}
+    files = {}
+    stale = []
+    for rel_path in manifest_files(build_dir):
+        old = previous_files.get(rel_path)
+        stat = os.stat(os.path.join(build_dir, rel_path))
+        if (
+            old is not None
+            and old.get("size") == stat.st_size
+            and old.get("mtime_ns") == stat.st_mtime_ns
+        ):
+            files[rel_path] = old
+        else:
+            stale.append(rel_path)
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            paths = [os.path.join(build_dir, p) for p in stale]
+            for rel_path, entry in zip(stale, executor.map(file_entry, paths)):
+                files[rel_path] = entry
+
+    return {"files": dict(sorted(files.items()))}
+
+
+def load_manifest(path):
+    """Load a manifest, a missing file counts as an empty manifest"""
+    if not os.path.exists(path):
+        return {"files": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(build_dir, jobs=None):
+    """
+    Update build_dir/manifest.json, re-hashing only files that changed since
+    it was last written. Returns the path of the manifest.
+    """
+    os.makedirs(build_dir, exist_ok=True)
+    path = os.path.join(build_dir, MANIFEST_NAME)
+    manifest = build_manifest(build_dir, previous=load_manifest(path), jobs=jobs)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def has_changed(old_entry, new_entry):
+    """
+    Whether a file needs uploading again. STLs are compared by geometry,
+    everything else by content.
+    """
+    old_mesh = old_entry.get("mesh")
+    new_mesh = new_entry.get("mesh")
+    if old_mesh and new_mesh:
+        return old_mesh["fingerprint"] != new_mesh["fingerprint"]
+    return old_entry["sha256"] != new_entry["sha256"]
+
+
+def diff_manifests(old, new):
+    """
+    The minimal list of files to upload and to delete to turn a deployed
+    folder described by `old` into one described by `new`.
+
+    Returns (upload, delete), both sorted lists of relative paths.
+    """
+    old_files = old["files"]
+    new_files = new["files"]
+    upload = [
+        p for p in new_files if p not in old_files or has_changed(old_files[p], new_files[p])
+    ]
+    delete = [p for p in old_files if p not in new_files]
+    return sorted(upload), sorted(delete)
+
+
+def _write_list(path, items):
+    with open(path, "w") as f:
+        f.writelines(f"{item}\n" for item in items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manifest of the build folder.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    write_parser = subparsers.add_parser("write", help="Update <build_dir>/manifest.json")
+    write_parser.add_argument("build_dir", help="The build folder, e.g. builds")
+    write_parser.add_argument("--jobs", "-j", type=int, help="Files to hash in parallel.")
+
+    diff_parser = subparsers.add_parser(
+        "diff", help="List the files to upload and delete to deploy a new build."
+    )
+    diff_parser.add_argument("old", help="Manifest of the deployed build (may be missing).")
+    diff_parser.add_argument("new", help="Manifest of the new build.")
+    diff_parser.add_argument("--upload-list", help="Write the files to upload here.")
+    diff_parser.add_argument("--delete-list", help="Write the files to delete here.")
+
+    args = parser.parse_args()
+
+    if args.command == "write":
+        print(f"generated {write_manifest(args.build_dir, args.jobs)}")
+    else:
+        upload, delete = diff_manifests(load_manifest(args.old), load_manifest(args.new))
+        if args.upload_list:
+            _write_list(args.upload_list, upload)
+        if args.delete_list:
+            _write_list(args.delete_list, delete)
+        if not (args.upload_list or args.delete_list):
+            for p in upload:
+                print(f"upload {p}")
+            for p in delete:
+                print(f"delete {p}")
+        print(f"{len(upload)} to upload, {len(delete)} to delete")
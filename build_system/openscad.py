@@ -0,0 +1,46 @@
+import sys
+
+
+def default_executable():
+    """The openscad executable on this platform"""
+    if sys.platform.startswith("darwin"):
+        return "/Applications/OpenSCAD.app/Contents/MacOS/OpenSCAD"
+    return "openscad"
+
+
+def _format_value(value):
+    # Convert bools to lowercase
+    if type(value) == bool:
+        return str(value).lower()
+    # Wrap strings in quotes
+    if type(value) == str:
+        return f'"{value}"'
+    return value
+
+
+def parameters_to_string(parameters):
+    """
+    Build an OpenScad parameter arguments string from a variable name and value
+
+    Arguments:
+        parameters {dict} -- Dictionary of parameters
+    """
+    strings = []
+    for name in parameters:
+        strings.append("-D '{}={}'".format(name, _format_value(parameters[name])))
+
+    return " ".join(strings)
+
+
+def parameter_arguments(parameters):
+    """
+    The same parameters as parameters_to_string, as a list of arguments for
+    running openscad without a shell.
+
+    Arguments:
+        parameters {dict} -- Dictionary of parameters
+    """
+    arguments = []
+    for name in parameters:
+        arguments += ["-D", "{}={}".format(name, _format_value(parameters[name]))]
+    return arguments
@@ -0,0 +1,163 @@
+"""
+Package the builds/ folder into reproducible zip files.
+
+Entries are sorted and carry a fixed timestamp and permissions, so the same
+content always produces the same bytes. Members are deflated in parallel
+(zlib releases the GIL) and the compressed bytes are written into a
+zipfile.ZipFile in order. As well as one zip of everything, one small zip per
+entry in `stl_presets` is written that only holds the STLs that preset
+selects.
+
+    python3 -m build_system.package builds --name openflexure-microscope
+"""
+import argparse
+import os
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .selection import load_stl_options, preset_configuration, selected_stls
+
+# the earliest date a zip file can store
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# regular file, rw-r--r--
+EXTERNAL_ATTRIBUTES = 0o100644 << 16
+# folders of the build that aren't put in the zip of everything
+WEB_ONLY_DIRS = ("previews", "thumbnails")
+
+
+def compress_member(path, level=9):
+    """
+    Read and raw-deflate one file, returning (compress type, crc, size, data).
+    Files that don't compress are stored.
+
+    Arguments:
+        path {str} -- file to compress
+        level {int} -- zlib compression level
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(raw) + compressor.flush()
+    crc = zlib.crc32(raw)
+    if len(data) >= len(raw):
+        return zipfile.ZIP_STORED, crc, len(raw), raw
+    return zipfile.ZIP_DEFLATED, crc, len(raw), data
+
+
+def _write_compressed(archive, info, data):
+    # ZipFile can only compress members itself, so write the header and the
+    # already compressed data the way ZipFile.writestr does
+    info.header_offset = archive.fp.tell()
+    archive.fp.write(info.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.start_dir = archive.fp.tell()
+    archive._didModify = True
+
+
+def _parallel_map(function, items, jobs):
+    """Like executor.map but only keeps a window of results in memory"""
+    jobs = jobs or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        window = deque()
+        for item in items:
+            window.append(executor.submit(function, item))
+            if len(window) >= 2 * jobs:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def write_reproducible_zip(zip_path, base_dir, files, jobs=None):
+    """
+    Write a zip of `files` whose bytes depend only on their names and content.
+
+    Arguments:
+        zip_path {str} -- the zip file to write
+        base_dir {str} -- the folder `files` are relative to
+        files {list} -- relative paths of the files to include
+        jobs {int} -- number of files to compress in parallel
+    """
+    names = sorted(set(f.replace(os.sep, "/") for f in files))
+    members = _parallel_map(lambda name: compress_member(os.path.join(base_dir, name)), names, jobs)
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        for name, (compress_type, crc, size, data) in zip(names, members):
+            info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+            info.compress_type = compress_type
+            info.create_system = 3  # unix, so the permissions are used
+            info.external_attr = EXTERNAL_ATTRIBUTES
+            info.CRC = crc
+            info.file_size = size
+            info.compress_size = len(data)
+            _write_compressed(archive, info, data)
+
+
+def list_files(base_dir):
+    """All files below base_dir relative to it, skipping hidden files and folders"""
+    found = []
+    for root, dirs, files in os.walk(base_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if not f.startswith("."):
+                found.append(os.path.relpath(os.path.join(root, f), base_dir))
+    return found
+
+
+def package(build_dir, output_dir, name, jobs=None):
+    """
+    Write `<name>.zip` with everything in build_dir, and `<name>-<preset>.zip`
+    for every preset in stl_options.json (if it has been generated). Returns
+    the paths of the zips written.
+
+    Arguments:
+        build_dir {str} -- the build folder, e.g. "builds"
+        output_dir {str} -- where to put the zip files
+        name {str} -- base name of the zip files
+        jobs {int} -- number of files to compress in parallel
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+
+    zip_path = os.path.join(output_dir, f"{name}.zip")
+    # preview meshes and thumbnails are only for the web STL selector and docs
+    files = [f for f in list_files(build_dir) if f.split(os.sep)[0] not in WEB_ONLY_DIRS]
+    write_reproducible_zip(zip_path, build_dir, files, jobs)
+    written.append(zip_path)
+
+    if os.path.exists(os.path.join(build_dir, "stl_options.json")):
+        stl_options = load_stl_options(build_dir)
+        for preset in stl_options["presets"]:
+            configuration = preset_configuration(stl_options, preset["key"])
+            stls = selected_stls(stl_options, configuration)
+            missing = [s for s in stls if not os.path.exists(os.path.join(build_dir, s))]
+            if missing:
+                raise FileNotFoundError(
+                    f"Preset '{preset['key']}' needs STL files that haven't been built: "
+                    + ", ".join(missing)
+                )
+            zip_path = os.path.join(output_dir, f"{name}-{preset['key']}.zip")
+            write_reproducible_zip(zip_path, build_dir, stls, jobs)
+            written.append(zip_path)
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Package the build folder into reproducible zip files."
+    )
+    parser.add_argument("build_dir", help="The build folder, e.g. builds")
+    parser.add_argument("--name", required=True, help="Base name of the zip files.")
+    parser.add_argument(
+        "--output-dir", default=".", help="Where to write the zip files."
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, help="Number of files to compress in parallel."
+    )
+    args = parser.parse_args()
+
+    for p in package(args.build_dir, args.output_dir, args.name, args.jobs):
+        print(f"generated {p}")
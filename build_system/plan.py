@@ -0,0 +1,166 @@
+"""
+What a build would do and how long it should take, worked out from a dry
+run of ninja and the render times in render_history.jsonl.
+"""
+import heapq
+import os
+import re
+import statistics
+import subprocess
+
+_EXPLANATIONS = [
+    (re.compile(r"output (\S+) doesn't exist"), "new output"),
+    (re.compile(r"output (\S+) older than most recent input (\S+)"), "changed input"),
+    (re.compile(r"recorded mtime of (\S+) older than most recent input (\S+)"), "changed input"),
+    (re.compile(r"command line changed for (\S+)"), "changed command line"),
+    (re.compile(r"deps for '?([^' ]+)'? are missing"), "no recorded dependencies"),
+    # every depfile in build.ninja is named after its output, $out.d
+    (re.compile(r"depfile '([^']+)\.d' is missing"), "new output"),
+    (re.compile(r"(\S+) is dirty"), "depends on an out of date file"),
+]
+NINJA_PROGRESS = re.compile(r"^\[(\d+)/(\d+)\]")
+
+
+def default_jobs():
+    """How many commands ninja runs at once if not told otherwise"""
+    cpus = os.cpu_count() or 1
+    return cpus + 2 if cpus > 2 else cpus + 1
+
+
+def explain_build(ninja_command):
+    """
+    Ask ninja which outputs are out of date, without building anything.
+
+    Returns ({output: (reason, input)}, number of edges ninja would run).
+    The input is the newer file that made the output out of date, if any.
+
+    Arguments:
+        ninja_command {list} -- ninja and any options to pass it
+    """
+    result = subprocess.run(
+        list(ninja_command) + ["-n", "-d", "explain"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    reasons = {}
+    for line in result.stderr.decode(errors="replace").splitlines():
+        if not line.startswith("ninja explain: "):
+            continue
+        line = line[len("ninja explain: ") :]
+        for pattern, reason in _EXPLANATIONS:
+            match = pattern.match(line)
+            if match:
+                output = os.path.normpath(match.group(1))
+                input = match.group(2) if pattern.groups > 1 else None
+                # the first reason ninja gives is the most specific one
+                reasons.setdefault(output, (reason, input))
+                break
+    edges = 0
+    for line in result.stdout.decode(errors="replace").splitlines():
+        match = NINJA_PROGRESS.match(line)
+        if match:
+            edges = int(match.group(2))
+    return reasons, edges
+
+
+def describe_reason(reason, input, target_input=None):
+    """
+    A readable reason, telling a change to the .scad file an output is
+    rendered from apart from a change to a file it includes (from its depfile).
+    """
+    if reason == "changed input" and input is not None:
+        if target_input is not None and os.path.normpath(input) != os.path.normpath(target_input):
+            return f"changed dependency {input}"
+        return f"changed input {input}"
+    if reason == "changed command line":
+        return "changed command line (parameters or options)"
+    return reason
+
+
+def schedule_length(durations, jobs, busy=()):
+    """
+    How long it takes to run tasks on `jobs` workers, giving the longest
+    waiting task to the first free worker (largest processing time first).
+
+    Arguments:
+        durations {list} -- estimated duration of each task
+        jobs {int} -- number of tasks run at once
+        busy {list} -- time left on tasks that are already running
+    """
+    workers = sorted(list(busy)[:jobs]) + [0.0] * max(jobs - len(busy), 0)
+    heapq.heapify(workers)
+    for duration in sorted(durations, reverse=True):
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers) if workers else 0.0
+
+
+def estimate_durations(outputs, typical):
+    """
+    Estimated render time of each output, from its history or, without one,
+    the median of all the outputs that have a history.
+
+    Returns ({output: seconds}, outputs without history).
+    """
+    fallback = statistics.median(typical.values()) if typical else 0.0
+    estimates = {}
+    unknown = []
+    for output in outputs:
+        if output in typical:
+            estimates[output] = typical[output]
+        else:
+            estimates[output] = fallback
+            unknown.append(output)
+    return estimates, unknown
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
+def plan_report(reasons, edges, targets, typical, jobs):
+    """
+    A listing of what a build would render and why, with time estimates.
+
+    Arguments:
+        reasons {dict} -- from explain_build
+        edges {int} -- from explain_build
+        targets {dict} -- maps each render output to its input .scad file
+        typical {dict} -- typical render time of each output
+        jobs {int} -- renders run at once
+    """
+    outputs = sorted(o for o in reasons if o in targets)
+    if not edges:
+        return "Everything is up to date."
+    estimates, unknown = estimate_durations(outputs, typical)
+    lines = []
+    for output in outputs:
+        reason, input = reasons[output]
+        estimate = format_duration(estimates[output]) if output not in unknown else "?"
+        lines.append(
+            f"  {output} [{estimate}]: {describe_reason(reason, input, targets[output])}"
+        )
+    other = edges - len(outputs)
+    lines.append(f"{len(outputs)} render(s) and {other} other step(s) out of date.")
+    if len(unknown) == len(outputs):
+        lines.append("No render times have been recorded yet, so there is no estimate.")
+    elif outputs:
+        total = sum(estimates.values())
+        # renders don't depend on each other, so the critical path is the longest one
+        critical_path = max(estimates.values())
+        lines.append(
+            f"Estimated time with {jobs} jobs: {format_duration(schedule_length(estimates.values(), jobs))}"
+            f" ({format_duration(total)} of rendering in total, critical path"
+            f" {format_duration(critical_path)})."
+        )
+    if unknown and len(unknown) < len(outputs):
+        lines.append(
+            f"{len(unknown)} render(s) have no recorded time, and are assumed to take"
+            f" as long as a typical render."
+        )
+    return "\n".join(lines)
@@ -0,0 +1,356 @@
+"""
+Arrange the STL files a configuration needs on as few printer beds as
+possible.
+
+    python3 -m build_system.plates --preset high_resolution_raspberry_pi --bed 250 210
+
+packs the parts `high_resolution_raspberry_pi` selects from builds/stl_options.json
+onto 250 x 210mm plates, and writes each plate as an STL and a 3MF file to
+plates/, with plates.json listing where every part went. Instead of a
+preset, `--set name=value` options (and the defaults for the rest) choose
+the parts.
+
+Each part's footprint, the outline of the mesh seen from above, is drawn
+on a grid and widened by half of `--spacing`. Parts go largest first at the
+lowest, then leftmost, place where the footprint doesn't overlap anything
+already on a plate, trying four rotations. The overlap at every position of
+the plate is found at once by correlating the two grids with FFTs, which is
+what makes trying rotations cheap. The parts are placed as they are in the
+STL files, the right way up for printing.
+"""
+import argparse
+import json
+import os
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from .preview import weld_vertices
+from .selection import default_configuration, load_stl_options, preset_configuration, selected_stls
+from .stl import read_stl, write_binary_stl
+from .variants import parse_axis_argument
+
+
+def rotate(triangles, quarter_turns):
+    """Rotate a mesh about the z axis by a multiple of 90 degrees"""
+    rotated = triangles.copy()
+    for _ in range(quarter_turns % 4):
+        rotated[..., 0], rotated[..., 1] = -rotated[..., 1], rotated[..., 0].copy()
+    return rotated
+
+
+def footprint(triangles, resolution):
+    """
+    The cells of a grid covered by a mesh seen from above.
+
+    Returns (boolean grid indexed [x, y], position of cell [0, 0] in mm).
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        resolution {float} -- size of the grid cells in mm
+    """
+    xy = triangles[:, :, :2]
+    origin = xy.reshape(-1, 2).min(axis=0)
+    xy = (xy - origin) / resolution
+    shape = np.floor(xy.reshape(-1, 2).max(axis=0)).astype(int) + 1
+    grid = np.zeros(shape, dtype=bool)
+    # mark a lattice of points on each triangle, at most half a cell apart
+    edges = np.linalg.norm(xy - np.roll(xy, 1, axis=1), axis=2).max(axis=1)
+    steps = np.ceil(2 * edges).astype(int) + 1
+    for s in np.unique(steps):
+        i, j = np.nonzero(np.add.outer(np.arange(s + 1), np.arange(s + 1)) <= s)
+        u, v = i / s, j / s
+        t = xy[steps == s]
+        points = (
+            t[:, None, 0] * (1 - u - v)[None, :, None]
+            + t[:, None, 1] * u[None, :, None]
+            + t[:, None, 2] * v[None, :, None]
+        )
+        cells = np.minimum(np.floor(points).astype(int), shape - 1).reshape(-1, 2)
+        grid[cells[:, 0], cells[:, 1]] = True
+    return grid, origin
+
+
+def dilate(grid, radius):
+    """Grow the marked cells of a grid by a disc `radius` cells across"""
+    grown = np.zeros((grid.shape[0] + 2 * radius, grid.shape[1] + 2 * radius), dtype=bool)
+    for i in range(-radius, radius + 1):
+        for j in range(-radius, radius + 1):
+            if i * i + j * j <= radius * radius:
+                grown[
+                    radius + i : radius + i + grid.shape[0], radius + j : radius + j + grid.shape[1]
+                ] |= grid
+    return grown
+
+
+def free_positions(plate, shape):
+    """
+    Where a footprint could go on a plate without overlapping anything.
+
+    Returns a boolean grid of the positions of its cell [0, 0].
+
+    Arguments:
+        plate {ndarray} -- boolean grid of the cells already taken
+        shape {ndarray} -- boolean grid of the footprint
+    """
+    width, height = plate.shape[0] - shape.shape[0] + 1, plate.shape[1] - shape.shape[1] + 1
+    if width <= 0 or height <= 0:
+        return np.zeros((0, 0), dtype=bool)
+    size = (plate.shape[0] + shape.shape[0], plate.shape[1] + shape.shape[1])
+    # overlap[x, y] = sum over (i, j) of plate[x + i, y + j] * shape[i, j]
+    overlap = np.fft.irfft2(
+        np.fft.rfft2(plate, size) * np.conj(np.fft.rfft2(shape, size)), size
+    )[:width, :height]
+    return overlap < 0.5
+
+
+class Part:
+    def __init__(self, name, triangles, resolution, spacing):
+        """
+        A part to place, with its footprint in each of four rotations.
+
+        Arguments:
+            name {str} -- the stl file, relative to the build folder
+            triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+            resolution {float} -- size of the grid cells in mm
+            spacing {float} -- gap to leave between parts in mm
+        """
+        self.name = name
+        self.triangles = triangles
+        self.footprints = []
+        radius = int(np.ceil(spacing / 2 / resolution))
+        for quarter_turns in range(4):
+            grid, origin = footprint(rotate(triangles, quarter_turns), resolution)
+            self.footprints.append((dilate(grid, radius), origin - radius * resolution))
+        self.area = int(self.footprints[0][0].sum())
+
+
+def _best_position(plate, part):
+    """The lowest then leftmost free position over all rotations, or None"""
+    best = None
+    for quarter_turns, (shape, _) in enumerate(part.footprints):
+        free = free_positions(plate, shape)
+        if not free.any():
+            continue
+        x, y = np.nonzero(free)
+        # lowest top edge first, then leftmost
+        top = y + shape.shape[1]
+        i = np.lexsort((x, top))[0]
+        candidate = (top[i], x[i], quarter_turns, x[i], y[i])
+        if best is None or candidate[:2] < best[:2]:
+            best = candidate
+    return None if best is None else best[2:]
+
+
+def pack(parts, bed_cells):
+    """
+    Place parts on plates, first fit, largest footprint first.
+
+    Returns a list of plates, each a list of (part, quarter turns, x cell, y cell).
+
+    Arguments:
+        parts {list} -- the Parts to place
+        bed_cells {tuple} -- size of a plate in grid cells
+    """
+    grids = []
+    plates = []
+    for part in sorted(parts, key=lambda p: (-p.area, p.name)):
+        for grid, placed in zip(grids, plates):
+            position = _best_position(grid, part)
+            if position is not None:
+                break
+        else:
+            grid = np.zeros(bed_cells, dtype=bool)
+            placed = []
+            position = _best_position(grid, part)
+            if position is None:
+                raise ValueError(f"{part.name} doesn't fit on an empty plate")
+            grids.append(grid)
+            plates.append(placed)
+        quarter_turns, x, y = position
+        shape = part.footprints[quarter_turns][0]
+        grid[x : x + shape.shape[0], y : y + shape.shape[1]] |= shape
+        placed.append((part, quarter_turns, int(x), int(y)))
+    return plates
+
+
+def placed_triangles(part, quarter_turns, x, y, resolution):
+    """The triangles of a part moved to where it was placed on the plate"""
+    triangles = rotate(part.triangles, quarter_turns)
+    _, origin = part.footprints[quarter_turns]
+    offset = np.array([x * resolution, y * resolution]) - origin
+    triangles[..., :2] += offset
+    triangles[..., 2] -= triangles[..., 2].min()
+    return triangles
+
+
+def write_3mf(path, objects):
+    """
+    Write meshes as a 3MF file, one object each.
+
+    Arguments:
+        path {str} -- the .3mf file to write
+        objects {list} -- (name, triangles) of each mesh, in mm
+    """
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<model unit="millimeter" xml:lang="en-US"'
+        ' xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">',
+        "<resources>",
+    ]
+    for i, (name, triangles) in enumerate(objects, start=1):
+        vertices, faces = weld_vertices(triangles)
+        lines.append(f'<object id="{i}" type="model" name="{escape(name)}"><mesh><vertices>')
+        lines.extend(f'<vertex x="{x:.4f}" y="{y:.4f}" z="{z:.4f}"/>' for x, y, z in vertices)
+        lines.append("</vertices><triangles>")
+        lines.extend(f'<triangle v1="{a}" v2="{b}" v3="{c}"/>' for a, b, c in faces)
+        lines.append("</triangles></mesh></object>")
+    lines.append("</resources>")
+    lines.append("<build>")
+    lines.extend(f'<item objectid="{i}"/>' for i in range(1, len(objects) + 1))
+    lines.append("</build>")
+    lines.append("</model>")
+
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+        "</Types>\n"
+    )
+    relationships = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Target="/3D/3dmodel.model" Id="rel0"'
+        ' Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+        "</Relationships>\n"
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", content_types)
+        z.writestr("_rels/.rels", relationships)
+        z.writestr("3D/3dmodel.model", "\n".join(lines) + "\n")
+
+
+def plate_parts(
+    build_dir, stls, output_dir, bed=(220, 220), spacing=5, resolution=1, copies=None
+):
+    """
+    Pack STL files onto plates and write each plate as STL and 3MF.
+
+    Returns a summary of the plates, which is also written to plates.json.
+
+    Arguments:
+        build_dir {str} -- the build folder, e.g. "builds"
+        stls {list} -- the stl files to place, relative to build_dir
+        output_dir {str} -- where to write the plates
+        bed {tuple} -- size of the printer bed in mm
+        spacing {float} -- gap to leave between parts in mm
+        resolution {float} -- size of the footprint grid cells in mm
+        copies {dict} -- how many of each stl to print, if not one
+    """
+    copies = copies or {}
+    parts = []
+    for stl in stls:
+        triangles = read_stl(os.path.join(build_dir, stl))
+        if len(triangles) == 0:
+            continue
+        part = Part(stl, triangles, resolution, spacing)
+        parts += [part] * copies.get(stl, 1)
+
+    bed_cells = tuple(int(size / resolution) for size in bed)
+    plates = pack(parts, bed_cells)
+
+    os.makedirs(output_dir, exist_ok=True)
+    summary = {"bed": list(bed), "spacing": spacing, "plates": []}
+    for number, placed in enumerate(plates, start=1):
+        objects = []
+        entries = []
+        for part, quarter_turns, x, y in placed:
+            triangles = placed_triangles(part, quarter_turns, x, y, resolution)
+            objects.append((os.path.splitext(os.path.basename(part.name))[0], triangles))
+            entries.append(
+                {
+                    "stl": part.name,
+                    "rotation": 90 * quarter_turns,
+                    "position": [round(float(v), 3) for v in triangles.min(axis=(0, 1))[:2]],
+                }
+            )
+        name = f"plate_{number}"
+        write_binary_stl(
+            os.path.join(output_dir, name + ".stl"), np.concatenate([t for _, t in objects])
+        )
+        write_3mf(os.path.join(output_dir, name + ".3mf"), objects)
+        used = sum(part.footprints[q][0].sum() for part, q, _, _ in placed)
+        summary["plates"].append(
+            {
+                "name": name,
+                "parts": entries,
+                "fill": round(float(used) / (bed_cells[0] * bed_cells[1]), 3),
+            }
+        )
+    with open(os.path.join(output_dir, "plates.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def format_summary(summary):
+    lines = []
+    for plate in summary["plates"]:
+        lines.append(
+            f"{plate['name']}: {len(plate['parts'])} part(s), {100 * plate['fill']:.0f}% of the bed"
+        )
+        lines.extend(f"    {p['stl']}" for p in plate["parts"])
+    lines.append(f"{len(summary['plates'])} plate(s) of {summary['bed'][0]} x {summary['bed'][1]}mm")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Arrange the STL files of a configuration on printer beds."
+    )
+    parser.add_argument("--build-dir", default="builds")
+    parser.add_argument("--preset", help="A preset from stl_options.json.")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Set an option (on top of the preset, if given).",
+    )
+    parser.add_argument("--bed", type=float, nargs=2, default=[220, 220], metavar=("X", "Y"))
+    parser.add_argument("--spacing", type=float, default=5, help="Gap between parts in mm.")
+    parser.add_argument("--resolution", type=float, default=1, help="Footprint grid size in mm.")
+    parser.add_argument(
+        "--copies",
+        action="append",
+        default=[],
+        metavar="STL=N",
+        help="Print more than one of an STL file.",
+    )
+    parser.add_argument("--output-dir", default="plates")
+    args = parser.parse_args()
+
+    stl_options = load_stl_options(args.build_dir)
+    if args.preset:
+        configuration = preset_configuration(stl_options, args.preset)
+    else:
+        configuration = default_configuration(stl_options)
+    for argument in args.set:
+        name, values = parse_axis_argument(argument)
+        configuration[name] = values[0]
+    copies = {}
+    for argument in args.copies:
+        name, values = parse_axis_argument(argument)
+        copies[name] = int(values[0])
+
+    summary = plate_parts(
+        args.build_dir,
+        selected_stls(stl_options, configuration),
+        args.output_dir,
+        bed=args.bed,
+        spacing=args.spacing,
+        resolution=args.resolution,
+        copies=copies,
+    )
+    print(format_summary(summary))
@@ -0,0 +1,104 @@
+"""
+Check every part for OpenSCAD errors before rendering anything.
+
+Each distinct input file and parameter set is evaluated with a CSG export,
+which runs all the OpenSCAD code but skips the expensive geometry, so a
+syntax error, an unknown module or a failed assertion is reported within
+seconds instead of when ninja gets to that part of the build.
+"""
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+_MESSAGE_PATTERN = re.compile(r"^(ERROR|WARNING|DEPRECATED|TRACE):\s*(.*)$")
+# warnings that mean the code is broken, rather than just untidy. Unknown
+# variables are only reported for now: parts may still rely on a variable
+# being undef, which has to be checked against a real build first.
+_FATAL_WARNINGS = re.compile(r"Ignoring unknown (module|function)|Assertion .* failed")
+
+
+def check_part(executable, input, parameters, output_dir):
+    """
+    Evaluate a part without rendering it.
+
+    Returns (exit status, [(level, message)]).
+
+    Arguments:
+        executable {str} -- the openscad executable
+        input {str} -- the .scad file
+        parameters {str} -- openscad parameter arguments, see parameters_to_string in build.py
+        output_dir {str} -- folder for the throwaway CSG file
+    """
+    handle, csg_file = tempfile.mkstemp(suffix=".csg", dir=output_dir)
+    os.close(handle)
+    result = subprocess.run(
+        [executable, *shlex.split(parameters), input, "-o", csg_file],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    os.remove(csg_file)
+    messages = []
+    for line in result.stdout.decode(errors="replace").splitlines():
+        match = _MESSAGE_PATTERN.match(line.strip())
+        if match:
+            messages.append((match.group(1), match.group(2)))
+    return result.returncode, messages
+
+
+def is_fatal(level, message):
+    return level == "ERROR" or bool(_FATAL_WARNINGS.search(message))
+
+
+def preflight(executable, targets, parameters, jobs=None):
+    """
+    Check the parts that make up the given outputs in parallel.
+
+    Returns (ok, report).
+
+    Arguments:
+        executable {str} -- the openscad executable
+        targets {dict} -- maps each output to its .scad file
+        parameters {dict} -- maps each output to its openscad parameters
+        jobs {int} -- parts checked at once, by default one per processor
+    """
+    # outputs made from the same file and parameters only need checking once
+    parts = {}
+    for output in sorted(targets):
+        parts.setdefault((targets[output], parameters[output]), []).append(output)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        with ThreadPoolExecutor(jobs or os.cpu_count()) as executor:
+            results = list(
+                executor.map(
+                    lambda part: check_part(executable, part[0], part[1], output_dir), parts
+                )
+            )
+
+    # the same message usually comes up for many parts, so list it once
+    messages = {}
+    failed = []
+    for (part, outputs), (status, part_messages) in zip(parts.items(), results):
+        for level, message in part_messages:
+            messages.setdefault((level, message), []).extend(outputs)
+        if status != 0:
+            failed.extend(outputs)
+
+    fatal = [m for m in messages if is_fatal(*m)]
+    lines = []
+    for level, message in sorted(messages, key=lambda m: (not is_fatal(*m), m)):
+        outputs = messages[(level, message)]
+        shown = ", ".join(os.path.basename(o) for o in outputs[:3])
+        if len(outputs) > 3:
+            shown += f" and {len(outputs) - 3} more"
+        lines.append(f"{level}: {message}\n    in {shown}")
+    if failed:
+        lines.append(f"openscad failed for {', '.join(os.path.basename(o) for o in failed)}")
+    ok = not fatal and not failed
+    lines.append(
+        f"Preflight checked {len(parts)} part(s): {len(fatal)} error(s),"
+        f" {len(messages) - len(fatal)} other warning(s)."
+    )
+    return ok, "\n".join(lines)
@@ -0,0 +1,195 @@
+"""
+Small preview meshes of the STL files, for the web STL selector to show
+before the full file is downloaded.
+
+    python3 -m build_system.preview builds/main_body_LS65-M.stl \\
+        --output-dir builds/previews --budgets 2000 20000
+
+writes builds/previews/main_body_LS65-M.2000.ofpv and .20000.ofpv, each
+simplified by vertex clustering until it has no more than that many
+triangles.
+
+The .ofpv format is little-endian:
+
+    header (40 bytes): magic "OFPV", uint16 version (1), uint16 bytes per
+        index (2 or 4), uint32 vertex count, uint32 triangle count,
+        float32 x3 bounding box minimum, float32 x3 bounding box maximum
+    vertices: uint16 x3 per vertex, 0 to 65535 across the bounding box,
+        padded with zeros to a multiple of 4 bytes
+    triangles: three vertex indices each, counter-clockwise seen from outside
+"""
+import argparse
+import os
+import struct
+
+import numpy as np
+
+from .stl import read_stl
+
+MAGIC = b"OFPV"
+VERSION = 1
+_HEADER = struct.Struct("<4sHHII6f")
+
+
+def weld_vertices(triangles, decimals=4):
+    """
+    Turn a triangle soup into an indexed mesh, merging vertices that are at
+    the same place once rounded.
+
+    Returns (vertices (m, 3), faces (n, 3)).
+    """
+    points = np.round(triangles.reshape(-1, 3), decimals)
+    vertices, inverse = np.unique(points, axis=0, return_inverse=True)
+    faces = inverse.reshape(-1, 3)
+    return vertices, _clean_faces(faces)
+
+
+def _clean_faces(faces):
+    """Drop collapsed and duplicate faces, without flipping any"""
+    faces = faces[
+        (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    ]
+    if len(faces) == 0:
+        return faces
+    # rotate each face to start at its smallest index, which keeps its
+    # orientation, so duplicates are identical rows
+    first = np.argmin(faces, axis=1)
+    order = (first[:, None] + np.arange(3)) % 3
+    return np.unique(np.take_along_axis(faces, order, axis=1), axis=0)
+
+
+def _compact(vertices, faces):
+    """Remove vertices no face uses"""
+    used, inverse = np.unique(faces, return_inverse=True)
+    return vertices[used], inverse.reshape(-1, 3)
+
+
+def cluster_vertices(vertices, faces, cell_size):
+    """
+    Simplify a mesh by merging all the vertices in each cell of a grid into
+    one, at their mean position.
+
+    Returns (vertices, faces).
+    """
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    # one integer per cell, each axis has at most 2**21 cells
+    keys = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+    _, cluster, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    cluster = cluster.reshape(-1)
+    merged = np.stack(
+        [np.bincount(cluster, weights=vertices[:, i]) for i in range(3)], axis=1
+    ) / counts[:, None]
+    return _compact(merged, _clean_faces(cluster[faces]))
+
+
+def simplify(vertices, faces, budget, iterations=16):
+    """
+    The most detailed clustering of a mesh with no more than `budget`
+    triangles, found by bisecting the cell size.
+
+    Returns (vertices, faces).
+    """
+    if len(faces) <= budget:
+        return vertices, faces
+    diagonal = float(np.linalg.norm(np.ptp(vertices, axis=0)))
+    # the grid has at most 2**21 cells along each axis
+    low, high = np.log(diagonal / 2 ** 20), np.log(diagonal)
+    best = cluster_vertices(vertices, faces, diagonal)
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        candidate = cluster_vertices(vertices, faces, np.exp(middle))
+        if len(candidate[1]) <= budget:
+            best = candidate
+            high = middle
+        else:
+            low = middle
+    return best
+
+
+def write_preview(path, vertices, faces):
+    """Write an indexed mesh in the .ofpv format described above"""
+    if len(vertices):
+        low, high = vertices.min(axis=0), vertices.max(axis=0)
+    else:
+        low = high = np.zeros(3)
+    scale = np.where(high > low, high - low, 1)
+    quantised = np.round((vertices - low) / scale * 65535).astype("<u2")
+    index_type = "<u2" if len(vertices) <= 65536 else "<u4"
+    vertex_bytes = quantised.tobytes()
+    with open(path, "wb") as f:
+        f.write(
+            _HEADER.pack(
+                MAGIC, VERSION, np.dtype(index_type).itemsize, len(vertices), len(faces), *low, *high
+            )
+        )
+        f.write(vertex_bytes + b"\0" * (-len(vertex_bytes) % 4))
+        f.write(faces.astype(index_type).tobytes())
+
+
+def read_preview_header(path):
+    """The header of an .ofpv file, as a dict"""
+    with open(path, "rb") as f:
+        magic, version, index_bytes, n_vertices, n_faces, *bounds = _HEADER.unpack(
+            f.read(_HEADER.size)
+        )
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a preview mesh")
+    return {
+        "version": version,
+        "index_bytes": index_bytes,
+        "vertices": n_vertices,
+        "triangles": n_faces,
+        "bbox": [bounds[:3], bounds[3:]],
+    }
+
+
+def read_preview(path):
+    """Read an .ofpv file, returns (vertices, faces)"""
+    header = read_preview_header(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = _HEADER.size
+    n_vertices, n_faces = header["vertices"], header["triangles"]
+    quantised = np.frombuffer(data, "<u2", n_vertices * 3, offset).reshape(-1, 3)
+    offset += 6 * n_vertices
+    offset += -offset % 4
+    index_type = "<u2" if header["index_bytes"] == 2 else "<u4"
+    faces = np.frombuffer(data, index_type, n_faces * 3, offset).reshape(-1, 3)
+    low, high = np.array(header["bbox"])
+    vertices = low + quantised / 65535 * (high - low)
+    return vertices, faces.astype(np.int64)
+
+
+def preview_path(output_dir, stl_file, budget):
+    """Where the preview of an STL file with a triangle budget goes"""
+    name = os.path.splitext(os.path.basename(stl_file))[0]
+    return os.path.join(output_dir, f"{name}.{budget}.ofpv")
+
+
+def make_previews(stl_file, output_dir, budgets):
+    """
+    Write a preview of an STL file for each triangle budget.
+
+    Returns the paths written.
+    """
+    vertices, faces = weld_vertices(read_stl(stl_file))
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    for budget in sorted(budgets, reverse=True):
+        # each level starts from the more detailed one before, which is quicker
+        vertices, faces = simplify(vertices, faces, budget)
+        path = preview_path(output_dir, stl_file, budget)
+        write_preview(path, vertices, faces)
+        written.append(path)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make preview meshes of STL files.")
+    parser.add_argument("stl", nargs="+", help="STL files.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[2000, 20000])
+    args = parser.parse_args()
+
+    for stl_file in args.stl:
+        make_previews(stl_file, args.output_dir, args.budgets)
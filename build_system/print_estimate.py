@@ -0,0 +1,252 @@
+"""
+Estimate how long STL files take to print, and how much filament they use.
+
+    python3 -m build_system.print_estimate builds/*.stl --layer-height 0.3
+
+Each part is sliced into layers. Every triangle that crosses the middle of
+a layer adds a segment to that layer's outline, and the outline's length
+and the area it encloses are summed over the segments (the area by the
+shoelace formula, with each segment directed by its triangle's normal),
+so the segments never need joining into loops. All the triangles are cut
+at once in NumPy.
+
+From the outline and area of each layer, a simple model of a slicer gives
+the extruded volume and the time:
+
+    - `perimeters` lines follow the outline at `perimeter_speed`
+    - the rest of a layer is solid if it is within `solid_layers` of the
+      top or bottom of the part, judged by how much the area changes,
+      otherwise it is filled to `infill`, at `infill_speed`
+    - every layer adds `layer_time` for travel and the layer change
+
+The times are meant for comparing parts and planning, not to the minute.
+Estimates are cached by mesh fingerprint (see stl.mesh_fingerprint) and
+the settings, so a part is only sliced again when its geometry changes.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .plan import format_duration
+from .selection import selected_stls
+from .stl import face_normals, mesh_fingerprint, mesh_volume, read_stl
+
+CACHE_DIR = os.path.join("builds", ".print_estimate_cache")
+# change this when the estimates change, so cached ones aren't used
+ESTIMATOR_VERSION = 1
+# lengths in mm, speeds in mm/s, times in s and density in g/cm^3 (PLA)
+DEFAULT_SETTINGS = {
+    "layer_height": 0.2,
+    "line_width": 0.45,
+    "perimeters": 2,
+    "solid_layers": 4,
+    "infill": 0.2,
+    "perimeter_speed": 40,
+    "infill_speed": 60,
+    "layer_time": 2.0,
+    "filament_diameter": 1.75,
+    "density": 1.24,
+}
+
+
+def slice_layers(triangles, layer_height, max_segments=2000000):
+    """
+    The outline length and cross section area of each layer of a mesh,
+    cut through the middle of each layer from the bottom of the mesh up.
+
+    Returns (lengths, areas), each with one value per layer.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates, facing outwards
+        layer_height {float} -- thickness of the layers
+        max_segments {int} -- segments worked out at once, to limit memory use
+    """
+    if len(triangles) == 0:
+        return np.zeros(0), np.zeros(0)
+    # relative to the bottom centre of the part, to keep the area sums accurate
+    low, high = triangles.reshape(-1, 3).min(axis=0), triangles.reshape(-1, 3).max(axis=0)
+    triangles = triangles - [(low[0] + high[0]) / 2, (low[1] + high[1]) / 2, low[2]]
+    z = triangles[:, :, 2] / layer_height - 0.5
+    # the layers whose middle each triangle crosses
+    first = np.ceil(z.min(axis=1)).astype(np.int64)
+    counts = np.maximum(np.floor(z.max(axis=1)).astype(np.int64) - first + 1, 0)
+    n_layers = int(np.ceil((high[2] - low[2]) / layer_height)) + 1
+    lengths, areas = np.zeros(n_layers), np.zeros(n_layers)
+    normals = face_normals(triangles)
+    ends = np.cumsum(counts)
+
+    start = 0
+    while start < len(triangles):
+        stop = max(np.searchsorted(ends, ends[start] - counts[start] + max_segments), start + 1)
+        chunk = np.arange(start, min(stop, len(triangles)))
+        start = chunk[-1] + 1
+        c = counts[chunk]
+        if c.sum() == 0:
+            continue
+        triangle = np.repeat(chunk, c)
+        layer = first[triangle] + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        t = triangles[triangle]
+        plane = (layer + 0.5) * layer_height
+        above = t[:, :, 2] > plane[:, None]
+        n_above = above.sum(axis=1)
+        cut = (n_above == 1) | (n_above == 2)
+        t, plane, layer, normal = t[cut], plane[cut], layer[cut], normals[triangle[cut]]
+        above = above[cut]
+        # the vertex alone on its side of the plane, and the other two
+        alone = np.where(above.sum(axis=1) == 1, above.argmax(axis=1), (~above).argmax(axis=1))
+        rows = np.arange(len(t))
+        corner = t[rows, alone]
+        points = []
+        for offset in (1, 2):
+            other = t[rows, (alone + offset) % 3]
+            fraction = (plane - corner[:, 2]) / (other[:, 2] - corner[:, 2])
+            points.append(corner[:, :2] + fraction[:, None] * (other[:, :2] - corner[:, :2]))
+        p, q = points
+        # direct each segment with the outside of the part on its right
+        d = q - p
+        backwards = d[:, 1] * normal[:, 0] - d[:, 0] * normal[:, 1] < 0
+        p[backwards], q[backwards] = q[backwards], p[backwards].copy()
+        lengths += np.bincount(layer, weights=np.linalg.norm(d, axis=1), minlength=n_layers)[:n_layers]
+        cross = p[:, 0] * q[:, 1] - q[:, 0] * p[:, 1]
+        areas += np.bincount(layer, weights=cross / 2, minlength=n_layers)[:n_layers]
+    return lengths, areas
+
+
+def estimate_print(triangles, settings=DEFAULT_SETTINGS):
+    """
+    Estimate the print time and filament of a part, with the model above.
+
+    Returns {"layers", "seconds", "filament_m", "grams"}.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        settings {dict} -- see DEFAULT_SETTINGS
+    """
+    s = {**DEFAULT_SETTINGS, **settings}
+    if len(triangles) and mesh_volume(triangles) < 0:
+        # inside out, so every outline goes the wrong way
+        triangles = triangles[:, ::-1]
+    lengths, areas = slice_layers(triangles, s["layer_height"])
+    areas = np.clip(areas, 0, None)
+    printed = areas > 0
+
+    shell = np.minimum(areas, s["perimeters"] * s["line_width"] * lengths)
+    inside = areas - shell
+    # area that isn't covered by the layer solid_layers above, or below
+    n = s["solid_layers"]
+    padded = np.concatenate([np.zeros(n), areas, np.zeros(n)])
+    exposed = np.maximum(areas - padded[2 * n :], 0) + np.maximum(areas - padded[: len(areas)], 0)
+    solid = np.minimum(inside, exposed)
+    fill = solid + s["infill"] * (inside - solid)
+
+    volume = s["layer_height"] * (shell + fill).sum()
+    seconds = (
+        s["perimeters"] * lengths.sum() / s["perimeter_speed"]
+        + fill.sum() / s["line_width"] / s["infill_speed"]
+        + s["layer_time"] * printed.sum()
+    )
+    filament = volume / (np.pi * (s["filament_diameter"] / 2) ** 2)
+    return {
+        "layers": int(printed.sum()),
+        "seconds": int(round(seconds)),
+        "filament_m": round(float(filament) / 1000, 2),
+        "grams": round(float(volume) / 1000 * s["density"], 1),
+    }
+
+
+def _estimate_print(job):
+    stl_file, settings, cache_dir = job
+    triangles = read_stl(stl_file)
+    key = hashlib.sha256(
+        json.dumps(
+            [mesh_fingerprint(triangles), settings, ESTIMATOR_VERSION], sort_keys=True
+        ).encode()
+    ).hexdigest()
+    cached = os.path.join(cache_dir, key[:2], key + ".json")
+    if os.path.exists(cached):
+        with open(cached) as f:
+            return json.load(f)
+    estimate = estimate_print(triangles, settings)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    with open(cached + ".tmp", "w") as f:
+        json.dump(estimate, f)
+    os.replace(cached + ".tmp", cached)
+    return estimate
+
+
+def estimate_prints(stl_files, settings=DEFAULT_SETTINGS, cache_dir=CACHE_DIR, jobs=None):
+    """
+    Estimate the printing of STL files in parallel, reusing cached estimates.
+
+    Returns a dict of the estimate for each STL file.
+
+    Arguments:
+        stl_files {list} -- the STL files
+        settings {dict} -- see DEFAULT_SETTINGS
+        cache_dir {str} -- where estimates are cached by mesh fingerprint
+        jobs {int} -- number of files to slice at once
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    jobs_list = [(f, settings, cache_dir) for f in stl_files]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(stl_files, executor.map(_estimate_print, jobs_list)))
+
+
+def total_estimate(estimates):
+    """
+    The sum of the estimates of several parts, printed one after another.
+
+    Arguments:
+        estimates {list} -- estimates from estimate_print
+    """
+    return {
+        "parts": len(estimates),
+        "seconds": sum(e["seconds"] for e in estimates),
+        "filament_m": round(sum(e["filament_m"] for e in estimates), 2),
+        "grams": round(sum(e["grams"] for e in estimates), 1),
+    }
+
+
+def configuration_estimate(stl_options, configuration, estimates):
+    """
+    The total estimate of the parts a configuration selects, including the
+    printed tools and any optional parts it selects, but not the test prints
+    listed in `test_stls`.
+
+    Arguments:
+        stl_options {dict} -- the contents of stl_options.json
+        configuration {dict} -- value of every option
+        estimates {dict} -- the estimate of each stl (relative to the build folder)
+    """
+    test_stls = set(stl_options.get("test_stls", []))
+    return total_estimate(
+        [
+            estimates[stl]
+            for stl in selected_stls(stl_options, configuration)
+            if stl in estimates and stl not in test_stls
+        ]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate how long STL files take to print.")
+    parser.add_argument("stl", nargs="+", help="STL files.")
+    parser.add_argument("--layer-height", type=float, default=DEFAULT_SETTINGS["layer_height"])
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--jobs", "-j", type=int)
+    args = parser.parse_args()
+
+    estimates = estimate_prints(
+        args.stl, {"layer_height": args.layer_height}, args.cache_dir, args.jobs
+    )
+    for stl_file, estimate in estimates.items():
+        print(
+            f"{format_duration(estimate['seconds']):>10}  {estimate['grams']:7.1f} g  "
+            f"{estimate['filament_m']:6.2f} m  {stl_file}"
+        )
+    total = total_estimate(list(estimates.values()))
+    print(f"{format_duration(total['seconds']):>10}  {total['grams']:7.1f} g  {total['filament_m']:6.2f} m  total")
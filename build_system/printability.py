@@ -0,0 +1,175 @@
+"""
+Check how printable an STL file is, in the orientation it is printed in.
+
+    python3 -m build_system.printability builds/main_body_LS65-M.stl \\
+        -o builds/.printability/main_body_LS65-M.stl.json --limit min_wall=0.3
+
+writes these metrics as JSON:
+
+    overhang_area -- mm^2 of downward facing surface steeper than
+                     OVERHANG_ANGLE from vertical, but not flat enough to
+                     be a bridge, and not on the print bed
+    bridge_area -- mm^2 of flat downward facing surface, not on the print bed
+    max_overhang -- the steepest overhang counted in overhang_area, in
+                    degrees from vertical
+    min_wall -- wall thickness in mm that all but the thinnest 1% of the
+                surface exceeds (sharp edges are always thin)
+    thinnest -- the thinnest wall found, in mm
+
+Wall thickness is measured by sampling points on the surface and finding
+how far a ray from each goes into the part before leaving it. Walls
+thicker than MAX_WALL are not measured, if none are thinner min_wall and
+thinnest are null.
+
+If a `--limit` is exceeded the report is printed, no file is written and
+the exit status is 1, so ninja stops the build. min_wall is a lower limit,
+the others are upper limits.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from .geometry import BoxGrid, sample_surface
+from .stl import face_areas, face_normals, mesh_volume, read_stl
+from .variants import parse_axis_argument
+
+# overhangs steeper than this (in degrees from vertical) need support
+OVERHANG_ANGLE = 45
+# downward facing surfaces within this many degrees of flat are bridges
+BRIDGE_TOLERANCE = 1
+# faces this close to the bottom of the part are on the print bed
+BED_TOLERANCE = 0.01
+MAX_WALL = 5.0
+# limits that are lower bounds, the rest are upper bounds
+LOWER_LIMITS = ("min_wall",)
+
+
+def overhang_angles(triangles):
+    """
+    The overhang angle of each face in degrees: 0 for vertical or upward
+    facing faces, up to 90 for flat downward facing ones.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+    """
+    down = np.clip(-face_normals(triangles)[:, 2], 0, 1)
+    return np.degrees(np.arcsin(down))
+
+
+def wall_thickness(triangles, n_samples=20000, max_wall=MAX_WALL, seed=0):
+    """
+    Wall thickness at points spread over the surface, inf where it is more
+    than max_wall.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates, facing outwards
+        n_samples {int} -- number of points
+        max_wall {float} -- thickest wall to measure
+        seed {int} -- seed of the random number generator, for repeatable results
+    """
+    triangles = triangles[face_areas(triangles) > 0]
+    points, faces = sample_surface(triangles, n_samples, seed, return_faces=True)
+    if len(points) == 0:
+        return np.zeros(0)
+    inwards = -face_normals(triangles)[faces]
+    # cells a few triangles across, so each holds a handful of them
+    edges = np.linalg.norm(triangles - np.roll(triangles, 1, axis=1), axis=2).max(axis=1)
+    cell_size = np.clip(2 * np.median(edges), max_wall / 32, max_wall)
+    return BoxGrid(triangles, cell_size).first_hit(points, inwards, max_wall)
+
+
+def printability(triangles, n_samples=20000):
+    """
+    The printability metrics described above.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        n_samples {int} -- points to measure the wall thickness at
+    """
+    if len(triangles) == 0:
+        return {
+            "overhang_area": 0.0,
+            "bridge_area": 0.0,
+            "max_overhang": 0.0,
+            "min_wall": None,
+            "thinnest": None,
+        }
+    if mesh_volume(triangles) < 0:
+        # inside out, so every normal points the wrong way
+        triangles = triangles[:, ::-1]
+
+    angles = overhang_angles(triangles)
+    areas = face_areas(triangles)
+    on_bed = triangles[:, :, 2].max(axis=1) <= triangles[:, :, 2].min() + BED_TOLERANCE
+    bridge = ~on_bed & (angles >= 90 - BRIDGE_TOLERANCE)
+    overhang = ~on_bed & ~bridge & (angles > OVERHANG_ANGLE)
+
+    thickness = np.sort(wall_thickness(triangles, n_samples))
+    measured = thickness[np.isfinite(thickness)]
+    min_wall = thickness[len(thickness) // 100] if len(thickness) else np.inf
+    return {
+        "overhang_area": round(float(areas[overhang].sum()), 3),
+        "bridge_area": round(float(areas[bridge].sum()), 3),
+        "max_overhang": round(float(angles[overhang].max()), 1) if overhang.any() else 0.0,
+        "min_wall": round(float(min_wall), 3) if np.isfinite(min_wall) else None,
+        "thinnest": round(float(measured[0]), 3) if len(measured) else None,
+    }
+
+
+def check_limits(metrics, limits):
+    """
+    Compare metrics with limits, returns a list of the limits exceeded.
+
+    Arguments:
+        metrics {dict} -- from printability()
+        limits {dict} -- metric name -> limit, see LOWER_LIMITS
+    """
+    problems = []
+    for name, limit in sorted(limits.items()):
+        value = metrics[name]
+        if value is None:
+            continue
+        if name in LOWER_LIMITS and value < limit:
+            problems.append(f"{name} is {value}, it should be at least {limit}")
+        elif name not in LOWER_LIMITS and value > limit:
+            problems.append(f"{name} is {value}, it should be at most {limit}")
+    return problems
+
+
+def limit_arguments(limits):
+    """Command line arguments for a dict of limits"""
+    return " ".join(f"--limit {name}={value}" for name, value in sorted(limits.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check how printable an STL file is.")
+    parser.add_argument("stl")
+    parser.add_argument("-o", "--output", required=True, help="JSON file for the metrics.")
+    parser.add_argument(
+        "--limit", action="append", default=[], metavar="NAME=VALUE", help="Fail beyond this."
+    )
+    parser.add_argument("--samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    limits = {}
+    for argument in args.limit:
+        name, values = parse_axis_argument(argument)
+        limits[name] = float(values[0])
+
+    metrics = printability(read_stl(args.stl), args.samples)
+    problems = check_limits(metrics, limits)
+    if problems:
+        print(f"{args.stl} is hard to print:")
+        for problem in problems:
+            print(f"    {problem}")
+        # so ninja tries again next time
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        sys.exit(1)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(metrics, f, indent=2)
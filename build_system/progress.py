@@ -0,0 +1,141 @@
+"""
+Run ninja with a one-line status display instead of its usual output: how
+many steps are done, which renders are running, and an estimate of the
+time left based on previous render times.
+"""
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from .plan import NINJA_PROGRESS, format_duration, schedule_length
+
+
+class RenderLogFollower:
+    def __init__(self, path):
+        """Reads the records added to a render log since the last call"""
+        self.path = path
+        self._offset = 0
+        self._partial = ""
+
+    def new_records(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            f.seek(self._offset)
+            data = f.read()
+            self._offset = f.tell()
+        lines = (self._partial + data).split("\n")
+        # keep a line that is still being written for next time
+        self._partial = lines.pop()
+        records = []
+        for line in lines:
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+        return records
+
+
+def _read_lines(stream, lines):
+    for line in iter(stream.readline, b""):
+        lines.put(line.decode(errors="replace").rstrip("\n"))
+    lines.put(None)
+
+
+def status_line(finished, total, running, estimates, jobs, now):
+    """
+    The status line shown while building.
+
+    Arguments:
+        finished {int} -- steps ninja has finished
+        total {int} -- steps ninja will run
+        running {dict} -- start time of each render in progress
+        estimates {dict} -- estimated duration of each render still to finish
+        jobs {int} -- renders run at once
+        now {float} -- the current time
+    """
+    busy = [max(estimates.get(o, 0.0) - (now - started), 0.0) for o, started in running.items()]
+    waiting = [d for o, d in estimates.items() if o not in running]
+    eta = schedule_length(waiting, jobs, busy)
+    names = sorted(os.path.basename(o) for o in running)
+    shown = ", ".join(names[:3]) + (f" +{len(names) - 3}" if len(names) > 3 else "")
+    return f"[{finished}/{total}] ETA {format_duration(eta)}, rendering: {shown or '-'}"
+
+
+def run_with_progress(ninja_command, render_log, estimates, jobs, total=0, interval=0.2):
+    """
+    Run ninja, showing a status line rather than its output. Output of failed
+    commands is still printed. Returns ninja's exit status.
+
+    Arguments:
+        ninja_command {list} -- ninja and any options to pass it
+        render_log {str} -- the log the renders write start and finish records to
+        estimates {dict} -- estimated duration of each render that is out of date
+        jobs {int} -- renders run at once
+        total {int} -- steps ninja is expected to run, until it says otherwise
+        interval {float} -- seconds between updates of the status line
+    """
+    remaining = dict(estimates)
+    running = {}
+    finished = 0
+    follower = RenderLogFollower(render_log)
+    # skip anything already in the log
+    follower.new_records()
+
+    process = subprocess.Popen(
+        ninja_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    lines = queue.Queue()
+    threading.Thread(target=_read_lines, args=(process.stdout, lines), daemon=True).start()
+
+    width = shutil.get_terminal_size().columns - 1
+    showing_failure = False
+    done = False
+    try:
+        while not done:
+            time.sleep(interval)
+            messages = []
+            while True:
+                try:
+                    line = lines.get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    done = True
+                    break
+                match = NINJA_PROGRESS.match(line)
+                if match:
+                    finished, total = int(match.group(1)), int(match.group(2))
+                    showing_failure = False
+                elif line.startswith("FAILED:"):
+                    showing_failure = True
+                    messages.append(line)
+                elif showing_failure or line.startswith("ninja:"):
+                    messages.append(line)
+
+            for record in follower.new_records():
+                if record.get("event") == "start":
+                    running[record["output"]] = record["time"]
+                elif record.get("event") == "finish":
+                    running.pop(record["output"], None)
+                    remaining.pop(record["output"], None)
+
+            # clear the status line before printing anything else
+            sys.stdout.write("\r\x1b[K")
+            for message in messages:
+                print(message)
+            if not done:
+                line = status_line(finished, total, running, remaining, jobs, time.time())
+                sys.stdout.write(line[:width])
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        # ninja gets the interrupt too, and stops its commands
+        process.wait()
+        raise
+    return process.wait()
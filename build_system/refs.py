@@ -0,0 +1,507 @@
+"""
+Build several git refs at once, e.g. to compare a release candidate with
+the last release.
+
+    ./build.py --refs v7.0.0-beta1 master
+
+checks each ref out in its own worktree under builds/.worktrees, and runs
+that ref's own build.py to write its build.ninja (with ninja replaced by a
+no-op, so nothing is built yet). The edges of every ref are then combined
+into one ninja file, builds/refs/build.ninja, so a single ninja schedules
+all the renders against one -j limit.
+
+Renders go through a cache shared by all refs, in builds/.ref_cache. It is
+keyed like ccache's direct mode: by the openscad command line, then by the
+content of every file the render depended on last time. A part that is
+the same in two refs is rendered once, and whichever ref gets there second
+waits for it rather than rendering it again.
+
+Once everything is built, each ref's STL files are linked into
+builds/refs/<ref>/ and builds/refs/summary.json lists the STLs whose
+geometry differs between the first ref and each of the others.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from ninja import BIN_DIR as NINJA_BIN_DIR, Writer, escape
+
+from .depfile import read_depfile, relative_dependencies, write_depfile
+from .extra_files import link_or_copy
+from .manifest import build_manifest, has_changed
+from .render_history import append_record, read_records
+from .stl import file_sha256
+
+WORKTREE_DIR = os.path.join("builds", ".worktrees")
+REFS_DIR = os.path.join("builds", "refs")
+CACHE_DIR = os.path.join("builds", ".ref_cache")
+STATS_FILE = "stats.jsonl"
+# the rule build.py uses for renders, whose outputs are cached
+RENDER_RULE = "openscad"
+
+# runs a ref's build.py without building anything, so it only writes build.ninja
+_GENERATE = """
+import runpy, sys, ninja
+ninja.ninja = lambda: None
+sys.argv = ["build.py"]
+runpy.run_path("build.py", run_name="__main__")
+"""
+
+
+def ref_name(ref):
+    """A folder name for a ref"""
+    return ref.replace("/", "_").replace(os.sep, "_")
+
+
+def add_worktree(ref, path):
+    """
+    Check a ref out at path, reusing the worktree there if there is one so
+    that ninja only rebuilds what has changed since last time.
+    """
+    if os.path.isdir(path):
+        subprocess.run(["git", "-C", path, "checkout", "--quiet", "--detach", ref], check=True)
+    else:
+        subprocess.run(["git", "worktree", "add", "--detach", path, ref], check=True)
+
+
+def generate_graph(worktree):
+    """Run a worktree's build.py to write its build.ninja, returns its path"""
+    result = subprocess.run(
+        [sys.executable, "-c", _GENERATE],
+        cwd=worktree,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"build.py failed in {worktree}:\n{result.stdout.decode(errors='replace')}"
+        )
+    return os.path.join(worktree, "build.ninja")
+
+
+def _split(text):
+    """Split a line on the spaces ninja doesn't treat as escaped"""
+    tokens = []
+    current = ""
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "$" and i + 1 < len(text):
+            current += text[i : i + 2]
+            i += 2
+            continue
+        if c == " ":
+            if current:
+                tokens.append(current)
+            current = ""
+        else:
+            current += c
+        i += 1
+    if current:
+        tokens.append(current)
+    return tokens
+
+
+def _expand(text, lookup):
+    """Expand the variables and escapes in a ninja string"""
+    result = ""
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c != "$" or i + 1 == len(text):
+            result += c
+            i += 1
+            continue
+        following = text[i + 1]
+        if following in "$ :":
+            result += following
+            i += 2
+        elif following == "{":
+            end = text.index("}", i)
+            result += lookup(text[i + 2 : end])
+            i = end + 1
+        else:
+            end = i + 1
+            while end < len(text) and (text[end].isalnum() or text[end] in "_-"):
+                end += 1
+            result += lookup(text[i + 1 : end])
+            i = end
+    return result
+
+
+def read_ninja(path):
+    """
+    Read the build edges of a ninja file, with their commands expanded.
+
+    Returns a list of dicts with the keys rule, outputs, inputs, implicit,
+    order_only, command, description, depfile and restat.
+    """
+    with open(path) as f:
+        raw = f.read().split("\n")
+    # join lines continued with a $ at the end
+    lines = []
+    for line in raw:
+        if lines and lines[-1].endswith("$") and (len(lines[-1]) - len(lines[-1].rstrip("$"))) % 2:
+            lines[-1] = lines[-1][:-1] + line.lstrip()
+        else:
+            lines.append(line)
+
+    file_variables = {}
+    rules = {"phony": {}}
+    blocks = []
+    current = None
+    for line in lines:
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        if line[0] == " ":
+            name, _, value = line.strip().partition("=")
+            current[name.strip()] = value.strip()
+            continue
+        keyword, _, rest = line.partition(" ")
+        if keyword == "rule":
+            current = rules.setdefault(rest.strip(), {})
+        elif keyword == "build":
+            current = {}
+            blocks.append((rest, current))
+        elif keyword in ("default", "pool"):
+            current = {}
+        elif keyword in ("include", "subninja"):
+            raise ValueError(f"{path}: {keyword} isn't supported")
+        else:
+            name, _, value = line.partition("=")
+            file_variables[name.strip()] = _expand(value.strip(), lambda n: file_variables.get(n, ""))
+            current = None
+
+    def file_lookup(name):
+        return file_variables.get(name, "")
+
+    edges = []
+    for rest, bindings in blocks:
+        outputs_text, _, inputs_text = rest.replace("$:", "\0").partition(":")
+        outputs_text, inputs_text = outputs_text.replace("\0", "$:"), inputs_text.replace("\0", "$:")
+        outputs = [_expand(p, file_lookup) for p in _split(outputs_text) if p != "|"]
+        tokens = _split(inputs_text)
+        rule, tokens = tokens[0], tokens[1:]
+        groups = {"inputs": [], "implicit": [], "order_only": []}
+        group = "inputs"
+        for token in tokens:
+            if token == "|":
+                group = "implicit"
+            elif token == "||":
+                group = "order_only"
+            else:
+                groups[group].append(_expand(token, file_lookup))
+        edge_variables = {k: _expand(v, file_lookup) for k, v in bindings.items()}
+
+        def lookup(name, rule=rule, edge_variables=edge_variables, edge=(outputs, groups)):
+            if name == "in":
+                return " ".join(edge[1]["inputs"])
+            if name == "out":
+                return " ".join(edge[0])
+            if name in edge_variables:
+                return edge_variables[name]
+            if name in rules[rule]:
+                return _expand(rules[rule][name], lookup)
+            return file_lookup(name)
+
+        edges.append(
+            {
+                "rule": rule,
+                "outputs": outputs,
+                **groups,
+                "command": lookup("command"),
+                "description": lookup("description"),
+                "depfile": lookup("depfile"),
+                "restat": bool(lookup("restat")),
+            }
+        )
+    return edges
+
+
+def _prefix(path, worktree):
+    return path if os.path.isabs(path) else os.path.join(worktree, path)
+
+
+def write_combined_graph(path, worktrees, cache_dir=CACHE_DIR):
+    """
+    Write one ninja file with the edges of every worktree's build.ninja,
+    each run in its own worktree. Renders go through the shared cache.
+
+    Arguments:
+        path {str} -- the ninja file to write
+        worktrees {list} -- the worktrees, with their build.ninja written
+        cache_dir {str} -- the shared render cache
+    """
+    with open(path, "w") as f:
+        ninja = Writer(f, width=120)
+        # keep the log apart from the one of the main build
+        ninja.variable("builddir", os.path.dirname(path))
+        ninja.rule("ref_edge", command="$command", description="$description", depfile="$depfile")
+        for worktree in worktrees:
+            for edge in read_ninja(os.path.join(worktree, "build.ninja")):
+                outputs = [_prefix(p, worktree) for p in edge["outputs"]]
+                if edge["rule"] == "phony":
+                    ninja.build(outputs, "phony", [_prefix(p, worktree) for p in edge["inputs"]])
+                    continue
+                if edge["depfile"] or edge["rule"] == RENDER_RULE:
+                    command = [sys.executable, "-m", "build_system.refs", "run", "--cwd", worktree]
+                    if len(edge["outputs"]) == 1:
+                        command += ["--output", edge["outputs"][0]]
+                    if edge["depfile"]:
+                        command += ["--depfile", edge["depfile"]]
+                    if edge["rule"] == RENDER_RULE:
+                        command += ["--cache-dir", cache_dir]
+                    command = " ".join(shlex.quote(c) for c in command + ["--", edge["command"]])
+                else:
+                    command = f"cd {shlex.quote(worktree)} && {edge['command']}"
+                # build.py's rules mostly have no description, and ninja would
+                # show the command instead, so name the rule and the target
+                description = edge["description"] or f"{edge['rule']} {edge['outputs'][0]}"
+                variables = {
+                    "command": escape(command),
+                    "description": escape(f"[{os.path.basename(worktree)}] {description}"),
+                }
+                if edge["depfile"]:
+                    variables["depfile"] = escape(_prefix(edge["depfile"], worktree))
+                if edge["restat"]:
+                    variables["restat"] = "1"
+                ninja.build(
+                    outputs,
+                    "ref_edge",
+                    inputs=[_prefix(p, worktree) for p in edge["inputs"]],
+                    implicit=[_prefix(p, worktree) for p in edge["implicit"]],
+                    order_only=[_prefix(p, worktree) for p in edge["order_only"]],
+                    variables=variables,
+                )
+
+
+def _cache_key(command, output):
+    # only the openscad command, not whatever build.py wrapped it in (e.g.
+    # render_history), as that differs between versions of the build system
+    command = command.rsplit(" -- ", 1)[-1]
+    # the same part may have another name in another ref
+    if output:
+        command = command.replace(output, "$out")
+    return hashlib.sha256(command.encode()).hexdigest()
+
+
+def _dependencies_match(dependencies, cwd):
+    for path, digest in dependencies.items():
+        full = os.path.join(cwd, path)
+        if not os.path.isfile(full) or file_sha256(full) != digest:
+            return False
+    return True
+
+
+def run_edge(cwd, command, output=None, depfile=None, cache_dir=None):
+    """
+    Run one edge of a ref's graph in its worktree. Returns the exit status.
+
+    The depfile's target is rewritten to the output's path from where ninja
+    runs. If cache_dir is given, the output is taken from the cache if a
+    render with the same command and dependencies is there, and stored in
+    it otherwise.
+
+    Arguments:
+        cwd {str} -- the worktree
+        command {str} -- the shell command, run in the worktree
+        output {str} -- the output, relative to the worktree
+        depfile {str} -- the depfile, relative to the worktree
+        cache_dir {str} -- the shared render cache
+    """
+    target = os.path.join(cwd, output) if output else None
+
+    def fix_depfile(dependencies):
+        write_depfile(
+            os.path.join(cwd, depfile),
+            target,
+            [os.path.join(os.path.abspath(cwd), d) for d in dependencies],
+        )
+
+    if not cache_dir or not output or not depfile:
+        status = subprocess.call(command, shell=True, cwd=cwd)
+        if status == 0 and depfile and target:
+            _, dependencies = read_depfile(os.path.join(cwd, depfile))
+            fix_depfile(relative_dependencies(dependencies, cwd))
+        return status
+
+    # only needed here, and not available on Windows
+    import fcntl
+
+    key = _cache_key(command, output)
+    index = os.path.join(cache_dir, "index", key + ".jsonl")
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    with open(index + ".lock", "w") as lock:
+        # another ref rendering the same part finishes first, then this is a cache hit
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for record in reversed(read_records(index)):
+            cached = os.path.join(cache_dir, "files", record["output"][:2], record["output"])
+            if os.path.exists(cached) and _dependencies_match(record["dependencies"], cwd):
+                if os.path.exists(target):
+                    os.remove(target)
+                os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+                link_or_copy(cached, target)
+                os.utime(target, None)
+                fix_depfile(list(record["dependencies"]))
+                append_record(os.path.join(cache_dir, STATS_FILE), {"event": "hit", "time": time.time()})
+                return 0
+
+        status = subprocess.call(command, shell=True, cwd=cwd)
+        if status != 0:
+            return status
+        _, dependencies = read_depfile(os.path.join(cwd, depfile))
+        dependencies = relative_dependencies(dependencies, cwd)
+        digest = file_sha256(target)
+        cached = os.path.join(cache_dir, "files", digest[:2], digest)
+        if not os.path.exists(cached):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            link_or_copy(target, cached + ".tmp")
+            os.replace(cached + ".tmp", cached)
+        append_record(
+            index,
+            {
+                "dependencies": {d: file_sha256(os.path.join(cwd, d)) for d in dependencies},
+                "output": digest,
+            },
+        )
+        fix_depfile(dependencies)
+        append_record(os.path.join(cache_dir, STATS_FILE), {"event": "rendered", "time": time.time()})
+        return 0
+
+
+def collect_outputs(worktree, destination):
+    """
+    Link the files a worktree's build made into destination, replacing
+    what was there. Hidden files and depfiles are left out.
+    """
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    source = os.path.join(worktree, "builds")
+    for root, dirs, files in os.walk(source):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if f.startswith(".") or f.endswith(".d"):
+                continue
+            path = os.path.join(root, f)
+            target = os.path.join(destination, os.path.relpath(path, source))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_or_copy(path, target)
+
+
+def compare_builds(base, other):
+    """
+    Compare the STL files of two builds by geometry.
+
+    Returns a dict of sorted lists: changed, added, removed, and the number unchanged.
+    """
+    old = {p: e for p, e in base["files"].items() if p.endswith(".stl")}
+    new = {p: e for p, e in other["files"].items() if p.endswith(".stl")}
+    changed = sorted(p for p in new if p in old and has_changed(old[p], new[p]))
+    return {
+        "changed": changed,
+        "added": sorted(p for p in new if p not in old),
+        "removed": sorted(p for p in old if p not in new),
+        "unchanged": len([p for p in new if p in old]) - len(changed),
+    }
+
+
+def format_summary(summary):
+    lines = []
+    base = summary["refs"][0]
+    for ref, comparison in summary["comparisons"].items():
+        lines.append(
+            f"{base} -> {ref}: {len(comparison['changed'])} STL(s) changed,"
+            f" {len(comparison['added'])} added, {len(comparison['removed'])} removed,"
+            f" {comparison['unchanged']} unchanged"
+        )
+        for kind in ("changed", "added", "removed"):
+            lines.extend(f"    {kind}: {p}" for p in comparison[kind])
+    renders = summary["renders"]
+    lines.append(
+        f"{renders['rendered'] + renders['hit']} render(s) needed, {renders['hit']} shared or"
+        f" cached, {renders['rendered']} rendered"
+    )
+    return "\n".join(lines)
+
+
+def build_refs(refs, jobs=None, cache_dir=CACHE_DIR):
+    """
+    Build git refs side by side, see above. Returns the exit status.
+
+    Arguments:
+        refs {list} -- the refs to build, the first is compared with the others
+        jobs {int} -- edges ninja runs at once
+        cache_dir {str} -- the shared render cache
+    """
+    worktrees = []
+    for ref in refs:
+        worktree = os.path.join(WORKTREE_DIR, ref_name(ref))
+        add_worktree(ref, worktree)
+        print(f"Writing the build graph of {ref}")
+        generate_graph(worktree)
+        worktrees.append(worktree)
+
+    os.makedirs(REFS_DIR, exist_ok=True)
+    graph = os.path.join(REFS_DIR, "build.ninja")
+    write_combined_graph(graph, worktrees, cache_dir)
+    started = time.time()
+    command = [os.path.join(NINJA_BIN_DIR, "ninja"), "-f", graph]
+    if jobs:
+        command += ["-j", str(jobs)]
+    status = subprocess.call(command)
+    if status != 0:
+        return status
+
+    manifests = []
+    for ref, worktree in zip(refs, worktrees):
+        destination = os.path.join(REFS_DIR, ref_name(ref))
+        collect_outputs(worktree, destination)
+        manifests.append(build_manifest(destination, jobs=jobs))
+
+    renders = {"hit": 0, "rendered": 0}
+    for record in read_records(os.path.join(cache_dir, STATS_FILE)):
+        if record["time"] >= started:
+            renders[record["event"]] += 1
+    summary = {
+        "refs": list(refs),
+        "comparisons": {
+            ref: compare_builds(manifests[0], manifest)
+            for ref, manifest in zip(refs[1:], manifests[1:])
+        },
+        "renders": renders,
+    }
+    with open(os.path.join(REFS_DIR, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    print(format_summary(summary))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build several git refs at once.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser("build", help="Build refs, like build.py --refs.")
+    build_parser.add_argument("refs", nargs="+")
+    build_parser.add_argument("--jobs", "-j", type=int)
+    build_parser.add_argument("--cache-dir", default=CACHE_DIR)
+
+    run_parser = subparsers.add_parser("run", help="Run an edge of a ref's graph (used by ninja).")
+    run_parser.add_argument("--cwd", required=True, help="The worktree.")
+    run_parser.add_argument("--output", help="The output, relative to the worktree.")
+    run_parser.add_argument("--depfile", help="The depfile, relative to the worktree.")
+    run_parser.add_argument("--cache-dir", help="Cache the output here.")
+    run_parser.add_argument("shell_command", nargs=argparse.REMAINDER, help="-- the command to run")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        sys.exit(build_refs(args.refs, args.jobs, args.cache_dir))
+    command = args.shell_command[1:] if args.shell_command[:1] == ["--"] else args.shell_command
+    sys.exit(run_edge(args.cwd, " ".join(command), args.output, args.depfile, args.cache_dir))
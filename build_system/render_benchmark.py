@@ -0,0 +1,264 @@
+"""
+Measure how long representative parts take to render, and how much memory
+openscad needs, for different resolutions and OpenSCAD versions.
+
+    python3 -m build_system.render_benchmark run -o before.json --fn 0 16 32
+    python3 -m build_system.render_benchmark run -o after.json --fn 0 16 32 \\
+        --openscad openscad --openscad ~/OpenSCAD-nightly.AppImage
+    python3 -m build_system.render_benchmark compare before.json after.json
+
+Each combination of target, binary and `$fn` is rendered a few times after
+some warm-up renders, and the median and variance of wall time and peak
+memory are written to a JSON file. `--fn 0` leaves the resolution as the
+.scad files set it, other values are passed as `-D '$fn=N'`, which changes
+every curve that doesn't set its own `$fn` (including the hull()/minkowski()
+shapes in utilities.scad and compact_nut_seat.scad that use the default).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .openscad import default_executable, parameter_arguments
+
+# parts that together cover most of the render time of a full build, with
+# the parameters build.py uses for the default microscope
+BENCHMARK_TARGETS = {
+    "main_body": (
+        "main_body.scad",
+        {"big_stage": True, "sample_z": 65, "motor_lugs": True, "enable_smart_brim": True},
+    ),
+    "optics": (
+        "optics.scad",
+        {"sample_z": 65, "optics": "rms_f50d13", "camera": "picamera_2", "beamsplitter": False},
+    ),
+    "microscope_stand": ("microscope_stand.scad", {"box_h": 30, "beamsplitter": False}),
+    "z_axis": ("z_axis.scad", {"big_stage": True, "sample_z": 65}),
+}
+
+
+def openscad_version(executable):
+    """The version string openscad reports, or None if it can't be run"""
+    try:
+        result = subprocess.run(
+            [executable, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+    except OSError:
+        return None
+    output = result.stdout.decode(errors="replace").strip()
+    if result.returncode != 0 or not output:
+        return None
+    return output.splitlines()[-1]
+
+
+def peak_memory_mb(rusage):
+    """The peak memory in MB of a process, from its resource usage"""
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    if sys.platform.startswith("darwin"):
+        return rusage.ru_maxrss / 2 ** 20
+    return rusage.ru_maxrss / 2 ** 10
+
+
+def measure_render(command, quiet=True):
+    """
+    Run a render, returning (exit status, wall time in seconds, peak memory in MB).
+
+    Arguments:
+        command {list} -- the openscad command line
+        quiet {bool} -- throw away what openscad prints
+    """
+    output = subprocess.DEVNULL if quiet else None
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=output, stderr=output)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    # the child has already been reaped, so stop Popen from waiting for it again
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return process.returncode, elapsed, peak_memory_mb(rusage)
+
+
+def _summary(values):
+    return {
+        "median": statistics.median(values),
+        "variance": statistics.variance(values) if len(values) > 1 else 0.0,
+        "values": values,
+    }
+
+
+def run_benchmark(
+    targets, executables, fn_values, repeats=3, warmup=1, source_dir="openscad", quiet=False
+):
+    """
+    Render every combination of target, executable and $fn value.
+
+    Returns a dict ready to be written as JSON.
+
+    Arguments:
+        targets {list} -- keys of BENCHMARK_TARGETS
+        executables {list} -- openscad binaries to compare
+        fn_values {list} -- values of $fn, 0 keeps the settings in the .scad files
+        repeats {int} -- measured renders of each combination
+        warmup {int} -- renders of each combination that are thrown away
+        source_dir {str} -- folder with the .scad files
+        quiet {bool} -- don't print progress
+    """
+    results = []
+    versions = {e: openscad_version(e) for e in executables}
+    missing = [e for e in executables if versions[e] is None]
+    if missing:
+        raise FileNotFoundError(f"Can't run {', '.join(missing)}")
+    with tempfile.TemporaryDirectory() as output_dir:
+        for target in targets:
+            input, parameters = BENCHMARK_TARGETS[target]
+            for executable in executables:
+                for fn in fn_values:
+                    defines = {**parameters, **({"$fn": fn} if fn else {})}
+                    command = [
+                        executable,
+                        *parameter_arguments(defines),
+                        os.path.join(source_dir, input),
+                        "-o",
+                        os.path.join(output_dir, f"{target}.stl"),
+                    ]
+                    times, memory, failures = [], [], 0
+                    for i in range(warmup + repeats):
+                        status, elapsed, peak = measure_render(command)
+                        if status != 0:
+                            failures += 1
+                        elif i >= warmup:
+                            times.append(elapsed)
+                            memory.append(peak)
+                    result = {
+                        "target": target,
+                        "openscad": executable,
+                        "version": versions[executable],
+                        "fn": fn,
+                        "failures": failures,
+                    }
+                    if times:
+                        result["time"] = _summary(times)
+                        result["peak_memory_mb"] = _summary(memory)
+                    results.append(result)
+                    if not quiet:
+                        print(_format_result(result))
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "repeats": repeats,
+        "warmup": warmup,
+        "results": results,
+    }
+
+
+def _format_result(result):
+    label = f"{result['target']} $fn={result['fn']} {result['version'] or result['openscad']}"
+    if "time" not in result:
+        return f"{label}: failed"
+    return (
+        f"{label}: {result['time']['median']:.2f}s "
+        f"(variance {result['time']['variance']:.3f}), "
+        f"{result['peak_memory_mb']['median']:.0f} MB"
+    )
+
+
+def _result_key(result):
+    # compare by version rather than path, the same binary may be in a different place
+    return result["target"], result["fn"], result["version"] or result["openscad"]
+
+
+def compare_results(old, new, threshold=10.0):
+    """
+    Lines comparing the median time and memory of two benchmark runs, with
+    changes bigger than threshold percent marked.
+
+    Arguments:
+        old {dict} -- results of the earlier run
+        new {dict} -- results of the later run
+        threshold {float} -- percentage change worth highlighting
+    """
+    old_results = {_result_key(r): r for r in old["results"] if "time" in r}
+    lines = []
+    for result in new["results"]:
+        key = _result_key(result)
+        label = f"{key[0]} $fn={key[1]} {key[2]}"
+        if "time" not in result:
+            lines.append(f"  {label}: failed")
+            continue
+        if key not in old_results:
+            lines.append(f"  {label}: new, {result['time']['median']:.2f}s")
+            continue
+        changes = []
+        for measure, unit in (("time", "s"), ("peak_memory_mb", " MB")):
+            before = old_results[key][measure]["median"]
+            after = result[measure]["median"]
+            change = 100 * (after - before) / before if before else 0.0
+            flag = "!" if abs(change) > threshold else " "
+            changes.append(f"{before:.2f}{unit} -> {after:.2f}{unit} ({change:+.1f}%){flag}")
+        lines.append(f"  {label}: " + ", ".join(changes))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark openscad renders.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Render the benchmark targets.")
+    run_parser.add_argument("-o", "--output", required=True, help="JSON file for the results.")
+    run_parser.add_argument(
+        "--openscad",
+        action="append",
+        help="An openscad binary to benchmark, can be given more than once.",
+    )
+    run_parser.add_argument(
+        "--fn",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="Values of $fn to try, 0 keeps the resolution set in the .scad files.",
+    )
+    run_parser.add_argument(
+        "--targets",
+        nargs="+",
+        choices=sorted(BENCHMARK_TARGETS),
+        default=list(BENCHMARK_TARGETS),
+    )
+    run_parser.add_argument("--repeats", type=int, default=3, help="Measured renders of each.")
+    run_parser.add_argument("--warmup", type=int, default=1, help="Unmeasured renders of each.")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files.")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=10.0, help="Percentage change to highlight."
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_benchmark(
+            args.targets,
+            args.openscad or [default_executable()],
+            args.fn,
+            repeats=args.repeats,
+            warmup=args.warmup,
+        )
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"generated {args.output}")
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        print(f"{args.old} -> {args.new}")
+        print("\n".join(compare_results(old, new, args.threshold)))
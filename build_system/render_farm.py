@@ -0,0 +1,688 @@
+"""
+Render the openscad edges of the build on other machines.
+
+A coordinator runs next to ninja and hands out render jobs over HTTP to any
+number of workers. `build.py --backend farm` replaces the `openscad` command
+in build.ninja with a `submit` client that queues the job and waits for the
+STL and its dependencies to come back, so ninja schedules and tracks the
+edges exactly as it does locally.
+
+    python3 -m build_system.render_farm coordinator --port 8765
+    python3 -m build_system.render_farm worker --coordinator http://host:8765
+    ./build.py --backend farm --farm-coordinator http://host:8765 -j 64
+
+The coordinator serves the current `openscad/` folder to workers as a
+tarball, so they don't need a checkout. Failed jobs are retried on another
+worker, and a job that has been running for much longer than usual gets a
+second, speculative lease - whichever copy finishes first wins.
+Results are kept until the client acknowledges them, so a client that
+loses a response can retry.
+
+Jobs are run without authentication, so only run this on a trusted network.
+
+    python3 -m build_system.render_farm benchmark --workers 1 2 4 8
+
+runs a coordinator and stand-in workers (which sleep instead of rendering)
+on localhost and reports the throughput for each number of workers.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import socketserver
+import statistics
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .depfile import read_depfile, relative_dependencies, write_depfile
+from .render_benchmark import peak_memory_mb
+from .render_history import append_record
+
+SOURCE_FOLDER = "openscad"
+
+
+def _encode(data):
+    return base64.b64encode(zlib.compress(data)).decode("ascii")
+
+
+def _decode(text):
+    return zlib.decompress(base64.b64decode(text))
+
+
+class SourceBundle:
+    def __init__(self, root):
+        """
+        A tarball of the openscad/ folder of root, rebuilt whenever a file in
+        it changes.
+
+        Arguments:
+            root {str} -- the repository root
+        """
+        self._root = root
+        self._signature = None
+        self._lock = threading.Lock()
+        self.digest = None
+        self.data = None
+
+    def _current_signature(self):
+        signature = []
+        for dirpath, dirs, files in os.walk(os.path.join(self._root, SOURCE_FOLDER)):
+            dirs.sort()
+            for f in sorted(files):
+                st = os.stat(os.path.join(dirpath, f))
+                signature.append((dirpath, f, st.st_size, st.st_mtime_ns))
+        return signature
+
+    def refresh(self):
+        """Rebuild the tarball if the sources changed, returns its digest"""
+        with self._lock:
+            signature = self._current_signature()
+            if signature != self._signature:
+                buffer = io.BytesIO()
+                with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+                    tar.add(os.path.join(self._root, SOURCE_FOLDER), arcname=SOURCE_FOLDER)
+                self.data = buffer.getvalue()
+                self.digest = hashlib.sha256(self.data).hexdigest()
+                self._signature = signature
+            return self.digest
+
+
+class Job:
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = spec
+        self.status = "pending"
+        self.failures = 0
+        self.leases = {}
+        self.result = None
+        self.finished = None
+        self.done = threading.Event()
+
+
+class Coordinator:
+    def __init__(
+        self,
+        root,
+        max_attempts=3,
+        straggler_factor=3.0,
+        min_straggler_time=60.0,
+        lost_lease_time=1800.0,
+        result_grace_time=600.0,
+    ):
+        """
+        Keeps the queue of render jobs and hands them out to workers.
+
+        Arguments:
+            root {str} -- the repository root, whose openscad/ folder is served
+            max_attempts {int} -- how many times a failing job is tried
+            straggler_factor {float} -- a job running this many times longer
+                                        than the median job gets a speculative second lease
+            min_straggler_time {float} -- never speculate on jobs younger than this (seconds)
+            lost_lease_time {float} -- until a job has finished, leases older than this are assumed lost (seconds)
+            result_grace_time {float} -- how long the result of a job is kept if it isn't acknowledged (seconds)
+        """
+        self.source = SourceBundle(root)
+        self.max_attempts = max_attempts
+        self.straggler_factor = straggler_factor
+        self.min_straggler_time = min_straggler_time
+        self.lost_lease_time = lost_lease_time
+        self.result_grace_time = result_grace_time
+        self._jobs = {}
+        self._pending = deque()
+        self._durations = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._leases = itertools.count(1)
+
+    def submit(self, spec):
+        """Queue a job, returning its id"""
+        spec = {**spec, "source": self.source.refresh()}
+        with self._lock:
+            self._forget_expired()
+            job = Job(str(next(self._ids)), spec)
+            self._jobs[job.id] = job
+            self._pending.append(job.id)
+            return job.id
+
+    def _forget_expired(self):
+        # results can be big, so don't keep them forever if nobody acknowledges them
+        limit = time.monotonic() - self.result_grace_time
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < limit]:
+            del self._jobs[job_id]
+
+    def _straggler_time(self):
+        if not self._durations:
+            return self.lost_lease_time
+        typical = statistics.median(self._durations)
+        return max(self.min_straggler_time, self.straggler_factor * typical)
+
+    def lease(self, worker):
+        """
+        Give a worker the next job: a pending one if there is one, otherwise
+        a duplicate of a job that is taking suspiciously long.
+        """
+        now = time.monotonic()
+        with self._lock:
+            job = None
+            while self._pending:
+                candidate = self._jobs[self._pending.popleft()]
+                if candidate.status == "pending":
+                    job = candidate
+                    break
+            if job is None:
+                limit = self._straggler_time()
+                for candidate in self._jobs.values():
+                    if candidate.status == "running" and candidate.leases:
+                        newest = max(start for _, start in candidate.leases.values())
+                        if now - newest > limit:
+                            job = candidate
+                            break
+            if job is None:
+                return None
+            lease_id = str(next(self._leases))
+            job.leases[lease_id] = (worker, now)
+            job.status = "running"
+            return {"id": job.id, "lease": lease_id, **job.spec}
+
+    def complete(self, job_id, lease_id, result):
+        """Record a worker's result; the first successful one wins"""
+        with self._lock:
+            job = self._jobs[job_id]
+            lease = job.leases.pop(lease_id, None)
+            if job.status in ("done", "failed"):
+                return
+            if result["ok"]:
+                if lease is not None:
+                    self._durations.append(time.monotonic() - lease[1])
+                job.status = "done"
+                job.result = result
+                job.finished = time.monotonic()
+                job.done.set()
+                return
+            job.failures += 1
+            if job.failures >= self.max_attempts:
+                job.status = "failed"
+                job.result = result
+                job.finished = time.monotonic()
+                job.done.set()
+            elif not job.leases:
+                job.status = "pending"
+                self._pending.appendleft(job.id)
+
+    def wait(self, job_id, timeout):
+        """
+        Wait for a job to finish, returning its result or None on timeout.
+        The result is kept, so a client that lost the response can ask
+        again, until it is acknowledged or result_grace_time has passed.
+        """
+        job = self._jobs[job_id]
+        if job.done.wait(timeout):
+            return {"status": job.status, **job.result}
+        return None
+
+    def acknowledge(self, job_id):
+        """Forget a finished job, once its result has been collected"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished is not None:
+                del self._jobs[job_id]
+
+
+class _CoordinatorHandler(BaseHTTPRequestHandler):
+    coordinator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length))
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        parts = path.strip("/").split("/")
+        if parts[0] == "job":
+            job = self.coordinator.lease(self.client_address[0])
+            if job is None:
+                self.send_response(204)
+                self.end_headers()
+            else:
+                self._send_json(job)
+        elif parts[0] == "source" and len(parts) == 2:
+            source = self.coordinator.source
+            if parts[1] != source.digest:
+                self.send_error(404, "Unknown source bundle")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/gzip")
+            self.send_header("Content-Length", str(len(source.data)))
+            self.end_headers()
+            self.wfile.write(source.data)
+        elif parts[0] == "wait" and len(parts) == 2:
+            timeout = float(query.partition("timeout=")[2] or 30)
+            try:
+                result = self.coordinator.wait(parts[1], timeout)
+            except KeyError:
+                self.send_error(404, "Unknown job")
+                return
+            if result is None:
+                self.send_response(204)
+                self.end_headers()
+            else:
+                self._send_json(result)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "submit":
+            self._send_json({"id": self.coordinator.submit(self._read_json())})
+        elif parts[0] == "result" and len(parts) == 2:
+            data = self._read_json()
+            try:
+                self.coordinator.complete(parts[1], data.pop("lease"), data)
+            except KeyError:
+                pass
+            self._send_json({})
+        elif parts[0] == "ack" and len(parts) == 2:
+            self.coordinator.acknowledge(parts[1])
+            self._send_json({})
+        else:
+            self.send_error(404)
+
+
+# socketserver.ThreadingMixIn rather than ThreadingHTTPServer, which needs Python 3.7
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    # every ninja edge holds a connection open while it waits
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def start_coordinator(coordinator, host="", port=0):
+    """
+    Serve a Coordinator over HTTP in a background thread, returns the server.
+    The port it listens on is `server.server_address[1]`.
+    """
+    handler = type("Handler", (_CoordinatorHandler,), {"coordinator": coordinator})
+    server = _Server((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _request(url, data=None, timeout=60):
+    """GET (or POST json data to) url, returns (status, body)"""
+    body = None
+    headers = {}
+    if data is not None:
+        body = json.dumps(data).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    request = urllib.request.Request(url, data=body, headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, response.read()
+
+
+def _transient(error):
+    # a 4xx response won't change if the request is repeated
+    return not isinstance(error, urllib.error.HTTPError) or error.code >= 500
+
+
+def _retry_request(url, data=None, timeout=60, attempts=6, delay=1.0):
+    """
+    _request, retried with exponential backoff when the coordinator can't
+    be reached or has a transient error (e.g. while it is restarting).
+    """
+    for attempt in range(attempts):
+        try:
+            return _request(url, data, timeout)
+        except (urllib.error.URLError, ConnectionError, OSError) as e:
+            if attempt == attempts - 1 or not _transient(e):
+                raise
+            print(f"Can't reach coordinator, retrying: {e}", file=sys.stderr)
+            time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def openscad_renderer(executable):
+    """
+    A render function running the real openscad in the source folder.
+    It returns (ok, log, stl bytes, dependencies relative to the folder,
+    {"duration", "peak_memory_mb"} of the render).
+    """
+
+    def render(root, job):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "output" + job["suffix"])
+            depfile = output + ".d"
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [executable, *job["parameters"], job["input"], "-o", output, "-d", depfile],
+                cwd=root,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+            with process.stdout:
+                log = process.stdout.read()
+            # wait4 rather than wait, for the peak memory of the render
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            measurements = {
+                "duration": time.perf_counter() - start,
+                "peak_memory_mb": peak_memory_mb(rusage),
+            }
+            if process.returncode != 0 or not os.path.exists(output):
+                return False, log, b"", [], measurements
+            with open(output, "rb") as f:
+                data = f.read()
+            _, dependencies = read_depfile(depfile)
+            return True, log, data, relative_dependencies(dependencies, root), measurements
+
+    return render
+
+
+def box_stl_bytes(size):
+    """A binary STL of a size x size x size box, used by stand-in workers"""
+    corners = [(x, y, z) for z in (0, size) for y in (0, size) for x in (0, size)]
+    faces = [(0, 2, 1), (1, 2, 3), (4, 5, 6), (5, 7, 6), (0, 1, 4), (1, 5, 4),
+             (2, 6, 3), (3, 6, 7), (0, 4, 2), (2, 4, 6), (1, 3, 5), (3, 7, 5)]
+    data = [b"stand-in box".ljust(80, b"\0"), struct.pack("<I", len(faces))]
+    for face in faces:
+        vertices = [c for i in face for c in corners[i]]
+        data.append(struct.pack("<12fH", 0, 0, 0, *vertices, 0))
+    return b"".join(data)
+
+
+def stand_in_renderer(seconds, failure_rate=0.0):
+    """
+    A render function that doesn't need openscad: it waits, then returns a
+    box. Useful to test the farm offline.
+
+    Arguments:
+        seconds {float} -- how long each "render" takes
+        failure_rate {float} -- fraction of renders that fail, to exercise retries
+    """
+    def render(root, job):
+        time.sleep(seconds)
+        measurements = {"duration": seconds, "peak_memory_mb": 0.0}
+        if random.random() < failure_rate:
+            return False, "stand-in failure", b"", [], measurements
+        return True, "", box_stl_bytes(10), [job["input"]], measurements
+
+    return render
+
+
+class Worker:
+    def __init__(self, coordinator_url, render, cache_dir=None, poll_interval=0.5):
+        """
+        Fetches jobs from a coordinator, renders them and sends back the results.
+
+        Arguments:
+            coordinator_url {str} -- e.g. http://build-host:8765
+            render {function} -- renders a job, see openscad_renderer
+            cache_dir {str} -- where to unpack source bundles
+            poll_interval {float} -- seconds to wait when there is no work
+        """
+        self.url = coordinator_url.rstrip("/")
+        self.render = render
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "openflexure-render-farm")
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+
+    def _source_root(self, digest):
+        root = os.path.join(self.cache_dir, digest)
+        if not os.path.isdir(root):
+            _, data = _request(f"{self.url}/source/{digest}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            partial = tempfile.mkdtemp(dir=self.cache_dir)
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+                tar.extractall(partial)
+            try:
+                os.rename(partial, root)
+            except OSError:
+                # another worker sharing this cache got there first
+                shutil.rmtree(partial, ignore_errors=True)
+        return root
+
+    def run_once(self):
+        """Render one job, returns False if there was nothing to do"""
+        status, body = _request(f"{self.url}/job")
+        if status == 204:
+            return False
+        job = json.loads(body)
+        try:
+            ok, log, data, dependencies, measurements = self.render(
+                self._source_root(job["source"]), job
+            )
+        except Exception as e:
+            ok, log, data, dependencies, measurements = False, f"worker error: {e}", b"", [], None
+        _request(
+            f"{self.url}/result/{job['id']}",
+            {
+                "lease": job["lease"],
+                "ok": ok,
+                "log": log,
+                "output": _encode(data),
+                "dependencies": dependencies,
+                "measurements": measurements,
+            },
+        )
+        return True
+
+    def run(self):
+        """Keep rendering jobs until stop() is called"""
+        while not self._stop.is_set():
+            try:
+                if not self.run_once():
+                    self._stop.wait(self.poll_interval)
+            except (urllib.error.URLError, ConnectionError, OSError) as e:
+                print(f"Can't reach coordinator: {e}", file=sys.stderr)
+                self._stop.wait(5 * self.poll_interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+def split_openscad_arguments(command):
+    """
+    Split the arguments of an openscad command line, as written in
+    build.ninja, into (parameters, input, output, depfile). The first element
+    is the executable, which is ignored as workers use their own.
+    """
+    arguments = list(command[1:])
+    output = arguments.pop(arguments.index("-o") + 1)
+    arguments.remove("-o")
+    depfile = None
+    if "-d" in arguments:
+        depfile = arguments.pop(arguments.index("-d") + 1)
+        arguments.remove("-d")
+    inputs = [a for a in arguments if a.endswith(".scad")]
+    if len(inputs) != 1:
+        raise ValueError(f"Expected one .scad input in {command}")
+    arguments.remove(inputs[0])
+    return arguments, inputs[0], output, depfile
+
+
+def submit(coordinator_url, command, poll_timeout=30, render_log=None):
+    """
+    Render an openscad command on the farm and write its output and depfile
+    as if it had run locally. Returns the exit code.
+
+    Arguments:
+        coordinator_url {str} -- e.g. http://build-host:8765
+        command {list} -- the openscad command line
+        render_log {str} -- if given, log the render there like
+                            render_history.timed_render, with the time and
+                            memory the worker measured rather than this client
+    """
+    url = coordinator_url.rstrip("/")
+    parameters, input, output, depfile = split_openscad_arguments(command)
+    if render_log:
+        append_record(render_log, {"event": "start", "output": output, "time": time.time()})
+    _, body = _retry_request(
+        f"{url}/submit",
+        {
+            "parameters": parameters,
+            "input": input.replace(os.sep, "/"),
+            "suffix": os.path.splitext(output)[1],
+        },
+    )
+    job_id = json.loads(body)["id"]
+    while True:
+        status, body = _retry_request(
+            f"{url}/wait/{job_id}?timeout={poll_timeout}", timeout=poll_timeout + 30
+        )
+        if status == 200:
+            break
+    result = json.loads(body)
+    try:
+        _request(f"{url}/ack/{job_id}", {})
+    except (urllib.error.URLError, ConnectionError, OSError):
+        # the coordinator forgets the result after a while anyway
+        pass
+    if result["log"]:
+        sys.stderr.write(result["log"])
+    status = 0 if result["status"] == "done" else 1
+    if render_log:
+        finish = {"event": "finish", "output": output, "time": time.time(), "status": status}
+        # a worker that failed before rendering has no measurements
+        finish.update(result.get("measurements") or {})
+        append_record(render_log, finish)
+    if status:
+        return 1
+    with open(output, "wb") as f:
+        f.write(_decode(result["output"]))
+    if depfile:
+        write_depfile(depfile, output, result["dependencies"])
+    return 0
+
+
+def benchmark(worker_counts, n_jobs, render_time):
+    """
+    Measure farm throughput on localhost with stand-in workers.
+
+    Arguments:
+        worker_counts {list} -- numbers of workers to try
+        n_jobs {int} -- jobs submitted for each run
+        render_time {float} -- seconds each stand-in render takes
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, SOURCE_FOLDER))
+        with open(os.path.join(root, SOURCE_FOLDER, "part.scad"), "w") as f:
+            f.write("cube(10);\n")
+        out_dir = os.path.join(root, "builds")
+        os.mkdir(out_dir)
+        for n_workers in worker_counts:
+            server = start_coordinator(Coordinator(root), "127.0.0.1", 0)
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            workers = [
+                Worker(url, stand_in_renderer(render_time), os.path.join(root, "cache"), 0.01)
+                for _ in range(n_workers)
+            ]
+            for w in workers:
+                threading.Thread(target=w.run, daemon=True).start()
+
+            def run_job(i):
+                out = os.path.join(out_dir, f"part_{i}.stl")
+                command = ["openscad", "-D", f"i={i}", "openscad/part.scad", "-o", out, "-d", out + ".d"]
+                return submit(url, command, poll_timeout=5)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                exit_codes = list(executor.map(run_job, range(n_jobs)))
+            elapsed = time.perf_counter() - start
+
+            for w in workers:
+                w.stop()
+            server.shutdown()
+            server.server_close()
+            failed = sum(1 for c in exit_codes if c)
+            results.append((n_workers, elapsed, failed))
+            print(
+                f"{n_workers} workers: {n_jobs} jobs in {elapsed:.2f}s, "
+                f"{n_jobs / elapsed:.1f} jobs/s, {failed} failed"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed rendering for build.py")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    coordinator_parser = subparsers.add_parser("coordinator", help="Run the job coordinator.")
+    coordinator_parser.add_argument("--host", default="", help="Address to listen on.")
+    coordinator_parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    coordinator_parser.add_argument("--root", default=".", help="Repository root to serve openscad/ from.")
+    coordinator_parser.add_argument("--max-attempts", type=int, default=3, help="Tries per failing job.")
+
+    worker_parser = subparsers.add_parser("worker", help="Render jobs from a coordinator.")
+    worker_parser.add_argument("--coordinator", required=True, help="e.g. http://build-host:8765")
+    worker_parser.add_argument("--openscad", default="openscad", help="OpenSCAD executable.")
+    worker_parser.add_argument("--cache-dir", help="Where to unpack the sources.")
+    worker_parser.add_argument(
+        "--stand-in",
+        type=float,
+        metavar="SECONDS",
+        help="Don't run openscad, just wait and return a box (for testing).",
+    )
+
+    submit_parser = subparsers.add_parser(
+        "submit", help="Render an openscad command line on the farm (used by build.ninja)."
+    )
+    submit_parser.add_argument("--coordinator", required=True, help="e.g. http://build-host:8765")
+    submit_parser.add_argument("--log", help="Render log to record the worker's render time in.")
+    submit_parser.add_argument("openscad_command", nargs=argparse.REMAINDER)
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measure throughput on localhost.")
+    benchmark_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    benchmark_parser.add_argument("--jobs", type=int, default=32, help="Jobs per run.")
+    benchmark_parser.add_argument("--render-time", type=float, default=0.2, help="Seconds per stand-in render.")
+
+    args = parser.parse_args()
+
+    if args.command == "coordinator":
+        server = start_coordinator(
+            Coordinator(args.root, max_attempts=args.max_attempts), args.host, args.port
+        )
+        print(f"Coordinator listening on port {server.server_address[1]}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == "worker":
+        if args.stand_in is not None:
+            render = stand_in_renderer(args.stand_in)
+        else:
+            render = openscad_renderer(args.openscad)
+        Worker(args.coordinator, render, args.cache_dir).run()
+    elif args.command == "submit":
+        command = args.openscad_command
+        if command and command[0] == "--":
+            command = command[1:]
+        sys.exit(submit(args.coordinator, command, render_log=args.log))
+    else:
+        benchmark(args.workers, args.jobs, args.render_time)
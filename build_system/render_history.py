@@ -0,0 +1,271 @@
+"""
+Render times and peak memory of every build, kept per commit so a change
+that makes rendering slower is noticed before CI starts timing out.
+
+build.py runs each openscad command through
+
+    python3 -m build_system.render_history run --log builds/.render_log.jsonl \\
+        --output builds/main_body_LS65-M.stl -- openscad ...
+
+which appends a start and a finish record to the log. After the build, the
+finished renders are added to render_history.jsonl, one line per build,
+together with the commit they were built from. Then
+
+    python3 -m build_system.render_history check --threshold 20
+
+compares the latest render of each target with the median of its renders
+in earlier commits, and lists the ones that got slower (or bigger) along
+with the .scad files they depend on that changed since then.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .depfile import read_depfile
+from .render_benchmark import measure_render
+
+RENDER_LOG = ".render_log.jsonl"
+HISTORY_FILE = "render_history.jsonl"
+
+
+def append_record(path, record):
+    """Append a record to a JSON lines file, as a single write"""
+    with open(path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def read_records(path):
+    """All the records in a JSON lines file, or none if it doesn't exist"""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a render that was killed halfway through writing
+                    pass
+    return records
+
+
+def timed_render(log_path, output, command):
+    """
+    Run an openscad command, logging when it started and finished. Returns
+    its exit status.
+
+    Arguments:
+        log_path {str} -- the render log, e.g. builds/.render_log.jsonl
+        output {str} -- the file being rendered
+        command {list} -- the command line to run
+    """
+    append_record(log_path, {"event": "start", "output": output, "time": time.time()})
+    status, duration, peak_memory = measure_render(command, quiet=False)
+    append_record(
+        log_path,
+        {
+            "event": "finish",
+            "output": output,
+            "time": time.time(),
+            "duration": duration,
+            "peak_memory_mb": peak_memory,
+            "status": status,
+        },
+    )
+    return status
+
+
+def current_commit():
+    """The commit checked out, or None outside a git repository"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+    return result.stdout.decode().strip() if result.returncode == 0 else None
+
+
+def record_build(log_path, history_path, settings, commit=None):
+    """
+    Add the renders that succeeded in the render log to the history as one
+    build. Returns the number of renders recorded.
+
+    Arguments:
+        log_path {str} -- the render log written by timed_render
+        history_path {str} -- e.g. render_history.jsonl
+        settings {str} -- what the build was run with (e.g. the backend), only
+                          builds with the same settings are compared
+        commit {str} -- the commit built, by default the one checked out
+    """
+    targets = {}
+    for record in read_records(log_path):
+        if record.get("event") == "finish" and record["status"] == 0 and "duration" in record:
+            targets[record["output"]] = {
+                "duration": record["duration"],
+                "peak_memory_mb": record["peak_memory_mb"],
+            }
+    if targets:
+        append_record(
+            history_path,
+            {
+                "commit": commit or current_commit(),
+                "time": time.time(),
+                "settings": settings,
+                "targets": targets,
+            },
+        )
+    return len(targets)
+
+
+def typical_durations(history, settings, builds=5):
+    """
+    The median render time of each target over its last few recorded renders.
+
+    Arguments:
+        history {list} -- build records, oldest first
+        settings {str} -- only use builds made with these settings
+        builds {int} -- how many of the latest renders of each target to use
+    """
+    durations = {}
+    for build in reversed(history):
+        if build["settings"] != settings:
+            continue
+        for output, measurements in build["targets"].items():
+            recent = durations.setdefault(output, [])
+            if len(recent) < builds:
+                recent.append(measurements["duration"])
+    return {output: statistics.median(d) for output, d in durations.items()}
+
+
+def changed_files(since_commit):
+    """Files changed between a commit and the working tree"""
+    if not since_commit:
+        return set()
+    result = subprocess.run(
+        ["git", "diff", "--name-only", since_commit],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return set(os.path.normpath(p) for p in result.stdout.decode().split())
+
+
+def target_dependencies(output):
+    """The files a target was built from, according to its depfile"""
+    if not os.path.exists(output + ".d"):
+        return set()
+    _, dependencies = read_depfile(output + ".d")
+    return set(os.path.normpath(os.path.relpath(d)) for d in dependencies)
+
+
+def find_regressions(history, threshold=20.0, baseline_size=5):
+    """
+    Targets whose latest render is slower, or uses more memory, than the
+    median of their renders in earlier commits by more than threshold percent.
+
+    Returns a list of dicts describing each regression.
+
+    Arguments:
+        history {list} -- build records, oldest first
+        threshold {float} -- percentage increase that counts as a regression
+        baseline_size {int} -- how many earlier commits to take the median over
+    """
+    if not history:
+        return []
+    latest = history[-1]
+    earlier = [
+        b
+        for b in history[:-1]
+        if b["settings"] == latest["settings"] and b["commit"] != latest["commit"]
+    ]
+    regressions = []
+    for output, measurements in sorted(latest["targets"].items()):
+        # the most recent render of this target in each earlier commit
+        baseline = {}
+        for build in reversed(earlier):
+            if output in build["targets"] and build["commit"] not in baseline:
+                baseline[build["commit"]] = build["targets"][output]
+            if len(baseline) == baseline_size:
+                break
+        if not baseline:
+            continue
+        for measure in ("duration", "peak_memory_mb"):
+            reference = statistics.median(b[measure] for b in baseline.values())
+            if reference > 0 and measurements[measure] > reference * (1 + threshold / 100):
+                regressions.append(
+                    {
+                        "output": output,
+                        "measure": measure,
+                        "baseline": reference,
+                        "latest": measurements[measure],
+                        "increase": 100 * (measurements[measure] / reference - 1),
+                        # the newest commit in the baseline
+                        "since": next(iter(baseline)),
+                    }
+                )
+    return regressions
+
+
+def suspect_files(regression):
+    """The dependencies of a regressed target that changed since its baseline"""
+    return sorted(
+        target_dependencies(regression["output"]) & changed_files(regression["since"])
+    )
+
+
+def format_regression(regression):
+    unit = "s" if regression["measure"] == "duration" else " MB"
+    name = "render time" if regression["measure"] == "duration" else "peak memory"
+    line = (
+        f"{regression['output']}: {name} {regression['baseline']:.1f}{unit}"
+        f" -> {regression['latest']:.1f}{unit} (+{regression['increase']:.0f}%)"
+    )
+    suspects = suspect_files(regression)
+    if suspects:
+        line += "\n    changed since " + regression["since"][:10] + ": " + ", ".join(suspects)
+    return line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track render times between commits.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run and time a render (used by build.ninja).")
+    run_parser.add_argument("--log", required=True, help="The render log to append to.")
+    run_parser.add_argument("--output", required=True, help="The file being rendered.")
+    run_parser.add_argument("render", nargs=argparse.REMAINDER, help="-- the command to run")
+
+    check_parser = subparsers.add_parser(
+        "check", help="List targets whose last render regressed, exits with 1 if any did."
+    )
+    check_parser.add_argument("--history", default=HISTORY_FILE)
+    check_parser.add_argument(
+        "--threshold", type=float, default=20.0, help="Percentage increase to flag."
+    )
+    check_parser.add_argument(
+        "--baseline", type=int, default=5, help="Number of earlier commits to compare with."
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        render = args.render[1:] if args.render[:1] == ["--"] else args.render
+        sys.exit(timed_render(args.log, args.output, render))
+    else:
+        history = read_records(args.history)
+        regressions = find_regressions(history, args.threshold, args.baseline)
+        for regression in regressions:
+            print(format_regression(regression))
+        if history:
+            print(
+                f"{len(regressions)} regression(s) in {len(history[-1]['targets'])} render(s)"
+                f" of {history[-1]['commit'] or 'an unknown commit'}"
+            )
+        sys.exit(1 if regressions else 0)
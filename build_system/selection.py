@@ -0,0 +1,79 @@
+import json
+import os
+
+
+def load_stl_options(build_dir):
+    """
+    Load the stl_options.json written by JsonGenerator from the build folder.
+
+    Arguments:
+        build_dir {str} -- the build folder, e.g. "builds"
+    """
+    with open(os.path.join(build_dir, "stl_options.json")) as f:
+        return json.load(f)
+
+
+def default_configuration(stl_options):
+    """
+    The configuration you get by leaving every option at its documented default.
+
+    Arguments:
+        stl_options {dict} -- the contents of stl_options.json
+    """
+    return {doc["key"]: doc["default"] for doc in stl_options["docs"]}
+
+
+def preset_configuration(stl_options, preset_key):
+    """
+    The configuration selected by one of the entries in `stl_presets`, with any
+    option the preset doesn't mention left at its default.
+
+    Arguments:
+        stl_options {dict} -- the contents of stl_options.json
+        preset_key {str} -- the "key" of the preset
+    """
+    for preset in stl_options["presets"]:
+        if preset["key"] == preset_key:
+            return {**default_configuration(stl_options), **preset["parameters"]}
+    raise KeyError(f"No preset called '{preset_key}' in stl_options.json")
+
+
+def is_selected(parameters, configuration, options):
+    """
+    Whether an stl registered with `parameters` is needed for `configuration`.
+    Only parameters that are user-facing options are compared, a list or set
+    of values means any of them will do.
+
+    Arguments:
+        parameters {dict} -- the "parameters" of an entry in stl_options.json
+        configuration {dict} -- value of every option
+        options {dict} -- the changeable options from stl_options.json
+    """
+    for name, value in parameters.items():
+        if name not in options:
+            continue
+        if isinstance(value, (list, set)):
+            if configuration.get(name) not in value:
+                return False
+        elif configuration.get(name) != value:
+            return False
+    return True
+
+
+def selected_stls(stl_options, configuration):
+    """
+    Sorted list of the stl files needed to build a microscope with the given
+    configuration.
+
+    Arguments:
+        stl_options {dict} -- the contents of stl_options.json
+        configuration {dict} -- value of every option
+    """
+    options = stl_options["options"]
+    return sorted(
+        set(
+            entry["stl"]
+            for entry in stl_options["stls"]
+            if is_selected(entry["parameters"], configuration, options)
+        )
+    )
@@ -0,0 +1,212 @@
+"""
+Cache renders by what they describe, rather than by the files they were
+made from.
+
+With `build.py --semantic-cache`, each STL is built in two steps:
+
+    python3 -m build_system.semantic_cache key --output builds/.semantic_cache/x.stl.key \\
+        -- openscad ... x.scad -o builds/.semantic_cache/x.stl.key.csg -d ...
+
+exports the CSG tree of the part, which is quick as no geometry is
+computed, and writes a hash of the normalised tree to the key file, leaving
+the file alone if the hash hasn't changed. As the key edge is a `restat`
+edge, ninja then skips the render, so comments, formatting or refactoring
+that doesn't change the geometry cost a CSG export rather than a render.
+
+    python3 -m build_system.semantic_cache render --key builds/.semantic_cache/x.stl.key \\
+        --output builds/x.stl --cache-dir builds/.semantic_cache -- openscad ...
+
+renders the part if no render with the same key is cached, e.g. from before
+an edit that has since been reverted, or another part with identical geometry.
+
+    python3 -m build_system.semantic_cache stats
+
+reports how many renders this avoided.
+"""
+import argparse
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import time
+
+from .depfile import read_depfile, write_depfile
+from .extra_files import link_or_copy
+from .render_history import append_record, read_records
+from .stl import file_sha256
+
+CACHE_DIR = os.path.join("builds", ".semantic_cache")
+STATS_FILE = "stats.jsonl"
+
+_IDENTITY_MATRIX = "multmatrix([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])"
+_IMPORT_PATTERN = re.compile(r'\b(import|surface)\(file = "([^"]*)"')
+
+
+def normalise_csg(text, source_dir="."):
+    """
+    Remove differences from a CSG tree that don't change the geometry:
+    indentation, empty groups (left by e.g. echo or assert) and identity
+    transformations. Files the tree imports are replaced by a hash of their
+    content, as it's the content rather than the name that matters.
+
+    Arguments:
+        text {str} -- the CSG tree as exported by openscad
+        source_dir {str} -- folder relative file names are relative to
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line == "group();":
+            continue
+        if line.startswith(_IDENTITY_MATRIX):
+            line = "group()" + line[len(_IDENTITY_MATRIX) :]
+
+        def content_hash(match):
+            path = os.path.join(source_dir, match.group(2))
+            digest = file_sha256(path) if os.path.isfile(path) else "missing"
+            return f'{match.group(1)}(file = "sha256:{digest}"'
+
+        lines.append(_IMPORT_PATTERN.sub(content_hash, line))
+    return "\n".join(lines) + "\n"
+
+
+def csg_key(csg_path):
+    """The semantic cache key of a CSG file"""
+    with open(csg_path, encoding="utf8", errors="replace") as f:
+        text = f.read()
+    normalised = normalise_csg(text, os.path.dirname(csg_path))
+    return hashlib.sha256(normalised.encode()).hexdigest()
+
+
+def _record(cache_dir, output, event):
+    os.makedirs(cache_dir, exist_ok=True)
+    append_record(
+        os.path.join(cache_dir, STATS_FILE), {"output": output, "event": event, "time": time.time()}
+    )
+
+
+def update_key(output, command, cache_dir=CACHE_DIR):
+    """
+    Export a CSG tree with openscad and write its key, only touching the key
+    file if it has changed. Returns the exit status.
+
+    Arguments:
+        output {str} -- the key file, openscad should write output + ".csg" and output + ".d"
+        command {list} -- the openscad command line
+        cache_dir {str} -- where the statistics are kept
+    """
+    status = subprocess.call(command)
+    if status != 0:
+        return status
+    # openscad names the .csg file in the depfile, but ninja expects the key file
+    _, dependencies = read_depfile(output + ".d")
+    write_depfile(output + ".d", output, dependencies)
+
+    key = csg_key(output + ".csg")
+    previous = None
+    if os.path.exists(output):
+        with open(output) as f:
+            previous = f.read().strip()
+    if key == previous:
+        _record(cache_dir, output, "unchanged")
+    else:
+        with open(output, "w") as f:
+            f.write(key + "\n")
+        _record(cache_dir, output, "new" if previous is None else "changed")
+    return 0
+
+
+def cached_render(key_path, output, command, cache_dir=CACHE_DIR, engine=""):
+    """
+    Put the render of a key at output, from the cache or by running the
+    openscad command. Returns the exit status.
+
+    Arguments:
+        key_path {str} -- the key file written by update_key
+        output {str} -- the STL file to write
+        command {list} -- the openscad command line that renders output
+        cache_dir {str} -- where the renders and statistics are kept
+        engine {str} -- anything else that changes the result, e.g. the CSG backend
+    """
+    with open(key_path) as f:
+        key = hashlib.sha256(f"{f.read().strip()} {engine}".encode()).hexdigest()
+    cached = os.path.join(cache_dir, "stl", key[:2], key + os.path.splitext(output)[1])
+    # the output may be a hard link to a cached file, which openscad mustn't overwrite
+    if os.path.exists(output):
+        os.remove(output)
+    if os.path.exists(cached):
+        link_or_copy(cached, output)
+        # ninja compares modification times, so the output must look new
+        os.utime(output, None)
+        _record(cache_dir, output, "cache_hit")
+        return 0
+
+    status = subprocess.call(command)
+    if status == 0:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        link_or_copy(output, cached + ".tmp")
+        os.replace(cached + ".tmp", cached)
+        _record(cache_dir, output, "rendered")
+    return status
+
+
+def cache_statistics(cache_dir=CACHE_DIR):
+    """Count each kind of event in the statistics"""
+    counts = {"new": 0, "changed": 0, "unchanged": 0, "cache_hit": 0, "rendered": 0}
+    for record in read_records(os.path.join(cache_dir, STATS_FILE)):
+        counts[record["event"]] = counts.get(record["event"], 0) + 1
+    return counts
+
+
+def format_statistics(counts):
+    # a key is only updated when ninja sees a changed input file, so every
+    # update of an existing key is a render a file hash would have triggered
+    updates = counts["changed"] + counts["unchanged"]
+    lines = [
+        f"{updates} re-render(s) of existing parts triggered by changed input files,",
+        f"  {counts['unchanged']} skipped as the CSG tree didn't change",
+        f"  {counts['changed']} with a changed CSG tree",
+    ]
+    if updates:
+        lines.append(
+            f"The semantic key avoided {100 * counts['unchanged'] / updates:.0f}% of them."
+        )
+    lines.append(
+        f"Of {counts['cache_hit'] + counts['rendered']} render(s) needed (including"
+        f" {counts['new']} new part(s)), {counts['cache_hit']} came from the cache."
+    )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache renders by their CSG tree.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    key_parser = subparsers.add_parser("key", help="Export a CSG tree and update its key.")
+    key_parser.add_argument("--output", required=True, help="The key file.")
+    key_parser.add_argument("--cache-dir", default=CACHE_DIR)
+    key_parser.add_argument("openscad", nargs=argparse.REMAINDER, help="-- the command to run")
+
+    render_parser = subparsers.add_parser("render", help="Render, or take a render from the cache.")
+    render_parser.add_argument("--key", required=True, help="The key file.")
+    render_parser.add_argument("--output", required=True, help="The STL file.")
+    render_parser.add_argument("--cache-dir", default=CACHE_DIR)
+    render_parser.add_argument("--engine", default="", help="e.g. the CSG backend")
+    render_parser.add_argument("openscad", nargs=argparse.REMAINDER, help="-- the command to run")
+
+    stats_parser = subparsers.add_parser("stats", help="How many renders were avoided.")
+    stats_parser.add_argument("--cache-dir", default=CACHE_DIR)
+
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(format_statistics(cache_statistics(args.cache_dir)))
+        sys.exit(0)
+
+    command = args.openscad[1:] if args.openscad[:1] == ["--"] else args.openscad
+    if args.command == "key":
+        sys.exit(update_key(args.output, command, args.cache_dir))
+    else:
+        sys.exit(cached_render(args.key, args.output, command, args.cache_dir, args.engine))
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import re
+import struct
+
+import numpy as np
+
+_VERTEX_PATTERN = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+def read_stl(path):
+    """
+    Read an ASCII (as written by OpenSCAD) or binary STL file.
+
+    Returns an (n, 3, 3) float64 array of triangle vertex coordinates.
+
+    Arguments:
+        path {str} -- the stl file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) >= 84:
+        (n_triangles,) = struct.unpack("<I", data[80:84])
+        if len(data) == 84 + 50 * n_triangles:
+            records = np.frombuffer(
+                data,
+                dtype=np.dtype(
+                    [("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attr", "<u2")]
+                ),
+                count=n_triangles,
+                offset=84,
+            )
+            return records["vertices"].astype(np.float64)
+
+    vertices = _VERTEX_PATTERN.findall(data)
+    if len(vertices) % 3:
+        raise ValueError(f"'{path}' is not a valid STL file")
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3, 3)
+
+
+def write_binary_stl(path, triangles, header=b"OpenFlexure Microscope"):
+    """
+    Write triangles as a binary STL file.
+
+    Arguments:
+        path {str} -- the stl file to write
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        header {bytes} -- up to 80 bytes of header text
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    records = np.zeros(
+        len(triangles),
+        dtype=np.dtype(
+            [("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attr", "<u2")]
+        ),
+    )
+    records["normal"] = face_normals(triangles)
+    records["vertices"] = triangles
+    with open(path, "wb") as f:
+        f.write(header[:80].ljust(80, b"\0"))
+        f.write(struct.pack("<I", len(triangles)))
+        f.write(records.tobytes())
+
+
+def face_normals(triangles):
+    """Unit normals of each triangle, zero for degenerate triangles"""
+    normals = np.cross(
+        triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+    )
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+
+def face_areas(triangles):
+    """Area of each triangle"""
+    return 0.5 * np.linalg.norm(
+        np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]),
+        axis=1,
+    )
+
+
+def mesh_volume(triangles):
+    """Enclosed volume of a closed, consistently oriented mesh"""
+    return float(
+        np.einsum(
+            "ij,ij->i", triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])
+        ).sum()
+        / 6.0
+    )
+
+
+def mesh_fingerprint(triangles, decimals=4):
+    """
+    A hash of the geometry that doesn't depend on the order of the triangles,
+    which vertex each triangle starts from, or the formatting of the file.
+    Coordinates are rounded to `decimals` places before hashing.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        decimals {int} -- number of decimal places to keep
+    """
+    quantised = np.round(triangles * 10 ** decimals).astype(np.int64)
+    if len(quantised):
+        # rotate each triangle so it starts at its smallest vertex, keeping
+        # the winding order (and so the direction of the normal)
+        first = _smallest_vertex(quantised)
+        rolls = (np.arange(3)[None, :] + first[:, None]) % 3
+        quantised = np.take_along_axis(quantised, rolls[:, :, None], axis=1)
+        flat = quantised.reshape(len(quantised), 9)
+        order = np.lexsort(flat.T[::-1])
+        quantised = flat[order]
+    return hashlib.sha256(np.ascontiguousarray(quantised).tobytes()).hexdigest()
+
+
+def _smallest_vertex(quantised):
+    """Index (0-2) of the lexicographically smallest vertex of each triangle"""
+    a, b, c = quantised[:, 0], quantised[:, 1], quantised[:, 2]
+
+    def less(p, q):
+        # lexicographic p < q, row by row
+        result = np.zeros(len(p), dtype=bool)
+        decided = np.zeros(len(p), dtype=bool)
+        for axis in range(3):
+            lt = (p[:, axis] < q[:, axis]) & ~decided
+            gt = (p[:, axis] > q[:, axis]) & ~decided
+            result |= lt
+            decided |= lt | gt
+        return result
+
+    first = np.zeros(len(quantised), dtype=np.int64)
+    smallest = a.copy()
+    for index, vertex in ((1, b), (2, c)):
+        smaller = less(vertex, smallest)
+        first[smaller] = index
+        smallest[smaller] = vertex[smaller]
+    return first
+
+
+def mesh_metrics(triangles):
+    """
+    Summary of a mesh: triangle count, bounding box, volume, surface area and
+    geometry fingerprint.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+    """
+    if len(triangles):
+        points = triangles.reshape(-1, 3)
+        bbox = [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+    else:
+        bbox = [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+    return {
+        "triangles": int(len(triangles)),
+        "bbox": bbox,
+        "volume": round(mesh_volume(triangles), 6),
+        "area": round(float(face_areas(triangles).sum()), 6),
+        "fingerprint": mesh_fingerprint(triangles),
+    }
+
+
+def file_sha256(path):
+    """sha256 of a file's content"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_stl(path):
+    return os.path.splitext(path)[1].lower() == ".stl"
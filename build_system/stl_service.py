@@ -0,0 +1,386 @@
+"""
+Render STL files on demand, for configurations build.py doesn't pre-render.
+
+    python3 -m build_system.stl_service --port 8766 --cache-dir ~/.cache/openflexure-stl
+    curl -X POST localhost:8766/render -o stand.stl \\
+        -d '{"input": "microscope_stand.scad", "parameters": {"box_h": 40}}'
+
+Each request names a .scad file in openscad/ and its parameters, and gets
+back the STL, rendered with the same openscad arguments build.py would use.
+Renders are cached on disk, keyed by the request and the content of
+openscad/, and the least recently used ones are removed when the cache is
+bigger than --max-cache-mb. Identical requests that arrive while a render
+is running wait for that render instead of starting another, and at most
+--workers renders run at once.
+
+`--stand-in SECONDS` replaces openscad with a renderer that waits and
+returns a box, so the service can be tried without OpenSCAD installed.
+GET /stats returns counters as JSON. `--self-test` renders through the
+service with the stand-in renderer and exits, which CI runs.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .openscad import default_executable, parameter_arguments
+from .render_farm import SOURCE_FOLDER, openscad_renderer, stand_in_renderer
+from .stl import file_sha256
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z_$][A-Za-z0-9_$]*$")
+_INPUT_PATTERN = re.compile(r"^[A-Za-z0-9_\-/]+\.scad$")
+
+
+class RenderError(Exception):
+    pass
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+def validate_request(root, input, parameters):
+    """
+    Check a request names an existing .scad file and has sensible parameter
+    values, raising ValueError if not.
+    """
+    if not isinstance(input, str) or not _INPUT_PATTERN.match(input) or ".." in input:
+        raise ValueError(f"Invalid input file {input!r}")
+    if not os.path.isfile(os.path.join(root, SOURCE_FOLDER, input)):
+        raise ValueError(f"No such file openscad/{input}")
+    if not isinstance(parameters, dict):
+        raise ValueError("parameters should be an object")
+    for name, value in parameters.items():
+        if not _NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid parameter name {name!r}")
+        if isinstance(value, str):
+            if '"' in value or "\\" in value:
+                raise ValueError(f"Invalid value for {name}")
+        elif not isinstance(value, (bool, int, float)):
+            raise ValueError(f"Invalid value for {name}")
+
+
+class SourceDigest:
+    def __init__(self, root):
+        """
+        A hash of the content of the openscad/ folder, recomputed only when
+        a file's size or modification time changes.
+        """
+        self._root = root
+        self._signature = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            files = []
+            for dirpath, dirs, names in os.walk(os.path.join(self._root, SOURCE_FOLDER)):
+                dirs.sort()
+                for name in sorted(names):
+                    path = os.path.join(dirpath, name)
+                    st = os.stat(path)
+                    files.append((path, st.st_size, st.st_mtime_ns))
+            if files != self._signature:
+                digest = hashlib.sha256()
+                for path, _, _ in files:
+                    digest.update(os.path.relpath(path, self._root).encode())
+                    digest.update(file_sha256(path).encode())
+                self._digest = digest.hexdigest()
+                self._signature = files
+            return self._digest
+
+
+class StlService:
+    def __init__(
+        self, root, cache_dir, render, workers=2, max_cache_bytes=500 * 2 ** 20, max_pending=64
+    ):
+        """
+        Renders STL files on request, with a size-limited LRU cache on disk.
+
+        Arguments:
+            root {str} -- the repository root, with the openscad/ folder
+            cache_dir {str} -- where to keep rendered files
+            render {function} -- renders a job, see render_farm.openscad_renderer
+            workers {int} -- renders run at once
+            max_cache_bytes {int} -- size the cache is kept under
+            max_pending {int} -- renders that may be queued or running before
+                                 new ones are turned away
+        """
+        self.root = root
+        self.cache_dir = cache_dir
+        self.render = render
+        self.max_cache_bytes = max_cache_bytes
+        self.max_pending = max_pending
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "failures": 0, "evictions": 0}
+        self._source = SourceDigest(root)
+        self._executor = ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        # key -> size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_cache()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".stl")
+
+    def _load_cache(self):
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".stl"):
+                st = os.stat(os.path.join(self.cache_dir, name))
+                found.append((st.st_mtime, name[: -len(".stl")], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_cache_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def key(self, input, parameters):
+        """The cache key of a request, which changes with the source files"""
+        request = json.dumps(
+            {"input": input, "parameters": parameters, "source": self._source.get()},
+            sort_keys=True,
+        )
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def _render(self, key, input, parameters):
+        job = {
+            "input": f"{SOURCE_FOLDER}/{input}",
+            "parameters": parameter_arguments(parameters),
+            "suffix": ".stl",
+        }
+        try:
+            ok, log, data, _, _ = self.render(self.root, job)
+            with self._lock:
+                if not ok:
+                    self.stats["failures"] += 1
+                    raise RenderError(log)
+                partial = self._path(key) + ".tmp"
+                with open(partial, "wb") as f:
+                    f.write(data)
+                os.replace(partial, self._path(key))
+                self._entries[key] = len(data)
+                self._size += len(data)
+                self._evict()
+            return data
+        finally:
+            # only once the result is in the cache, so later requests find it there
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def get(self, input, parameters):
+        """
+        The STL for a request, rendering it if it isn't cached.
+
+        Returns (STL data, "hit", "miss" or "coalesced").
+        """
+        validate_request(self.root, input, parameters)
+        key = self.key(input, parameters)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                # so the order survives a restart, see _load_cache
+                os.utime(self._path(key), None)
+                with open(self._path(key), "rb") as f:
+                    return f.read(), "hit"
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                outcome = "coalesced"
+            else:
+                if len(self._in_flight) >= self.max_pending:
+                    raise ServiceBusy(f"{len(self._in_flight)} renders are already waiting")
+                self.stats["misses"] += 1
+                outcome = "miss"
+                future = self._executor.submit(self._render, key, input, parameters)
+                self._in_flight[key] = future
+        return future.result(), outcome
+
+    def status(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "in_flight": len(self._in_flight),
+                "cache_entries": len(self._entries),
+                "cache_bytes": self._size,
+            }
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text):
+        self._send(status, text.encode("utf-8"), "text/plain; charset=utf-8")
+
+    def do_GET(self):
+        if self.path.strip("/") == "stats":
+            body = json.dumps(self.service.status()).encode("utf-8")
+            self._send(200, body, "application/json")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path.strip("/") != "render":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            input, parameters = request.get("input"), request.get("parameters", {})
+            validate_request(self.service.root, input, parameters)
+        except (ValueError, AttributeError) as e:
+            self._send_text(400, f"{e}\n")
+            return
+        try:
+            data, outcome = self.service.get(input, parameters)
+        except ServiceBusy as e:
+            self._send_text(503, f"{e}\n")
+        except RenderError as e:
+            self._send_text(500, f"Render failed:\n{e}\n")
+        except Exception as e:
+            self._send_text(500, f"Internal error: {e!r}\n")
+            raise
+        else:
+            self._send(200, data, "model/stl", {"X-Cache": outcome})
+
+
+# socketserver.ThreadingMixIn rather than ThreadingHTTPServer, which needs Python 3.7
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    # requests for a render hold their connection open until it's done
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def start_service(service, host="", port=0):
+    """
+    Serve an StlService over HTTP in a background thread, returns the server.
+    The port it listens on is `server.server_address[1]`.
+    """
+    handler = type("Handler", (_ServiceHandler,), {"service": service})
+    server = _Server((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _expect(value, expected, what):
+    # not assert, so the check still runs under python -O
+    if value != expected:
+        raise AssertionError(f"{what}: expected {expected!r}, got {value!r}")
+
+
+def self_test():
+    """
+    Render through the HTTP interface with the stand-in renderer, so a change
+    to the renderer interface can't break the service unnoticed. Raises
+    AssertionError if something is wrong.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, SOURCE_FOLDER))
+        with open(os.path.join(root, SOURCE_FOLDER, "part.scad"), "w") as f:
+            f.write("cube(size);\n")
+        service = StlService(root, os.path.join(root, "cache"), stand_in_renderer(0.01))
+        server = start_service(service, "127.0.0.1", 0)
+        url = f"http://127.0.0.1:{server.server_address[1]}/render"
+
+        def post(request):
+            data = json.dumps(request).encode("utf-8")
+            try:
+                with urllib.request.urlopen(url, data=data, timeout=30) as response:
+                    return response.status, response.headers.get("X-Cache"), response.read()
+            except urllib.error.HTTPError as e:
+                return e.code, None, e.read()
+
+        try:
+            for outcome in ("miss", "hit"):
+                status, cache, body = post({"input": "part.scad", "parameters": {"size": 10}})
+                _expect(status, 200, f"status of a render ({body[:200]!r})")
+                _expect(cache, outcome, "X-Cache")
+                _expect(body[80:84], struct.pack("<I", 12), "triangles in the STL")
+            status, _, _ = post({"input": "missing.scad"})
+            _expect(status, 400, "status of a request for a missing file")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render STL files on demand.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.join(os.path.expanduser("~"), ".cache", "openflexure-stl"),
+    )
+    parser.add_argument("--max-cache-mb", type=float, default=500)
+    parser.add_argument("--workers", type=int, default=2, help="Renders to run at once.")
+    parser.add_argument("--openscad", default=default_executable())
+    parser.add_argument(
+        "--stand-in",
+        type=float,
+        metavar="SECONDS",
+        help="Don't run openscad, return a box after this many seconds (for testing).",
+    )
+    parser.add_argument(
+        "--self-test",
+        action="store_true",
+        help="Check a render through the service works, with the stand-in renderer, and exit.",
+    )
+    args = parser.parse_args()
+
+    if args.self_test:
+        self_test()
+        print("stl_service self test passed")
+        sys.exit(0)
+
+    if args.stand_in is not None:
+        render = stand_in_renderer(args.stand_in)
+    else:
+        render = openscad_renderer(args.openscad)
+    service = StlService(
+        os.getcwd(),
+        args.cache_dir,
+        render,
+        workers=args.workers,
+        max_cache_bytes=int(args.max_cache_mb * 2 ** 20),
+    )
+    server = start_service(service, args.host, args.port)
+    print(f"Serving STL files on http://{args.host}:{server.server_address[1]}/render")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,259 @@
+"""
+Pictures of STL files, drawn without OpenGL.
+
+    python3 -m build_system.thumbnail builds/*.stl --output-dir builds/thumbnails
+
+writes builds/thumbnails/<name>.iso.png for each file: an orthographic view
+from the front right and above, flat shaded on a transparent background.
+`--views` picks other views from VIEWS.
+
+Triangles are drawn with a z-buffer in NumPy, several pixels per output
+pixel to smooth the edges. Files are drawn in parallel processes, and each
+picture is cached by the mesh fingerprint (see stl.mesh_fingerprint), so a
+part whose geometry hasn't changed isn't drawn again.
+"""
+import argparse
+import hashlib
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .extra_files import link_or_copy
+from .stl import face_normals, mesh_fingerprint, mesh_volume, read_stl
+
+CACHE_DIR = os.path.join("builds", ".thumbnail_cache")
+# change this when the pictures change, so cached ones aren't used
+RENDERER_VERSION = 1
+# azimuth and elevation of the camera, in degrees. Azimuth is measured
+# anticlockwise from +x, so -90 looks at the front of a part.
+VIEWS = {
+    "iso": (-60, 30),
+    "front": (-90, 0),
+    "top": (-90, 90),
+}
+COLOUR = (0.95, 0.6, 0.15)
+SUPERSAMPLING = 3
+MARGIN = 0.05
+
+
+def view_axes(azimuth, elevation):
+    """
+    Unit vectors (right, up, towards the camera) of a view, in model coordinates.
+    """
+    azimuth, elevation = np.radians(azimuth), np.radians(elevation)
+    towards = np.array(
+        [
+            np.cos(elevation) * np.cos(azimuth),
+            np.cos(elevation) * np.sin(azimuth),
+            np.sin(elevation),
+        ]
+    )
+    right = np.array([-np.sin(azimuth), np.cos(azimuth), 0.0])
+    return right, np.cross(towards, right), towards
+
+
+def rasterise(points, shades, width, height, max_fragments=4000000):
+    """
+    Draw flat shaded triangles with a z-buffer.
+
+    Returns (shade, covered), each (height, width).
+
+    Arguments:
+        points {ndarray} -- (n, 3, 3) triangle vertices in pixels, x right,
+                            y down and z towards the camera
+        shades {ndarray} -- (n,) brightness of each triangle
+        width {int} -- image width in pixels
+        height {int} -- image height in pixels
+        max_fragments {int} -- pixels tested at once, to limit memory use
+    """
+    depth = np.full(width * height, -np.inf)
+    shade = np.zeros(width * height)
+    # the pixel centres inside each triangle's bounding box
+    x0 = np.clip(np.ceil(points[:, :, 0].min(axis=1) - 0.5), 0, width).astype(np.int64)
+    x1 = np.clip(np.floor(points[:, :, 0].max(axis=1) - 0.5) + 1, 0, width).astype(np.int64)
+    y0 = np.clip(np.ceil(points[:, :, 1].min(axis=1) - 0.5), 0, height).astype(np.int64)
+    y1 = np.clip(np.floor(points[:, :, 1].max(axis=1) - 0.5) + 1, 0, height).astype(np.int64)
+    columns = np.maximum(x1 - x0, 0)
+    counts = columns * np.maximum(y1 - y0, 0)
+    ends = np.cumsum(counts)
+
+    first = 0
+    while first < len(points):
+        last = max(np.searchsorted(ends, ends[first] - counts[first] + max_fragments), first + 1)
+        chunk = np.arange(first, min(last, len(points)))
+        first = chunk[-1] + 1
+        c = counts[chunk]
+        if c.sum() == 0:
+            continue
+        triangle = np.repeat(chunk, c)
+        local = np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        px = x0[triangle] + local % columns[triangle]
+        py = y0[triangle] + local // columns[triangle]
+
+        t = points[triangle]
+        cx, cy = px + 0.5, py + 0.5
+        # barycentric coordinates from the edge functions
+        a, b, d = t[:, 0], t[:, 1], t[:, 2]
+        area = (b[:, 0] - a[:, 0]) * (d[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (d[:, 0] - a[:, 0])
+        area = np.where(area == 0, np.inf, area)
+        w1 = ((cx - a[:, 0]) * (d[:, 1] - a[:, 1]) - (cy - a[:, 1]) * (d[:, 0] - a[:, 0])) / area
+        w2 = ((b[:, 0] - a[:, 0]) * (cy - a[:, 1]) - (b[:, 1] - a[:, 1]) * (cx - a[:, 0])) / area
+        w0 = 1 - w1 - w2
+        inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+        z = (w0 * a[:, 2] + w1 * b[:, 2] + w2 * d[:, 2])[inside]
+        pixel = (py * width + px)[inside]
+        triangle = triangle[inside]
+
+        # the nearest fragment at each pixel
+        order = np.lexsort((-z, pixel))
+        pixel, z, triangle = pixel[order], z[order], triangle[order]
+        nearest = np.ones(len(pixel), dtype=bool)
+        nearest[1:] = pixel[1:] != pixel[:-1]
+        pixel, z, triangle = pixel[nearest], z[nearest], triangle[nearest]
+        closer = z > depth[pixel]
+        depth[pixel[closer]] = z[closer]
+        shade[pixel[closer]] = shades[triangle[closer]]
+
+    covered = np.isfinite(depth)
+    return shade.reshape(height, width), covered.reshape(height, width)
+
+
+def render_thumbnail(triangles, view="iso", size=256, colour=COLOUR):
+    """
+    Draw a mesh, returns an RGBA image as a (size, size, 4) uint8 array.
+
+    Arguments:
+        triangles {ndarray} -- (n, 3, 3) triangle vertex coordinates
+        view {str} -- one of VIEWS
+        size {int} -- width and height in pixels
+        colour {tuple} -- RGB colour of a fully lit face, 0 to 1
+    """
+    pixels = size * SUPERSAMPLING
+    image = np.zeros((size, size, 4), dtype=np.uint8)
+    if len(triangles) == 0:
+        return image
+    if mesh_volume(triangles) < 0:
+        triangles = triangles[:, ::-1]
+
+    right, up, towards = view_axes(*VIEWS[view])
+    normals = face_normals(triangles)
+    # faces pointing away from the camera are hidden behind the rest of the part
+    visible = normals @ towards > 0
+    triangles, normals = triangles[visible], normals[visible]
+    light = right * 0.4 + up * 0.6 + towards
+    light /= np.linalg.norm(light)
+    shades = 0.3 + 0.7 * np.clip(normals @ light, 0, 1)
+
+    view_points = np.stack([triangles @ right, triangles @ up, triangles @ towards], axis=-1)
+    low = view_points.reshape(-1, 3).min(axis=0)
+    high = view_points.reshape(-1, 3).max(axis=0)
+    scale = pixels * (1 - 2 * MARGIN) / max((high - low)[:2].max(), 1e-9)
+    centre = (low + high) / 2
+    points = np.empty_like(view_points)
+    points[..., 0] = (view_points[..., 0] - centre[0]) * scale + pixels / 2
+    points[..., 1] = pixels / 2 - (view_points[..., 1] - centre[1]) * scale
+    points[..., 2] = view_points[..., 2]
+
+    shade, covered = rasterise(points, shades, pixels, pixels)
+    # average each block of pixels, weighting the colour by coverage
+    blocks = (size, SUPERSAMPLING, size, SUPERSAMPLING)
+    coverage = covered.reshape(blocks).mean(axis=(1, 3))
+    brightness = (shade * covered).reshape(blocks).mean(axis=(1, 3))
+    brightness = brightness / np.where(coverage > 0, coverage, 1)
+    for i in range(3):
+        image[..., i] = np.round(255 * brightness * colour[i])
+    image[..., 3] = np.round(255 * coverage)
+    return image
+
+
+def write_png(path, image):
+    """
+    Write an RGBA image as a PNG file.
+
+    Arguments:
+        path {str} -- the file to write
+        image {ndarray} -- (height, width, 4) uint8 array
+    """
+    height, width, _ = image.shape
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    # 8 bits per channel, RGBA, no interlacing
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    # each row starts with its filter type, 0 for none
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", header))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 9)))
+        f.write(chunk(b"IEND", b""))
+
+
+def thumbnail_path(output_dir, stl_file, view):
+    """Where the thumbnail of an STL file from a view goes"""
+    name = os.path.splitext(os.path.basename(stl_file))[0]
+    return os.path.join(output_dir, f"{name}.{view}.png")
+
+
+def _make_thumbnails(job):
+    stl_file, output_dir, views, size, cache_dir = job
+    triangles = read_stl(stl_file)
+    fingerprint = mesh_fingerprint(triangles)
+    written = {}
+    for view in views:
+        key = hashlib.sha256(
+            f"{fingerprint} {view} {size} {RENDERER_VERSION}".encode()
+        ).hexdigest()
+        cached = os.path.join(cache_dir, key[:2], key + ".png")
+        if not os.path.exists(cached):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            write_png(cached + ".tmp", render_thumbnail(triangles, view, size))
+            os.replace(cached + ".tmp", cached)
+        path = thumbnail_path(output_dir, stl_file, view)
+        if os.path.exists(path):
+            os.remove(path)
+        link_or_copy(cached, path)
+        written[view] = path
+    return written
+
+
+def make_thumbnails(stl_files, output_dir, views=("iso",), size=256, cache_dir=CACHE_DIR, jobs=None):
+    """
+    Draw thumbnails of STL files in parallel, reusing cached ones.
+
+    Returns a dict of the thumbnail of each view, for each STL file.
+
+    Arguments:
+        stl_files {list} -- the STL files
+        output_dir {str} -- where to put the thumbnails
+        views {list} -- names of VIEWS to draw
+        size {int} -- width and height in pixels
+        cache_dir {str} -- where thumbnails are cached by mesh fingerprint
+        jobs {int} -- number of files to draw at once
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs_list = [(f, output_dir, tuple(views), size, cache_dir) for f in stl_files]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(stl_files, executor.map(_make_thumbnails, jobs_list)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draw thumbnails of STL files.")
+    parser.add_argument("stl", nargs="+", help="STL files.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--views", nargs="+", choices=sorted(VIEWS), default=["iso"])
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--jobs", "-j", type=int)
+    args = parser.parse_args()
+
+    make_thumbnails(args.stl, args.output_dir, args.views, args.size, args.cache_dir, args.jobs)
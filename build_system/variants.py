@@ -0,0 +1,165 @@
+from collections import namedtuple
+
+# A rule that removes impossible combinations: `when` is called with the
+# values of `axes` (in order) and returns True if the combination should be
+# skipped. Rules are checked as soon as all their axes have values, so whole
+# branches of the matrix are pruned without being enumerated.
+Exclusion = namedtuple("Exclusion", ["axes", "when"])
+
+
+class VariantMatrix:
+    def __init__(self, name, axes, output, exclude=None, labels=None):
+        """
+        A declarative set of build variants: the product of some option axes,
+        minus the combinations removed by exclusion rules.
+
+        Arguments:
+            name {str} -- name used when reporting on the matrix
+            axes {dict} -- values of each axis, in order. A tuple of names as
+                           the key means the values are tuples that set
+                           several variables together, e.g. ("camera", "lens")
+            output {str} -- template for the output file name, formatted with
+                            the (labelled) values of the variant
+            exclude {list} -- Exclusion rules for impossible combinations
+            labels {dict} -- for each variable, a dict mapping values to the
+                             text used in the output name, e.g. {True: "-BS", False: ""}
+        """
+        self.name = name
+        self.axes = dict(axes)
+        self.output_template = output
+        self.exclusions = list(exclude or [])
+        self.labels = dict(labels or {})
+
+    def _variables(self, axis):
+        return axis if isinstance(axis, tuple) else (axis,)
+
+    def __iter__(self):
+        """Lazily yield each possible variant as a dict of variable values"""
+        axes = list(self.axes.items())
+        assigned = set()
+        # work out which rules can be checked once each axis has a value
+        checks = []
+        remaining = list(self.exclusions)
+        for axis, _ in axes:
+            assigned.update(self._variables(axis))
+            ready = [r for r in remaining if set(r.axes) <= assigned]
+            remaining = [r for r in remaining if r not in ready]
+            checks.append(ready)
+        if remaining:
+            raise ValueError(
+                f"Exclusion rules in '{self.name}' refer to unknown axes: "
+                + ", ".join(str(r.axes) for r in remaining)
+            )
+
+        def expand(depth, variant):
+            if depth == len(axes):
+                yield dict(variant)
+                return
+            axis, values = axes[depth]
+            for value in values:
+                values_for = value if isinstance(axis, tuple) else (value,)
+                child = {**variant, **dict(zip(self._variables(axis), values_for))}
+                if any(r.when(*[child[a] for a in r.axes]) for r in checks[depth]):
+                    continue
+                yield from expand(depth + 1, child)
+
+        return expand(0, {})
+
+    def output(self, variant):
+        """The output file name of a variant"""
+        labelled = {
+            k: self.labels[k][v] if k in self.labels else v for k, v in variant.items()
+        }
+        return self.output_template.format(**labelled)
+
+    def count(self):
+        """Number of variants left after pruning"""
+        return sum(1 for _ in self)
+
+    def unpruned_count(self):
+        """Size of the full product of all the axes"""
+        n = 1
+        for values in self.axes.values():
+            n *= len(values)
+        return n
+
+    def with_axis(self, axis, values, label=None):
+        """
+        A copy of this matrix with an extra axis (or different values for an
+        existing one), to see what it would cost.
+
+        Arguments:
+            axis {str} -- name of the new axis
+            values {list} -- its values
+            label {dict} -- optional labels for the output name
+        """
+        labels = dict(self.labels)
+        if label is not None:
+            labels[axis] = label
+        return VariantMatrix(
+            self.name,
+            {**self.axes, axis: values},
+            self.output_template,
+            exclude=self.exclusions,
+            labels=labels,
+        )
+
+
+def variant_report(matrices, extra_axes=None):
+    """
+    Describe how many renders each matrix produces and, optionally, how many
+    more it would produce with extra axes added.
+
+    Arguments:
+        matrices {list} -- the VariantMatrix objects used by the build
+        extra_axes {dict} -- maps "matrix:axis" or "axis" (meaning every
+                             matrix) to a list of values
+    """
+    if extra_axes is None:
+        extra_axes = {}
+    lines = []
+    total = 0
+    total_extra = 0
+    for matrix in matrices:
+        count = matrix.count()
+        total += count
+        axes = " x ".join(
+            f"{'/'.join(matrix._variables(a))}({len(v)})" for a, v in matrix.axes.items()
+        )
+        lines.append(
+            f"{matrix.name}: {count} renders ({matrix.unpruned_count() - count} pruned) from {axes}"
+        )
+        for key, values in extra_axes.items():
+            target, _, axis = key.rpartition(":")
+            if target and target != matrix.name:
+                continue
+            extended = matrix.with_axis(axis, values).count()
+            total_extra += extended - count
+            change = "changing" if axis in matrix.axes else "adding"
+            lines.append(
+                f"  {change} {axis} to {len(values)} values: {extended - count:+d} renders"
+            )
+    lines.append(f"total: {total} renders")
+    if extra_axes:
+        lines.append(f"the changes above would add {total_extra} renders")
+    return "\n".join(lines)
+
+
+def parse_axis_argument(argument):
+    """
+    Parse a "[matrix:]axis=value1,value2" command line argument into a key and
+    a list of values. Values that look like ints or bools are converted.
+    """
+    key, _, values = argument.partition("=")
+    if not values:
+        raise ValueError(f"Expected [matrix:]axis=value1,value2 but got '{argument}'")
+
+    def convert(value):
+        if value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    return key, [convert(v) for v in values.split(",")]
@@ -0,0 +1,329 @@
+"""
+Re-render the STL files affected by edits to the OpenSCAD sources.
+
+Changes are picked up with inotify on Linux, or by polling modification
+times elsewhere. Each changed file is mapped to the outputs that use it,
+directly or through `include <...>`/`use <...>`, and only those are passed to
+ninja. A burst of saves is treated as one change, and if a new edit affects
+something that is being rendered right now, the running ninja is stopped
+and restarted so no time is spent finishing an obsolete render.
+"""
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import re
+import select
+import signal
+import struct
+import subprocess
+import sys
+import time
+
+from .depfile import read_depfile
+
+_REFERENCE_PATTERN = re.compile(
+    r"""(?:\b(?:include|use)\s*<\s*([^>]+?)\s*>)|(?:\bimport\s*\(\s*(?:file\s*=\s*)?"([^"]+)")"""
+)
+_COMMENT_PATTERN = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+
+
+def scad_references(path):
+    """
+    Files referenced by a .scad file through include, use or import, resolved
+    relative to the file. References that don't exist are left out.
+    """
+    with open(path, encoding="utf8", errors="replace") as f:
+        source = _COMMENT_PATTERN.sub("", f.read())
+    folder = os.path.dirname(path)
+    references = set()
+    for match in _REFERENCE_PATTERN.finditer(source):
+        reference = match.group(1) or match.group(2)
+        candidate = os.path.normpath(os.path.join(folder, reference))
+        if os.path.isfile(candidate):
+            references.add(candidate)
+    return references
+
+
+class DependencyGraph:
+    def __init__(self, source_dir):
+        """
+        The include/use graph of all the .scad files below source_dir.
+
+        Arguments:
+            source_dir {str} -- e.g. "openscad"
+        """
+        self.source_dir = source_dir
+        self._references = {}
+        self.refresh()
+
+    def refresh(self, changed=None):
+        """Re-read the references of changed files (or of every file)"""
+        if changed is None:
+            changed = []
+            for root, dirs, files in os.walk(self.source_dir):
+                changed += [os.path.join(root, f) for f in files if f.endswith(".scad")]
+        for path in changed:
+            path = os.path.normpath(path)
+            if path.endswith(".scad") and os.path.isfile(path):
+                self._references[path] = scad_references(path)
+            else:
+                self._references.pop(path, None)
+
+    def dependencies(self, path):
+        """Every file path depends on, including itself"""
+        seen = set()
+        stack = [os.path.normpath(path)]
+        while stack:
+            p = stack.pop()
+            if p not in seen:
+                seen.add(p)
+                stack.extend(self._references.get(p, ()))
+        return seen
+
+
+def affected_targets(targets, graph, changed):
+    """
+    The outputs that need rebuilding when files change.
+
+    Arguments:
+        targets {dict} -- maps each output to its input .scad file
+        graph {DependencyGraph} -- the include/use graph
+        changed {set} -- paths of the changed files
+    """
+    changed = set(os.path.normpath(p) for p in changed)
+    affected = set()
+    for output, input in targets.items():
+        dependencies = graph.dependencies(input)
+        # the depfile of a previous render also knows about e.g. imported files
+        if os.path.exists(output + ".d"):
+            _, deps = read_depfile(output + ".d")
+            dependencies |= set(os.path.normpath(os.path.relpath(d)) for d in deps)
+        if dependencies & changed:
+            affected.add(output)
+    return affected
+
+
+class PollingWatcher:
+    def __init__(self, source_dir, interval=0.5):
+        """Watches source_dir for changes by comparing modification times"""
+        self.source_dir = source_dir
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.source_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds, returning the set of changed paths"""
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(
+                p
+                for p in set(snapshot) | set(self._snapshot)
+                if snapshot.get(p) != self._snapshot.get(p)
+            )
+            self._snapshot = snapshot
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, source_dir):
+        """Watches source_dir (recursively) for changes with Linux inotify"""
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._libc = libc
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._folders = {}
+        for root, dirs, files in os.walk(source_dir):
+            self._add_watch(root)
+
+    def _add_watch(self, folder):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Can't watch {folder}")
+        self._folders[wd] = folder
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds, returning the set of changed paths"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0").decode()
+            offset += length
+            path = os.path.join(self._folders.get(wd, ""), name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add_watch(path)
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(source_dir, polling=False):
+    """An inotify watcher if possible, otherwise a polling one"""
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(source_dir)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(source_dir)
+
+
+def collect_changes(watcher, debounce, timeout):
+    """
+    Wait up to timeout for a change, then keep collecting until nothing has
+    changed for `debounce` seconds, so a burst of saves counts as one edit.
+    """
+    changed = watcher.changes(timeout)
+    if changed:
+        while True:
+            more = watcher.changes(debounce)
+            if not more:
+                break
+            changed |= more
+    return changed
+
+
+def order_targets(targets, focus):
+    """
+    Split targets into the ones matching the focus patterns, which are
+    rendered first, and the rest. Empty groups are dropped.
+    """
+    first = sorted(
+        t for t in targets if any(fnmatch.fnmatch(os.path.basename(t), p) for p in focus)
+    )
+    rest = sorted(set(targets) - set(first))
+    return [group for group in (first, rest) if group]
+
+
+class NinjaRun:
+    def __init__(self, ninja_command, groups):
+        """
+        Builds groups of targets one after the other with ninja, in a way that
+        can be cancelled.
+
+        Arguments:
+            ninja_command {list} -- ninja and any options to pass it
+            groups {list} -- lists of targets, built in order
+        """
+        self._ninja = list(ninja_command)
+        self.groups = list(groups)
+        self.targets = set(t for g in self.groups for t in g)
+        self._process = None
+
+    def poll(self):
+        """Start the next group when the last finished, returns False when all are done"""
+        if self._process is not None:
+            if self._process.poll() is None:
+                return True
+            self._process = None
+        if not self.groups:
+            return False
+        group = self.groups.pop(0)
+        print(f"Rendering {len(group)} target(s): {' '.join(os.path.basename(t) for t in group)}")
+        self._process = subprocess.Popen(self._ninja + group, start_new_session=True)
+        self._group = set(group)
+        return True
+
+    def in_flight(self):
+        """Targets of the group ninja is working on right now"""
+        return self._group if self._process is not None else set()
+
+    def cancel(self):
+        """Interrupt ninja, which stops its renders and removes partial outputs"""
+        if self._process is not None and self._process.poll() is None:
+            os.killpg(self._process.pid, signal.SIGINT)
+            self._process.wait()
+        self._process = None
+        self.groups = []
+
+
+def watch(
+    targets,
+    ninja_command,
+    source_dir="openscad",
+    focus=(),
+    debounce=0.3,
+    polling=False,
+):
+    """
+    Watch the sources and re-render affected targets until interrupted.
+
+    Arguments:
+        targets {dict} -- maps each output to its input .scad file
+        ninja_command {list} -- ninja and any options to pass it, e.g. ["ninja", "-j", "4"]
+        source_dir {str} -- folder to watch
+        focus {list} -- patterns (e.g. "main_body_*.stl") of outputs to render first
+        debounce {float} -- seconds without changes that end a burst of edits
+        polling {bool} -- poll for changes even if inotify is available
+    """
+    graph = DependencyGraph(source_dir)
+    watcher = make_watcher(source_dir, polling)
+    print(f"Watching {source_dir}/ with {type(watcher).__name__}, press Ctrl+C to stop")
+    run = None
+    queued = set()
+    try:
+        while True:
+            changed = collect_changes(watcher, debounce, timeout=0.2)
+            if changed:
+                graph.refresh(changed)
+                affected = affected_targets(targets, graph, changed)
+                if affected:
+                    print(f"{len(changed)} file(s) changed, {len(affected)} target(s) affected")
+                if run is not None and affected & run.in_flight():
+                    # a newer edit made the running renders obsolete
+                    print("Cancelling renders made obsolete by the latest edit")
+                    unfinished = set(t for g in run.groups for t in g) | run.in_flight()
+                    run.cancel()
+                    run = None
+                    queued |= unfinished
+                queued |= affected
+            if run is None and queued:
+                run = NinjaRun(ninja_command, order_targets(queued, focus))
+                queued = set()
+            if run is not None and not run.poll():
+                run = None
+                if not queued:
+                    print("Up to date, waiting for changes")
+    except KeyboardInterrupt:
+        if run is not None:
+            run.cancel()
+    finally:
+        watcher.close()